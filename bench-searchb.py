@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+# Benchmark the different searchb implementations (Python, C, C++,
+# Go and Rust) on synthetic corpora with benchmark.py and detect
+# regressions against a baseline.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+
+
+log = logging.getLogger(__name__)
+
+src_dir = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (directory: 'build' for the build directory, None for the
+# source directory; filename; build command or None if CMake builds it)
+impls = {
+        'py':   (None, 'searchb.py', None),
+        'c':    ('build', 'searchb', None),
+        'cc':   ('build', 'searchbxx', None),
+        'go':   ('build', 'searchb-go', [ 'go', 'build', '-o', '{out}',
+                    '{src}/searchb.go' ]),
+        'rust': (None, 'searchb-rs/target/release/searchb-rs', [ 'cargo',
+                    'build', '--release', '--manifest-path',
+                    '{src}/searchb-rs/Cargo.toml' ]),
+        }
+
+positions = [ 'start', 'middle', 'end', 'none' ]
+
+def parse_size(s):
+    units = { 'K': 2**10, 'M': 2**20, 'G': 2**30 }
+    if s[-1:].upper() in units:
+        return int(s[:-1]) * units[s[-1:].upper()]
+    return int(s)
+
+def parse_args(*a):
+    p = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description='Benchmark the searchb implementations against each other',
+            epilog='''
+For each size a random target file is generated (and reused by later
+runs) in the work directory. The query is a slice of the target at
+the start, in the middle or at the end of it, or random bytes that
+don't occur in it (i.e. the whole target is searched). Each
+implementation is checked for the right result before it's measured
+with benchmark.py, with a cold and a warm page cache.
+
+The work directory shouldn't be on a tmpfs, otherwise the cold cache
+runs are warm, as well. Dropping the page cache needs root, otherwise
+the target files are just evicted with posix_fadvise().
+
+Implementations that aren't built are skipped, the C and C++ ones are
+built with CMake, the Go and Rust ones are built with `--build`.
+
+Examples:
+
+Record a baseline:
+
+    bench-searchb --build-dir build --update
+
+Compare the implementations on 1 GiB corpora and plot the results:
+
+    bench-searchb --sizes 1G --svg searchb.svg
+
+Exit status is 1 if an implementation returned a wrong result or if
+its median wall time regressed beyond the threshold.
+
+'''
+            )
+    p.add_argument('--impls', nargs='+', choices=list(impls), default=list(impls),
+            help='implementations to benchmark (default: all available)')
+    p.add_argument('--impl', action='append', default=[], metavar='NAME=PATH',
+            help='add or override an implementation')
+    p.add_argument('--build-dir', default=os.path.join(src_dir, 'build'),
+            help='CMake build directory (default: %(default)s)')
+    p.add_argument('--build', action='store_true',
+            help='build the Go and Rust implementations if missing')
+    p.add_argument('--work-dir', '-w', default='searchb-corpus',
+            help='directory for the generated corpora (default: %(default)s)')
+    p.add_argument('--sizes', nargs='+', default=['16M', '256M'], metavar='SIZE',
+            help='target sizes (K/M/G suffixes, default: %(default)s)')
+    p.add_argument('--positions', nargs='+', choices=positions, default=positions,
+            help='match positions (default: all)')
+    p.add_argument('--query-size', type=int, default=32,
+            help='query size in bytes (default: %(default)s)')
+    p.add_argument('--seed', type=int, default=23,
+            help='seed for generating the corpora (default: %(default)s)')
+    p.add_argument('--cache', nargs='+', choices=['cold', 'warm'],
+            default=['cold', 'warm'],
+            help='page cache states (default: %(default)s)')
+    p.add_argument('--repeat', '-n', type=int, default=5,
+            help='number of runs per implementation and corpus (default: %(default)s)')
+    p.add_argument('--time', default='/usr/bin/time',
+            help='measurement program (default: %(default)s)')
+    p.add_argument('--preflight', choices=['off', 'warn', 'refuse'], default='warn',
+            help='check for a noisy system before running (default: %(default)s)')
+    p.add_argument('--csv', metavar='FILE',
+            help='also write the statistics to FILE')
+    p.add_argument('--raw', metavar='FILE',
+            help='append the single measurements to FILE')
+    p.add_argument('--svg', metavar='FILE',
+            help='plot the median wall times to FILE')
+    p.add_argument('--baseline', '-b', default='searchb-baseline.json',
+            help='baseline file (default: %(default)s)')
+    p.add_argument('--update', '-u', action='store_true',
+            help='write the results as new baseline')
+    p.add_argument('--threshold', type=float, default=0.2,
+            help='tolerated relative regression (default: %(default)s)')
+    p.add_argument('--min-delta', type=float, default=0.005, metavar='SECONDS',
+            help='tolerated absolute regression (default: %(default)s)')
+    p.add_argument('--verbose', '-v', action='store_true',
+            help='verbose output')
+    args = p.parse_args(*a)
+    args.sizes = [ (x, parse_size(x)) for x in args.sizes ]
+    args.extra = {}
+    for x in args.impl:
+        name, _, path = x.partition('=')
+        if not path:
+            p.error(f'--impl expects NAME=PATH: {x}')
+        args.extra[name] = os.path.abspath(path)
+    return args
+
+def load_benchmark():
+    s = importlib.util.spec_from_file_location('benchmark',
+            os.path.join(src_dir, 'benchmark.py'))
+    m = importlib.util.module_from_spec(s)
+    s.loader.exec_module(m)
+    return m
+
+# benchmark.py already configures the root logger
+def setup_logging(verbose):
+    for h in logging.getLogger().handlers:
+        h.setLevel(logging.DEBUG if verbose else logging.INFO)
+
+def build(name, out, cmd):
+    log.info(f'Building {name} implementation ...')
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    p = subprocess.run([ x.format(out=out, src=src_dir) for x in cmd ],
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+    if p.returncode != 0:
+        log.warning(f'Building {name} failed: {p.stderr.strip()}')
+
+def find_impls(args):
+    d = {}
+    for name in args.impls:
+        dirname, fn, cmd = impls[name]
+        path = os.path.join(args.build_dir if dirname else src_dir, fn)
+        if not os.access(path, os.X_OK) and args.build and cmd:
+            if shutil.which(cmd[0]):
+                build(name, path, cmd)
+            else:
+                log.warning(f"Can't build {name} implementation: {cmd[0]} not found")
+        if os.access(path, os.X_OK):
+            d[name] = path
+        else:
+            log.warning(f'Skipping {name} implementation: {path} not found')
+    d.update(args.extra)
+    return d
+
+def gen_target(filename, size, seed):
+    if os.path.exists(filename) and os.path.getsize(filename) == size:
+        return
+    log.info(f'Generating {filename} ...')
+    r = random.Random(seed)
+    n = 16 * 1024 * 1024
+    with open(filename + '.tmp', 'wb') as f:
+        for off in range(0, size, n):
+            f.write(r.randbytes(min(n, size - off)))
+    os.rename(filename + '.tmp', filename)
+
+def gen_query(filename, target, size, position, args):
+    off = { 'start': 0, 'middle': (size - args.query_size) // 2,
+            'end': size - args.query_size }.get(position)
+    if off is None:
+        # i.e. a random query that is very unlikely to occur in the target
+        q = random.Random(args.seed - 1).randbytes(args.query_size)
+    else:
+        with open(target, 'rb') as f:
+            f.seek(off)
+            q = f.read(args.query_size)
+    with open(filename, 'wb') as f:
+        f.write(q)
+    return off
+
+# yields (corpus, query, target, expected offset) tuples
+def gen_corpora(args):
+    os.makedirs(args.work_dir, exist_ok=True)
+    for label, size in args.sizes:
+        if size < args.query_size:
+            raise ValueError(f'size {label} is smaller than the query')
+        target = os.path.join(args.work_dir, f'target-{size}-{args.seed}.bin')
+        gen_target(target, size, args.seed + size)
+        for position in args.positions:
+            query = os.path.join(args.work_dir, f'query-{size}-{position}.bin')
+            off = gen_query(query, target, size, position, args)
+            yield f'{label}-{position}', query, target, off
+
+def verify(name, path, query, target, off):
+    p = subprocess.run([ path, query, target ], stdout=subprocess.PIPE,
+            universal_newlines=True)
+    expected = (0, f'{off}\n') if off is not None else (1, '')
+    if (p.returncode, p.stdout) != expected:
+        log.error(f'{name} returned {p.returncode} {p.stdout.strip()!r} instead of'
+                f' {expected[0]} {expected[1].strip()!r} for {query} {target}')
+        return False
+    return True
+
+def measure(bm, names, paths, corpus, query, target, args, preflight):
+    # i.e. the arguments are shared by all commands
+    xs = [ paths[0], query, target ]
+    if paths[1:]:
+        xs += [ '--cmd', *paths[1:] ]
+    xs += [ '--tags', *[ f'{name}/{corpus}' for name in names ],
+            '--cache', *args.cache, '--cache-files', target,
+            '--repeat', str(args.repeat), '--time', args.time,
+            '--preflight', preflight, '--ok-rc', '0', '1' ]
+    bargs = bm.parse_args(xs)
+    if preflight != 'off':
+        bm.preflight(bargs)
+    rxs, errors = bm.execute(bargs)
+    return bargs, rxs, errors
+
+def check(key, median, baseline, args):
+    b = baseline.get(key)
+    if b is None:
+        return 'new'
+    delta = median - b
+    if delta > b * args.threshold and delta > args.min_delta:
+        log.error(f'{key}: median wall time regressed from {b:.3f} s to {median:.3f} s')
+        return 'regression'
+    return 'ok'
+
+def write_table(rs, names, f):
+    print('corpus,cache,' + ','.join(names), file=f)
+    for (corpus, cache), d in rs.items():
+        print(','.join([ corpus, cache ] + [ f'{d[name]:.3f}' if name in d else ''
+            for name in names ]), file=f)
+
+def write_svg(rs, names, filename):
+    import matplotlib.pyplot as plt
+    groups = [ f'{corpus}/{cache}' for corpus, cache in rs ]
+    width = 0.8 / len(names)
+    fig, ax = plt.subplots(figsize=(max(6.4, len(groups) * 0.8), 4.8))
+    for i, name in enumerate(names):
+        ax.bar([ j + i * width for j in range(len(groups)) ],
+                [ d.get(name, 0) for d in rs.values() ], width, label=name)
+    ax.set_xticks([ j + width * (len(names) - 1) / 2 for j in range(len(groups)) ])
+    ax.set_xticklabels(groups, rotation=75)
+    ax.set_xlabel('corpus/cache')
+    ax.set_ylabel('median wall time (s)')
+    ax.set_title('searchb')
+    ax.legend()
+    fig.tight_layout()
+    fig.savefig(filename)
+
+def main(*a):
+    args = parse_args(*a)
+    bm = load_benchmark()
+    setup_logging(args.verbose)
+    try:
+        return run(bm, args)
+    except bm.PreflightError as e:
+        log.error(e)
+        return 1
+
+def run(bm, args):
+    ps = find_impls(args)
+    if not ps:
+        log.error('No implementation found')
+        return 1
+    baseline = {}
+    if not args.update and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['medians']
+    failures = 0
+    xs = []
+    # (corpus, cache) -> name -> median wall time
+    rs = {}
+    bargs = None
+    for corpus, query, target, off in gen_corpora(args):
+        names = [ name for name, path in ps.items()
+                  if verify(name, path, query, target, off) ]
+        failures += len(ps) - len(names)
+        if not names:
+            continue
+        log.info(f'Measuring {corpus} ...')
+        bargs, rxs, errors = measure(bm, names, [ ps[name] for name in names ],
+                corpus, query, target, args,
+                'off' if bargs else args.preflight)
+        failures += errors
+        xs.extend(rxs)
+        for tag, rows in rxs:
+            name, _, cache = tag.split('/')
+            s = bm.gen_stats(bm.get_items(rows, bargs), bargs)
+            rs.setdefault((corpus, cache), {})[name] = s.median
+    if not xs:
+        return 1
+    zs = [ (tag, bm.gen_stats(bm.get_items(rows, bargs), bargs)) for tag, rows in xs ]
+    bm.write_csv(zs, bargs, sys.stdout)
+    if args.csv:
+        with open(args.csv, 'w') as f:
+            bm.write_csv(zs, bargs, f)
+    if args.raw:
+        bm.write_raw(xs, bargs, args.raw)
+    names = list(ps)
+    print()
+    write_table(rs, names, sys.stdout)
+    if args.svg:
+        write_svg(rs, names, args.svg)
+    medians = { f'{name}/{corpus}/{cache}': m
+                for (corpus, cache), d in rs.items() for name, m in d.items() }
+    regressions = sum(check(k, v, baseline, args) == 'regression'
+                      for k, v in medians.items())
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump({ 'medians': medians }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        log.info(f'Wrote baseline to {args.baseline}')
+    return int(failures > 0 or regressions > 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# Measure the start-up time and import costs of the Python scripts
+# of this repository and detect regressions against a baseline.
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+
+log = logging.getLogger(__name__)
+
+# i.e. for scripts that don't support --help: just execute their module
+# level code, but not the __main__ part
+import_code = '''import importlib.util, sys
+s = importlib.util.spec_from_file_location('startup_probe', sys.argv[1])
+m = importlib.util.module_from_spec(s)
+s.loader.exec_module(m)'''
+
+main_guard_re = re.compile(r'''^if\s+__name__\s*==\s*['"]__main__['"]''', re.M)
+
+def parse_args(*a):
+    p = argparse.ArgumentParser(
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            description='Measure start-up time and import costs of Python scripts',
+            epilog='''
+Scripts that support `--help` (i.e. that use argparse or check for
+`--help` themselves) are started with `--help`, all others are just
+imported such that their main code isn't executed. Scripts without
+such a `__main__` guard are skipped (unless allowed with `--allow-exec`)
+since importing them would execute their main code.
+
+For each script the median wall time of the start-up and the
+cumulative import time (as reported by `python -X importtime`,
+without the imports the bare interpreter does anyway) are measured.
+
+Examples:
+
+Record a baseline:
+
+    bench-startup --update
+
+Check all scripts against the baseline and list the 3 most expensive
+imports of each script:
+
+    bench-startup --top 3
+
+Exit status is 1 if the start-up time of a script regressed beyond
+the threshold or if a script failed (unless allowed with
+`--allow-failure`, e.g. due to a missing optional dependency). Failed
+scripts aren't recorded in the baseline.
+
+'''
+            )
+    p.add_argument('scripts', metavar='SCRIPT', nargs='*',
+            help='scripts to measure (default: all Python scripts in the repository)')
+    p.add_argument('--baseline', '-b', default='startup-baseline.json',
+            help='baseline file (default: %(default)s)')
+    p.add_argument('--update', '-u', action='store_true',
+            help='write the results as new baseline')
+    p.add_argument('--repeat', '-n', type=int, default=10,
+            help='number of start-ups per script (default: %(default)s)')
+    p.add_argument('--threshold', type=float, default=0.2,
+            help='tolerated relative regression (default: %(default)s)')
+    p.add_argument('--min-delta', type=float, default=0.005, metavar='SECONDS',
+            help='tolerated absolute regression (default: %(default)s)')
+    p.add_argument('--top', type=int, default=0, metavar='N',
+            help='list the N most expensive imports of each script')
+    p.add_argument('--allow-failure', action='append', default=[], metavar='SCRIPT',
+            help="don't fail if SCRIPT (file name) exits with a non-zero status")
+    p.add_argument('--allow-exec', action='append', default=[], metavar='SCRIPT',
+            help='also import SCRIPT (file name) if it lacks a __main__ guard')
+    p.add_argument('--python', default=sys.executable,
+            help='interpreter to use (default: %(default)s)')
+    p.add_argument('--verbose', '-v', action='store_true',
+            help='verbose output')
+    args = p.parse_args(*a)
+    if not args.scripts:
+        args.scripts = find_scripts(os.path.dirname(os.path.abspath(__file__)))
+    return args
+
+def setup_logging(verbose):
+    log_format      = '%(asctime)s - %(levelname)-8s - %(message)s [%(name)s]'
+    log_date_format = '%Y-%m-%d %H:%M:%S'
+
+    logging.basicConfig(format=log_format, datefmt=log_date_format,
+        level=(logging.DEBUG if verbose else logging.INFO) )
+
+def find_scripts(dirname):
+    xs = []
+    for fn in sorted(os.listdir(dirname)):
+        if not fn.endswith('.py'):
+            continue
+        filename = os.path.join(dirname, fn)
+        with open(filename) as f:
+            if 'python' not in f.readline():
+                continue # e.g. drgn scripts
+        xs.append(filename)
+    return xs
+
+def supports_help(filename):
+    with open(filename) as f:
+        s = f.read()
+    return 'argparse' in s or "'--help'" in s
+
+def has_main_guard(filename):
+    with open(filename) as f:
+        return main_guard_re.search(f.read()) is not None
+
+def mk_argv(python, filename, importtime=False):
+    a = [ python ]
+    if importtime:
+        a += [ '-X', 'importtime' ]
+    if supports_help(filename):
+        return a + [ filename, '--help' ]
+    else:
+        return a + [ '-c', import_code, filename ]
+
+# returns the top-level imports, i.e. module -> cumulative time in seconds
+def parse_importtime(s):
+    d = {}
+    for line in s.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        xs = line.split('|')
+        if len(xs) != 3 or not xs[1].strip().isdigit():
+            continue # e.g. the header
+        name = xs[2]
+        # nested imports are indented further
+        if name[1:2] == ' ':
+            continue
+        d[name.strip()] = int(xs[1]) / 10**6
+    return d
+
+def get_imports(argv):
+    p = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True)
+    return parse_importtime(p.stderr)
+
+def time_startup(argv, n):
+    # warm up, e.g. to create .pyc files
+    p = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ts = []
+    for _ in range(n):
+        start = time.perf_counter()
+        subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        ts.append(time.perf_counter() - start)
+    return p.returncode, statistics.median(ts)
+
+# bare: imports of the interpreter itself, with and without --help support
+def measure(filename, bare, args):
+    bare = bare[supports_help(filename)]
+    rc, wall = time_startup(mk_argv(args.python, filename), args.repeat)
+    imports = { k: v for k, v in
+            get_imports(mk_argv(args.python, filename, True)).items()
+            if k not in bare }
+    return { 'rc': rc, 'wall': wall, 'import': sum(imports.values()),
+            'top': sorted(imports.items(), key=lambda x: x[1], reverse=True)[:args.top] }
+
+def check(name, r, baseline, args):
+    b = baseline.get(name)
+    if not b:
+        return 'new'
+    delta = r['wall'] - b['wall']
+    if delta > b['wall'] * args.threshold and delta > args.min_delta:
+        log.error(f'{name}: start-up regressed from {b["wall"]:.3f} s to {r["wall"]:.3f} s')
+        return 'regression'
+    return 'ok'
+
+def main(*a):
+    args = parse_args(*a)
+    setup_logging(args.verbose)
+    baseline = {}
+    if not args.update and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['scripts']
+    bare = {
+            True:  get_imports([ args.python, '-X', 'importtime', '-c', 'pass' ]),
+            False: get_imports([ args.python, '-X', 'importtime', '-c',
+                'import importlib.util' ]) }
+    _, bare_wall = time_startup([ args.python, '-c', 'pass' ], args.repeat)
+    print(f'# interpreter start-up: {bare_wall:.3f} s')
+    print('script,rc,wall,import,baseline,status' + (',top' if args.top else ''))
+    rs = {}
+    regressions = 0
+    failures = 0
+    for filename in args.scripts:
+        name = os.path.basename(filename)
+        b = baseline.get(name, {}).get('wall')
+        if not supports_help(filename) and not has_main_guard(filename) \
+                and name not in args.allow_exec:
+            log.warning(f'Skipping {filename} since it lacks a __main__ guard (cf. --allow-exec)')
+            print(','.join([ name, '', '', '', '' if b is None else f'{b:.3f}', 'skipped' ]))
+            continue
+        log.debug(f'Measuring {filename} ...')
+        r = measure(filename, bare, args)
+        if r['rc'] != 0:
+            if name in args.allow_failure:
+                log.warning(f'{filename} failed with exit status {r["rc"]}')
+                status = 'allowed-failure'
+            else:
+                log.error(f'{filename} failed with exit status {r["rc"]} (missing dependency? cf. --allow-failure)')
+                status = 'failed'
+                failures += 1
+        else:
+            rs[name] = { 'wall': r['wall'], 'import': r['import'] }
+            status = check(name, r, baseline, args)
+            regressions += status == 'regression'
+        xs = [ name, str(r['rc']), f'{r["wall"]:.3f}', f'{r["import"]:.3f}',
+                '' if b is None else f'{b:.3f}', status ]
+        if args.top:
+            xs.append(' '.join(f'{k}:{v:.3f}' for k, v in r['top']))
+        print(','.join(xs))
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump({ 'python': sys.version.split()[0], 'scripts': rs }, f,
+                    indent=2, sort_keys=True)
+            f.write('\n')
+        log.info(f'Wrote baseline to {args.baseline}')
+    return int(regressions > 0 or failures > 0)
+
+if __name__ == '__main__':
+    sys.exit(main())
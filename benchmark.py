@@ -4,8 +4,14 @@
 
 import argparse
 import collections
+import concurrent.futures
 import csv
 import datetime
+import errno
+import gc
+import gzip
+import importlib
+import importlib.util
 import itertools
 import logging
 # importing it conditionally iff svg generation is selected
@@ -16,9 +22,12 @@ import logging
 # importing it conditionally iff csv or not quiet
 #import numpy as np
 import os
+import resource
+import statistics
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 try:
@@ -39,6 +48,13 @@ data to a file:
     $ benchmark --cmd ./find_memchr ./find_find --raw raw.dat -n 20 \\
         ./find_unroll2 3000 in
 
+Count cache and TLB misses with `perf stat` (this yields items like
+cache_mis_rate and dtlb_mis_rate, where events that don't fit into the
+PMU counters are distributed over multiple runs of each repetition):
+
+    $ benchmark --pstat --events default,cache,tlb --graph-item ins_cyc \\
+        -n 20 ./find_memchr 3000 in
+
 Create boxplot SVG (and nicely format the stdout and also write
 the stats to a CSV file):
 
@@ -50,6 +66,57 @@ has its usual meaning (also explicitly specifiying a tag):
 
     $ benchmark --tags mode2 -n 1000 -- ./find_unroll2 --mode 2
 
+Pin the child to CPUs 2 and 3 and refuse to run if the system is
+noisy (i.e. high load, non-performance governor, turbo or ASLR enabled):
+
+    $ benchmark --cpus 2-3 --preflight refuse -n 20 ./find_memchr 3000 in
+
+The raw data also records the governor, turbo state, ASLR setting,
+load average and CPU set of each run.
+
+Account the whole process tree of a pipeline via cgroup v2 (i.e. in
+addition to the GNU time items of the direct child):
+
+    $ benchmark --cgroup -n 10 -- sh -c 'zstd -dc big.zst | wc -l'
+
+The cgroup items are appended after the items of the measurement
+program: cg_usage, cg_user, cg_sys (seconds), cg_mem (peak KiB),
+cg_rbytes, cg_wbytes and the cg_cpu_some, cg_mem_some, cg_io_some
+pressure stall totals (seconds). Note that the parent cgroup must be
+writable, e.g. when running inside
+`systemd-run --user --scope -p Delegate=yes`.
+
+Benchmark a Python function in-process (i.e. without paying the
+process start-up for each call), where the arguments are passed as
+strings and the items are per-call times in microseconds (wall_us,
+user_us, sys_us):
+
+    $ benchmark --callable -n 20 --no-gc -- user-installed.py:LooseVersion 1.2.4-rc3
+
+See also bench_callables() for benchmarking callables from Python code.
+
+Compare a cold page cache with a warm one (the tags are suffixed with
+/cold and /warm). In cold mode the input files are evicted via
+posix_fadvise() - or, when running as root, the complete page cache
+is dropped:
+
+    $ benchmark --cache cold warm --cmd ./searchb ./searchb.py -n 10 \\
+        -- pattern.bin disk.img
+
+Sample the memory and CPU usage of the child process tree 100 times
+per second, store the samples and plot them over time (the table
+on stdout is extended with the median peak RSS and time-to-peak):
+
+    $ benchmark --sample 100 --samples s.csv.gz --sample-svg \\
+        --cmd ./find_memchr ./find_find -n 5 -- 3000 in
+
+Measure how a command scales when 1, 2, 4 and 8 copies run at
+once (the per-instance latencies are reported under the tags
+lockf/k1, lockf/k2, etc.):
+
+    $ benchmark --concurrency 1,2,4,8 -n 10 --scaling-svg \\
+        -- ./lockf /tmp/lock sleep 0.1
+
 # 2016, Georg Sauthoff <mail@georg.so>, GPLv3+
 '''
       )
@@ -58,28 +125,82 @@ has its usual meaning (also explicitly specifiying a tag):
       help='extra commands to run')
   p.add_argument('--cols', nargs='+', default=[1,2,3,4],
       help='columns to generate stats for')
+  p.add_argument('--concurrency', metavar='K1,K2,..',
+      help='run K simultaneous copies of each command and report the'
+           ' throughput scaling relative to K=1')
+  p.add_argument('--cache', nargs='+', choices=['cold', 'warm'],
+      help='evict (cold) or pre-read (warm) the input files before each'
+           ' run, with both modes each command is run in both')
+  p.add_argument('--callable', action='store_true',
+      help='commands are Python callables (MODULE:FUNCTION) that are'
+           ' benchmarked in-process, with the arguments as strings')
+  p.add_argument('--cache-files', nargs='+', metavar='FILE',
+      help='input files for --cache (default: the child arguments that'
+           ' are regular files)')
+  p.add_argument('--cgroup', nargs='?', metavar='DIR', const='',
+      help='run each repetition in a transient cgroup v2 (below DIR,'
+           ' default: the current cgroup) and add whole process tree'
+           ' CPU, memory, I/O and pressure items')
+  p.add_argument('--cpus', metavar='LIST',
+      help='pin the child (and benchmark itself) to a CPU set via'
+           ' sched_setaffinity, e.g. 2,3 or 2-3')
   p.add_argument('--csv', nargs='?', const='benchmark.csv',
       help='also write results as csv')
   p.add_argument('--debug', nargs='?', metavar='FILE',
       const='benchmark.log', help='log debug messages into file')
+  p.add_argument('--events', metavar='GROUP|EVENT,..', default='default',
+      help='--pstat event groups ({}) and/or raw perf events'
+           ' (default: %(default)s)'.format(', '.join(perf_groups)))
   p.add_argument('--graph-item', help='item to plot in a graph')
   p.add_argument('--height', type=float, help='height of the graph (inch)')
   p.add_argument('--input', '-i', metavar='FILE',
       help='include raw data from a previous run')
   p.add_argument('--items', nargs='+', default=['wall', 'user', 'sys', 'rss'],
       help='names for the selected columns')
+  p.add_argument('--loops', type=int,
+      help='--callable: number of calls per measurement (default: calibrate)')
+  p.add_argument('--max-load', type=float, default=1.0,
+      help='preflight: maximal tolerated 1 minute load average (default: %(default)s)')
+  p.add_argument('--min-time', type=float, default=0.2, metavar='SECONDS',
+      help='--callable: minimal duration of a measurement when calibrating'
+           ' the number of calls (default: %(default)s)')
+  p.add_argument('--no-gc', action='store_true',
+      help='--callable: disable the garbage collector while timing')
   p.add_argument('--null-out', type=bool, default=True,
       help='redirect stdout to /dev/null')
+  p.add_argument('--ok-rc', nargs='+', type=int, default=[0], metavar='RC',
+      help='exit statuses of the child that count as success, e.g. 0 1'
+           ' for a search that may not find anything (default: 0)')
+  p.add_argument('--pmu-counters', type=int, default=4,
+      help='--pstat: number of hardware counters, more events are'
+           ' multiplexed over multiple runs of the child (default: %(default)s)')
   p.add_argument('--pstat', action=InitPstat,
-      help='set options for `perf stat` instead of GNU time')
+      help='measure with `perf stat` instead of GNU time')
   p.add_argument('--precision', type=int, default=3,
       help='precision for printing values')
+  p.add_argument('--preflight', choices=['off', 'warn', 'refuse'],
+      default='off',
+      help='check for a noisy system (load, governor, turbo, ASLR) before'
+           ' running and warn or refuse to run (default: %(default)s)')
   p.add_argument('--quiet', '-q', action='store_true', default=False,
       help='avoid printing table to stdout')
   p.add_argument('--raw', nargs='?', metavar='FILE', const='data.csv',
       help='write measurement results to file')
   p.add_argument('--repeat', '-n', type=int, default=2,
       help='number of times to repeat the measurement')
+  p.add_argument('--sample', type=float, metavar='HZ',
+      help='sample RSS and CPU time of the child process tree with HZ')
+  p.add_argument('--sample-input', metavar='FILE',
+      help='include samples from a previous run')
+  p.add_argument('--sample-svg', nargs='?', const='samples.svg',
+      help='plot memory and CPU usage over time')
+  p.add_argument('--samples', nargs='?', metavar='FILE',
+      const='samples.csv.gz',
+      help='write the samples to file (gzip compressed iff FILE ends in .gz)')
+  p.add_argument('--scaling-csv', nargs='?', const='scaling.csv',
+      help='write the --concurrency throughput scaling as csv')
+  p.add_argument('--scaling-svg', nargs='?', const='scaling.svg',
+      help='plot the --concurrency speedup and efficiency curves')
   p.add_argument('--sleep', type=float, default=0.0, metavar='SECONDS',
       help='sleep between runs')
   p.add_argument('--svg', nargs='?', const='benchmark.svg',
@@ -89,7 +210,8 @@ has its usual meaning (also explicitly specifiying a tag):
   p.add_argument('--time', default='/usr/bin/time',
       help='measurement program (default: GNU time)')
   p.add_argument('--time-args', nargs='+',
-      default=[ '--append', '--format', '%e,%U,%S,%M', '--output', '$<' ],
+      default=[ '--quiet', '--append', '--format', '%e,%U,%S,%M', '--output',
+                '$<' ],
       help='default arguments to measurement program')
   p.add_argument('--timeout', help='timeout for waiting on a child')
   p.add_argument('--title', help='title of the graph')
@@ -109,39 +231,95 @@ class InitPstat(argparse.Action):
     super(InitPstat, self).__init__(
       option_strings, dest, nargs=0, **kwargs)
 
+  # the items, columns and the default graph item are set in
+  # parse_args() since they depend on the selected events
   def __call__(self, parser, args, values, option_string=None):
-    args.time = 'perfstat.sh'
-    args.time_args = [ '-o', '$<' ]
-    args.cols = list(range(1,12))
-    args.items = [ 'nsec','cswitch','cpu_migr','page_fault','cycles','ghz','ins','ins_cyc','br','br_mis','br_mis_rate' ]
-    if not args.graph_item:
-      args.graph_item = 'ins_cyc'
-    args.title = 'Counter ({})'.format(args.graph_item)
+    args.pstat = True
+    args.time = 'perf'
     args.ylabel = 'rate'
 
-def parse_args(xs = None):
+# fs: optional list of (tag, callable) pairs, cf. bench_callables()
+def parse_args(xs = None, fs = None):
   arg_parser = mk_arg_parser()
   if xs or xs == []:
     args = arg_parser.parse_args(xs)
   else:
     args = arg_parser.parse_args()
-  if not args.argv and not args.input:
+  if not args.argv and not args.input and not fs:
     raise ValueError('Neither cmd+args nor --input option present')
   if args.debug:
     setup_file_logging(args.debug)
-  if args.argv:
+  # i.e. with fs, all the positional arguments are passed to the callables
+  if args.argv and not fs:
     args.cmd = [ args.argv[0] ] + args.cmd
     args.argv = args.argv[1:]
+  if fs:
+    args.callable = True
+    args.cmd = [ tag for (tag, _) in fs ] + args.cmd
+  if args.callable:
+    if args.pstat or args.cgroup is not None or args.sample \
+        or args.concurrency:
+      raise ValueError('--callable is incompatible with --pstat, --cgroup,'
+          ' --sample and --concurrency')
+    args.callables = dict(fs or [])
+    for spec in args.cmd:
+      if spec not in args.callables:
+        args.callables[spec] = load_callable(spec)
+    # i.e. per-call times in seconds would just print as 0.000
+    args.items = ['wall_us', 'user_us', 'sys_us', 'rss']
+    args.cols = [1, 2, 3, 4]
+    if args.ylabel == 'time (s)':
+      args.ylabel = 'time per call (µs)'
   args.cols = [ int(x) for x in args.cols ]
-  if args.tags and args.tag.__len__() != args.cmd.__len__():
+  args.derived = []
+  if args.pstat:
+    setup_perf_events(args)
+    if not args.graph_item:
+      if 'ins_cyc' in args.derived:
+        args.graph_item = 'ins_cyc'
+      else:
+        args.graph_item = (args.derived + args.items)[0]
+    if not args.title:
+      args.title = 'Counter ({})'.format(args.graph_item)
+  if args.cgroup is not None:
+    # i.e. the cgroup values follow the columns of the measurement program
+    n = args.items.__len__()
+    args.items = args.items + cgroup_items
+    args.cols = args.cols + list(range(n + 1, n + 1 + cgroup_items.__len__()))
+  if args.concurrency:
+    ks = set(int(x) for x in args.concurrency.split(','))
+    if min(ks) < 1:
+      raise ValueError('concurrency must be positive')
+    # speedup and efficiency are relative to a single instance
+    ks.add(1)
+    args.concurrency = sorted(ks)
+  if args.cpus:
+    args.cpu_set = parse_cpu_list(args.cpus)
+  else:
+    args.cpu_set = None
+  if args.tags and args.tags.__len__() != args.cmd.__len__():
     raise ValueError('not enough tags specified')
   if not args.tags:
     args.tags = [ os.path.basename(x) for x in args.cmd ]
+  if args.cache:
+    if args.cache_files is None:
+      args.cache_files = [ x for x in args.argv if os.path.isfile(x) ]
+    if not args.cache_files:
+      log.warning('No input files for --cache found')
+    args.cache_modes = [ m for _ in args.cmd for m in args.cache ]
+    args.tags = [ '{}/{}'.format(t, m) for t in args.tags for m in args.cache ]
+    args.cmd = [ c for c in args.cmd for _ in args.cache ]
+  else:
+    args.cache_modes = [ '' for _ in args.cmd ]
   if not args.graph_item:
     args.graph_item = args.items[0]
   if not args.title:
     args.title = 'Runtime ({})'.format(args.graph_item)
-  if args.svg:
+  args.sample_runs = []
+  args.sample_counter = collections.defaultdict(itertools.count)
+  # i.e. the calibrated number of calls per callable
+  args.calls = {}
+  if args.svg or args.scaling_svg or args.sample_svg:
     #import matplotlib.pyplot as plt
     global matplotlib
     global plt
@@ -182,7 +360,7 @@ def mk_logger():
   if os.isatty(2):
     ch.setFormatter(cf)
   else:
-    ch.setFormatter(f)
+    ch.setFormatter(mk_formatter())
   log.addHandler(ch)
 
   return logging.getLogger(__name__)
@@ -197,6 +375,455 @@ def setup_file_logging(filename):
   fh.setFormatter(f)
   log.addHandler(fh)
 
+def parse_cpu_list(s):
+  cpus = set()
+  for x in s.split(','):
+    if '-' in x:
+      a, b = x.split('-', 1)
+      cpus.update(range(int(a), int(b) + 1))
+    else:
+      cpus.add(int(x))
+  return cpus
+
+def read_sys(filename):
+  try:
+    with open(filename) as f:
+      return f.read().strip()
+  except OSError:
+    return ''
+
+def get_governor(cpus):
+  gs = set(read_sys(
+      '/sys/devices/system/cpu/cpu{}/cpufreq/scaling_governor'.format(c))
+      for c in cpus)
+  gs.discard('')
+  return '/'.join(sorted(gs))
+
+def get_turbo():
+  v = read_sys('/sys/devices/system/cpu/intel_pstate/no_turbo')
+  if v:
+    return 'off' if v == '1' else 'on'
+  # e.g. acpi-cpufreq on AMD
+  v = read_sys('/sys/devices/system/cpu/cpufreq/boost')
+  if v:
+    return 'on' if v == '1' else 'off'
+  return ''
+
+# appended to each raw data row, after the fixed date,rc,cmd,args columns
+env_fields = ['governor', 'turbo', 'aslr', 'load', 'cpus', 'cache']
+
+def get_env(args):
+  cpus = args.cpu_set or os.sched_getaffinity(0)
+  return [ get_governor(cpus), get_turbo(),
+      read_sys('/proc/sys/kernel/randomize_va_space'),
+      '{:.2f}'.format(os.getloadavg()[0]),
+      args.cpus or '' ]
+
+class PreflightError(Exception):
+  pass
+
+def preflight(args):
+  if args.preflight == 'off':
+    return
+  governor, turbo, aslr, load, _ = get_env(args)
+  issues = []
+  if float(load) > args.max_load:
+    issues.append('load average {} is above {}'.format(load, args.max_load))
+  if governor and governor != 'performance':
+    issues.append('cpufreq governor is {} (instead of performance)'
+        .format(governor))
+  if turbo == 'on':
+    issues.append('turbo boost is enabled')
+  if aslr not in ('', '0'):
+    issues.append('ASLR is enabled (randomize_va_space={})'.format(aslr))
+  if args.cpu_set:
+    isolated = read_sys('/sys/devices/system/cpu/isolated')
+    if not args.cpu_set <= (parse_cpu_list(isolated) if isolated else set()):
+      issues.append('CPUs {} are not isolated (cf. isolcpus=)'
+          .format(args.cpus))
+  for issue in issues:
+    if args.preflight == 'refuse':
+      log.error('Preflight: {}'.format(issue))
+    else:
+      log.warning('Preflight: {}'.format(issue))
+  if issues and args.preflight == 'refuse':
+    raise PreflightError('Refusing to run on a noisy system (cf. --preflight)')
+
+# event -> item, the default group keeps the names of perfstat.sh
+perf_groups = {
+    'default': [ ('task-clock', 'nsec'), ('context-switches', 'cswitch'),
+      ('cpu-migrations', 'cpu_migr'), ('page-faults', 'page_fault'),
+      ('cycles', 'cycles'), ('instructions', 'ins'), ('branches', 'br'),
+      ('branch-misses', 'br_mis') ],
+    'cache': [ ('cache-references', 'cache_ref'),
+      ('cache-misses', 'cache_mis'), ('L1-dcache-loads', 'l1d_ld'),
+      ('L1-dcache-load-misses', 'l1d_ld_mis'), ('LLC-loads', 'llc_ld'),
+      ('LLC-load-misses', 'llc_ld_mis') ],
+    'tlb': [ ('dTLB-loads', 'dtlb_ld'), ('dTLB-load-misses', 'dtlb_ld_mis'),
+      ('iTLB-loads', 'itlb_ld'), ('iTLB-load-misses', 'itlb_ld_mis') ],
+    'topdown': [ ('topdown-total-slots', 'td_slots'),
+      ('topdown-slots-issued', 'td_issued'),
+      ('topdown-slots-retired', 'td_retired'),
+      ('topdown-fetch-bubbles', 'td_fetch_bub'),
+      ('topdown-recovery-bubbles', 'td_recovery_bub') ]
+    }
+
+# don't occupy PMU counters
+perf_sw_events = { 'task-clock', 'cpu-clock', 'context-switches',
+    'cpu-migrations', 'page-faults', 'minor-faults', 'major-faults' }
+
+# item, inputs, function - evaluated on whole numpy columns
+perf_derived = [
+    ('ghz', ('cycles', 'nsec'), lambda c, n: c / n),
+    ('ins_cyc', ('ins', 'cycles'), lambda i, c: i / c),
+    ('br_mis_rate', ('br_mis', 'br'), lambda m, b: m / b * 100.0),
+    ('cache_mis_rate', ('cache_mis', 'cache_ref'), lambda m, r: m / r * 100.0),
+    ('l1d_mis_rate', ('l1d_ld_mis', 'l1d_ld'), lambda m, l: m / l * 100.0),
+    ('llc_mis_rate', ('llc_ld_mis', 'llc_ld'), lambda m, l: m / l * 100.0),
+    ('dtlb_mis_rate', ('dtlb_ld_mis', 'dtlb_ld'), lambda m, l: m / l * 100.0),
+    ('itlb_mis_rate', ('itlb_ld_mis', 'itlb_ld'), lambda m, l: m / l * 100.0),
+    ('td_frontend', ('td_fetch_bub', 'td_slots'), lambda f, s: f / s),
+    ('td_bad_spec', ('td_issued', 'td_retired', 'td_recovery_bub', 'td_slots'),
+      lambda i, r, b, s: (i - r + b) / s),
+    ('td_retiring', ('td_retired', 'td_slots'), lambda r, s: r / s),
+    ('td_backend', ('td_fetch_bub', 'td_issued', 'td_recovery_bub',
+      'td_slots'), lambda f, i, b, s: 1 - (f + i + b) / s)
+    ]
+
+def setup_perf_events(args):
+  es = []
+  for x in args.events.split(','):
+    if x in perf_groups:
+      es.extend(perf_groups[x])
+    else:
+      es.append( (x, x.replace('-', '_').replace(':', '_')) )
+  args.perf_events = [ e for (e, _) in es ]
+  args.items = [ i for (_, i) in es ]
+  args.cols = list(range(1, es.__len__() + 1))
+  args.derived = [ d for (d, xs, _) in perf_derived
+                   if all(x in args.items for x in xs) ]
+  # i.e. multiplex over runs instead of letting the kernel
+  # multiplex during a run
+  chunks = [ [] ]
+  n = 0
+  for e in args.perf_events:
+    if e in perf_sw_events:
+      chunks[0].append(e)
+      continue
+    if n == args.pmu_counters:
+      chunks.append([])
+      n = 0
+    chunks[-1].append(e)
+    n = n + 1
+  args.event_chunks = chunks
+  log.debug('Perf event chunks: {}'.format(chunks))
+
+# cf. the CSV output format section in perf-stat(1)
+def read_perf(f, args):
+  d = {}
+  for row in csv.reader(f):
+    if not row or row[0].startswith('#') or row.__len__() < 3:
+      continue
+    v, unit, event = row[:3]
+    if row.__len__() > 4 and row[4] and float(row[4]) < 100.0:
+      log.warning('Event {} was multiplexed ({}% running), consider'
+          ' lowering --pmu-counters'.format(event, row[4]))
+    if v.startswith('<'):
+      v = '' # i.e. <not counted>/<not supported>
+    elif unit == 'msec':
+      v = float(v) * 10**6
+    d[event] = v
+  if not d:
+    raise StopIteration()
+  r = []
+  for e in args.perf_events:
+    # e.g. perf might print cycles:u
+    k = e if e in d else next((x for x in d if x.split(':')[0] == e), None)
+    r.append(d.get(k, ''))
+  return r
+
+def derive_items(m, args):
+  with np.errstate(divide='ignore', invalid='ignore'):
+    for (d, xs, f) in perf_derived:
+      if d in args.derived:
+        m[d] = f(*(m[x] for x in xs))
+
+cgroup_items = [ 'cg_usage', 'cg_user', 'cg_sys', 'cg_mem', 'cg_rbytes',
+    'cg_wbytes', 'cg_cpu_some', 'cg_mem_some', 'cg_io_some' ]
+
+cgroup_counter = itertools.count()
+
+def get_cgroup2_mount():
+  with open('/proc/self/mounts') as f:
+    for line in f:
+      xs = line.split()
+      if xs[2] == 'cgroup2':
+        return xs[1]
+  raise RuntimeError('No cgroup v2 hierarchy mounted')
+
+def setup_cgroup(args):
+  args.cgroup_leaf = None
+  if args.cgroup:
+    parent = args.cgroup
+  else:
+    with open('/proc/self/cgroup') as f:
+      path = [ line[3:].strip() for line in f if line.startswith('0::') ][0]
+    parent = get_cgroup2_mount() + path
+  with open(parent + '/cgroup.controllers') as f:
+    available = set(f.read().split())
+  cs = ' '.join('+' + c for c in ('cpu', 'memory', 'io') if c in available)
+  try:
+    with open(parent + '/cgroup.subtree_control', 'w') as f:
+      f.write(cs)
+  except OSError as e:
+    if e.errno != errno.EBUSY:
+      raise
+    # no internal process constraint, thus we have to move ourselves
+    # into a leaf first, e.g. when running in a delegated scope
+    leaf = '{}/benchmark-{}'.format(parent, os.getpid())
+    os.mkdir(leaf)
+    with open(leaf + '/cgroup.procs', 'w') as f:
+      f.write('0')
+    with open(parent + '/cgroup.subtree_control', 'w') as f:
+      f.write(cs)
+    args.cgroup_leaf = leaf
+  log.debug('Using cgroup parent {} with {}'.format(parent, cs))
+  args.cgroup = parent
+  args.cgroup_controllers = cs
+
+# i.e. undo the move into the leaf, which requires disabling the
+# controllers of the parent again
+def teardown_cgroup(args):
+  leaf = args.cgroup_leaf
+  if not leaf:
+    return
+  try:
+    with open(args.cgroup + '/cgroup.subtree_control', 'w') as f:
+      f.write(args.cgroup_controllers.replace('+', '-'))
+    with open(args.cgroup + '/cgroup.procs', 'w') as f:
+      f.write('0')
+    os.rmdir(leaf)
+  except OSError as e:
+    # e.g. EBUSY when another benchmark is using the controllers
+    log.warning("Couldn't remove cgroup {}: {}".format(leaf, e))
+
+# i.e. the child moves itself into the cgroup before it execs the
+# measurement program (a preexec_fn isn't safe with the threads
+# of --concurrency)
+def cgroup_exec(cgroup):
+  return [ '/bin/sh', '-c', 'echo 0 > "$0/cgroup.procs" && exec "$@"', cgroup ]
+
+def mk_cgroup(args):
+  cgroup = '{}/benchmark-{}-{}'.format(args.cgroup, os.getpid(),
+      next(cgroup_counter))
+  os.mkdir(cgroup)
+  return cgroup
+
+def read_keyed(filename, key=None):
+  d = {}
+  for line in read_sys(filename).splitlines():
+    xs = line.split()
+    if key:
+      if xs[0] == key:
+        d.update(x.split('=', 1) for x in xs[1:])
+    else:
+      d[xs[0]] = xs[1]
+  return d
+
+def read_cgroup(cgroup):
+  cpu = read_keyed(cgroup + '/cpu.stat')
+  peak = read_sys(cgroup + '/memory.peak')
+  rbytes = 0
+  wbytes = 0
+  for line in read_sys(cgroup + '/io.stat').splitlines():
+    d = dict(x.split('=', 1) for x in line.split()[1:])
+    rbytes = rbytes + int(d.get('rbytes', 0))
+    wbytes = wbytes + int(d.get('wbytes', 0))
+  r = [ int(cpu[k]) / 10**6 if k in cpu else ''
+        for k in ('usage_usec', 'user_usec', 'system_usec') ]
+  r.append(int(peak) // 1024 if peak else '')
+  r.extend([rbytes, wbytes])
+  for c in ('cpu', 'memory', 'io'):
+    d = read_keyed('{}/{}.pressure'.format(cgroup, c), 'some')
+    r.append(int(d['total']) / 10**6 if 'total' in d else '')
+  return r
+
+def rm_cgroup(cgroup):
+  try:
+    os.rmdir(cgroup)
+  except OSError as e:
+    if e.errno != errno.EBUSY:
+      raise
+    # i.e. some daemonized descendant is still running
+    log.warning('Killing leftover processes in {}'.format(cgroup))
+    with open(cgroup + '/cgroup.kill', 'w') as f:
+      f.write('1')
+    for i in range(100):
+      try:
+        os.rmdir(cgroup)
+        break
+      except OSError:
+        time.sleep(0.01)
+
+page_size = os.sysconf('SC_PAGE_SIZE')
+clock_ticks = os.sysconf('SC_CLK_TCK')
+
+def get_children(pid):
+  cs = []
+  try:
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+      cs.extend(int(x) for x in
+          read_sys('/proc/{}/task/{}/children'.format(pid, tid)).split())
+  except OSError:
+    pass # i.e. exited in the meantime
+  return cs
+
+# returns RSS (KiB) and CPU time (ms) of all descendants of pid,
+# where the CPU time includes already reaped descendants, i.e.
+# it's monotonic
+def sample_tree(pid):
+  rss = 0
+  ticks = 0
+  stack = get_children(pid)
+  while stack:
+    p = stack.pop()
+    s = read_sys('/proc/{}/stat'.format(p))
+    if not s:
+      continue
+    # comm might contain spaces, thus start after it, i.e. xs[0] is field 3
+    xs = s[s.rindex(')') + 2:].split()
+    # utime, stime, cutime, cstime
+    ticks = ticks + sum(int(x) for x in xs[11:15])
+    rss = rss + int(xs[21]) * page_size // 1024
+    stack.extend(get_children(p))
+  return (rss, ticks * 1000 // clock_ticks)
+
+# Reads just /proc/PID/stat of each process (instead of e.g. also
+# /proc/PID/status) to keep the overhead low. The measurement program
+# itself (i.e. the root of the tree) isn't accounted.
+class Sampler(threading.Thread):
+  def __init__(self, pid, hz):
+    super().__init__(daemon=True)
+    self.pid = pid
+    self.interval = 1.0 / hz
+    self.done = threading.Event()
+    self.xs = []
+
+  def run(self):
+    start = time.monotonic()
+    while True:
+      t = int((time.monotonic() - start) * 1000)
+      rss, cpu = sample_tree(self.pid)
+      self.xs.append( (t, rss, cpu) )
+      if self.done.wait(self.interval):
+        break
+
+  def stop(self):
+    self.done.set()
+    self.join()
+    return self.xs
+
+def open_samples(filename, mode):
+  if filename.endswith('.gz'):
+    return gzip.open(filename, mode + 't', newline='')
+  return open(filename, mode, newline='')
+
+# i.e. one row per sample: tag,run,t,rss,cpu where t and cpu are in
+# ms and rss is in KiB
+#
+# NB: a gzip file opened for appending always reports position 0,
+# thus the file size is checked, instead
+def write_samples(ss, filename):
+  header = not os.path.exists(filename) or os.path.getsize(filename) == 0
+  with open_samples(filename, 'a') as f:
+    writer = csv.writer(f)
+    if header:
+      writer.writerow(['tag', 'run', 't', 'rss', 'cpu'])
+    for (tag, run, xs) in ss:
+      for x in xs:
+        writer.writerow((tag, run) + x)
+
+def read_samples(filename):
+  with open_samples(filename, 'r') as f:
+    # i.e. also skip the duplicate headers older versions appended
+    reader = ( row for row in csv.reader(f) if row[:2] != ['tag', 'run'] )
+    return [ (tag, int(run), [ tuple(int(v) for v in row[2:]) for row in l ])
+             for ((tag, run), l) in itertools.groupby(reader,
+               lambda row: (row[0], row[1])) ]
+
+SampleStat = collections.namedtuple('SampleStat',
+        ['n', 'peak_rss', 'time_to_peak', 'peak_cpu'])
+
+def cpu_usage(xs):
+  return [ (b[2] - a[2]) / (b[0] - a[0]) * 100.0 if b[0] > a[0] else 0.0
+           for (a, b) in zip(xs, xs[1:]) ]
+
+def gen_sample_stats(ss):
+  d = collections.OrderedDict()
+  for (tag, run, xs) in ss:
+    if xs:
+      d.setdefault(tag, []).append(xs)
+  zs = []
+  for (tag, runs) in d.items():
+    peaks = [ max(xs, key=lambda x: x[1]) for xs in runs ]
+    zs.append( (tag, SampleStat(n=runs.__len__(),
+        peak_rss=statistics.median(x[1] for x in peaks),
+        time_to_peak=statistics.median(x[0] / 1000 for x in peaks),
+        peak_cpu=statistics.median(max(cpu_usage(xs), default=0.0)
+                                   for xs in runs))) )
+  return zs
+
+def write_sample_stats(zs, args, f):
+  fstr = '{:1.'+str(args.precision)+'f}'
+  print(','.join(['tag'] + list(SampleStat._fields)), file=f)
+  for (tag, z) in zs:
+    print(','.join([tag, str(z.n)] + [ fstr.format(v) for v in z[1:] ]),
+        file=f)
+
+def write_sample_svg(ss, args, filename):
+  fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True, figsize=(
+      (args.width, args.height) if args.width and args.height else None))
+  colors = {}
+  for (tag, run, xs) in ss:
+    if not xs:
+      continue
+    label = None
+    if tag not in colors:
+      colors[tag] = 'C{}'.format(colors.__len__() % 10)
+      label = tag
+    ts = [ x[0] / 1000 for x in xs ]
+    ax1.plot(ts, [ x[1] / 1024 for x in xs ], color=colors[tag],
+        alpha=0.6, label=label)
+    ax2.plot(ts[1:], cpu_usage(xs), color=colors[tag], alpha=0.6)
+  ax1.set_ylabel('RSS (MiB)')
+  ax2.set_ylabel('CPU (%)')
+  ax2.set_xlabel('time (s)')
+  ax1.legend()
+  ax1.set_title('Usage over time')
+  fig.tight_layout()
+  fig.savefig(filename)
+
+def prepare_cache(mode, args):
+  if mode == 'cold':
+    if os.geteuid() == 0:
+      os.sync()
+      # i.e. just the page cache, not dentries and inodes
+      with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('1')
+    else:
+      for filename in args.cache_files:
+        with open(filename, 'rb') as f:
+          # dirty pages aren't dropped
+          os.fdatasync(f.fileno())
+          os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+  elif mode == 'warm':
+    b = bytearray(1024 * 1024)
+    for filename in args.cache_files:
+      with open(filename, 'rb', buffering=0) as f:
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while f.readinto(b):
+          pass
+
 # Reasons for using an external `time` command instead of
 # calling e.g. `getrusage()`:
 # - the forked child will start
@@ -204,38 +831,143 @@ def setup_file_logging(filename):
 #   too high if child actually uses less memory
 # - same code path as for other measurement tools
 # - elapsed time would have to be measured separately, otherwise
-def measure(tag, cmd, args):
+def measure(tag, cmd, args, cache=''):
   errors = 0
   if args.null_out:
     stdout = subprocess.DEVNULL
   else:
     stdout = None
   with tempfile.NamedTemporaryFile(mode='w+', newline='') as temp_file:
-    time_args = args.time_args.copy()
-    time_args[time_args.index('$<')] = temp_file.name
-    a = [ args.time ] + time_args + [cmd] + args.argv
+    if args.pstat:
+      argvs = [ [ args.time, 'stat', '-x,', '--append', '-o', temp_file.name,
+                  '-e', ','.join(es), '--', cmd ] + args.argv
+                for es in args.event_chunks ]
+    else:
+      time_args = args.time_args.copy()
+      time_args[time_args.index('$<')] = temp_file.name
+      argvs = [ [ args.time ] + time_args + [cmd] + args.argv ]
     rc = -1
-    with subprocess.Popen(a, stdout=stdout) as p:
-      rc = p.wait(timeout=args.timeout)
-      if rc != 0:
-        log.error('Command {} failed with rc: {}'.format(cmd, rc))
-        errors = errors + 1
-    reader = csv.reader(temp_file)
-    r = [tag] + next(reader)
+    env = get_env(args)
+    cgroup = mk_cgroup(args) if args.cgroup is not None else None
+    # the measurement program is accounted as well, the child inherits it
+    prefix = cgroup_exec(cgroup) if cgroup else []
+    try:
+      for (i, a) in enumerate(argvs):
+        with subprocess.Popen(prefix + a, stdout=stdout) as p:
+          # with multiple perf runs, only the first one is sampled
+          sampler = Sampler(p.pid, args.sample) if args.sample and i == 0 \
+              else None
+          if sampler:
+            sampler.start()
+          try:
+            rc = p.wait(timeout=args.timeout)
+          finally:
+            if sampler:
+              args.sample_runs.append( (tag, next(args.sample_counter[tag]),
+                sampler.stop()) )
+          if rc not in args.ok_rc:
+            log.error('Command {} failed with rc: {}'.format(cmd, rc))
+            errors = errors + 1
+            break
+      cs = read_cgroup(cgroup) if cgroup else []
+    finally:
+      if cgroup:
+        rm_cgroup(cgroup)
+    if args.pstat:
+      r = [tag] + read_perf(temp_file, args) + cs
+    else:
+      # i.e. GNU time without --quiet also writes 'Command exited with
+      # non-zero status ...' (or 'Command terminated by signal ...')
+      reader = csv.reader(temp_file)
+      r = [tag] + next(row for row in reader
+          if row and not row[0].startswith('Command ')) + cs
     r.append(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
     r.append(rc)
     r.append(cmd)
     r.append(str(args.argv))
+    r.extend(env)
+    r.append(cache)
     return (r, errors)
 
+# spec: MODULE:FUNCTION where MODULE is either an importable module
+# or a path to a Python file (e.g. user-installed.py, which isn't importable
+# due to the dash)
+def load_callable(spec):
+  module, _, name = spec.rpartition(':')
+  if not module:
+    raise ValueError('Callable {} not of the form MODULE:FUNCTION'.format(spec))
+  if module.endswith('.py') or '/' in module:
+    mname = os.path.splitext(os.path.basename(module))[0].replace('-', '_')
+    s = importlib.util.spec_from_file_location(mname, module)
+    m = importlib.util.module_from_spec(s)
+    s.loader.exec_module(m)
+  else:
+    m = importlib.import_module(module)
+  f = m
+  for x in name.split('.'):
+    f = getattr(f, x)
+  return f
+
+def time_calls(f, xs, number, args):
+  it = itertools.repeat(None, number)
+  gc_enabled = gc.isenabled()
+  if args.no_gc:
+    gc.disable()
+  try:
+    r0 = resource.getrusage(resource.RUSAGE_SELF)
+    t0 = time.perf_counter()
+    for _ in it:
+      f(*xs)
+    t1 = time.perf_counter()
+    r1 = resource.getrusage(resource.RUSAGE_SELF)
+  finally:
+    if gc_enabled:
+      gc.enable()
+  return (t1 - t0, r1.ru_utime - r0.ru_utime, r1.ru_stime - r0.ru_stime,
+      r1.ru_maxrss)
+
+# similar to timeit.Timer.autorange()
+def calibrate(f, xs, args):
+  i = 1
+  while True:
+    for j in (1, 2, 5):
+      number = i * j
+      if time_calls(f, xs, number, args)[0] >= args.min_time:
+        return number
+    i = i * 10
+
+# Counterpart to measure() where the items are per call (in µs), except
+# the process' maxrss - a callable is just calibrated before its first
+# measurement such that all repetitions use the same number of calls
+def measure_callable(tag, cmd, args, cache=''):
+  f = args.callables[cmd]
+  env = get_env(args)
+  if cmd not in args.calls:
+    args.calls[cmd] = args.loops or calibrate(f, args.argv, args)
+    log.debug('Calling {} {} times per measurement'.format(cmd, args.calls[cmd]))
+  number = args.calls[cmd]
+  wall, user, sys_, rss = time_calls(f, args.argv, number, args)
+  r = [ tag ] + [ x / number * 1e6 for x in (wall, user, sys_) ] + [ rss ]
+  r.append(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+  r.append(0)
+  r.append(cmd)
+  r.append(str(args.argv))
+  r.extend(env)
+  r.append(cache)
+  return (r, 0)
+
 def execute(args):
   xs = []
   esum = 0
-  for (tag, cmd) in zip(args.tags, args.cmd):
+  for (tag, cmd, cache) in zip(args.tags, args.cmd, args.cache_modes):
     rs = []
     for i in range(args.repeat):
       try:
-        m, errors = measure(tag, cmd, args)
+        prepare_cache(cache, args)
+        if args.callable:
+          m, errors = measure_callable(tag, cmd, args, cache)
+        else:
+          m, errors = measure(tag, cmd, args, cache)
         if args.sleep > 0:
           time.sleep(args.sleep)
         rs.append(m)
@@ -247,11 +979,66 @@ def execute(args):
     xs.append( (tag, rs) )
   return (xs, esum)
 
-def read_raw(filename):
+# All K copies are started at once, thus the wall time of the batch is
+# the time until the slowest copy finished.
+def measure_batch(tag, cmd, k, args, cache=''):
+  rs = []
+  errors = 0
+  prepare_cache(cache, args)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=k) as executor:
+    start = time.monotonic()
+    fs = [ executor.submit(measure, tag, cmd, args, cache)
+           for _ in range(k) ]
+    for f in fs:
+      try:
+        m, e = f.result()
+        rs.append(m)
+        errors = errors + e
+      except StopIteration:
+        errors = errors + 1
+        log.error("Couldn't read measurements from temporary file"
+                + ' - {}'.format(tag))
+    wall = time.monotonic() - start
+  return (rs, wall, errors)
+
+Scaling = collections.namedtuple('Scaling',
+        ['k', 'n', 'throughput', 'speedup', 'efficiency'])
+
+def execute_concurrent(args):
+  xs = []
+  ss = []
+  esum = 0
+  for (tag, cmd, cache) in zip(args.tags, args.cmd, args.cache_modes):
+    ts = []
+    for k in args.concurrency:
+      ktag = '{}/k{}'.format(tag, k)
+      rs = []
+      bs = []
+      for i in range(args.repeat):
+        ms, wall, errors = measure_batch(ktag, cmd, k, args, cache)
+        if args.sleep > 0:
+          time.sleep(args.sleep)
+        rs.extend(ms)
+        bs.append(k / wall)
+        esum = esum + errors
+      xs.append( (ktag, rs) )
+      ts.append( (k, statistics.median(bs)) )
+    base = ts[0][1]
+    ss.append( (tag, [ Scaling(k=k, n=args.repeat, throughput=t,
+        speedup=t / base, efficiency=t / base / k) for (k, t) in ts ]) )
+  return (xs, ss, esum)
+
+# With --pstat, the counter columns are selected by the item names of
+# the header, i.e. such that raw files with other events or written by
+# the perfstat.sh wrapper (which also stored the derived items) can
+# still be read.
+def read_raw(filename, args):
   with open(filename, 'r', newline='') as f:
     reader = csv.reader(f)
     rs = []
-    next(reader)
+    header = next(reader)
+    if args.pstat and 'date' in header:
+      reader = remap_pstat_raw(reader, header, args)
 
     xs = [ (k, list(l))
             for (k, l) in itertools.groupby(reader, lambda row: row[0])]
@@ -268,10 +1055,17 @@ def read_raw(filename):
 
     return xs
 
+def remap_pstat_raw(reader, header, args):
+  i = header.index('date')
+  ks = [ header.index(x) if x in header[:i] else None for x in args.items ]
+  for row in reader:
+    yield [ row[0] ] + [ '' if k is None else row[k] for k in ks ] + row[i:]
+
 def write_raw(rrs, args, filename):
   with open(filename, 'a', newline='') as f:
     writer = csv.writer(f)
-    writer.writerow(['tag'] + args.items +  ['date', 'rc', 'cmd', 'args' ])
+    writer.writerow(['tag'] + args.items +  ['date', 'rc', 'cmd', 'args' ]
+        + env_fields)
     for rs in rrs:
       for row in rs[1]:
         writer.writerow(row)
@@ -298,6 +1092,34 @@ def write_svg(ys, args, filename):
   plt.tight_layout()
   plt.savefig(filename)
 
+def write_scaling(ss, args, f):
+  fstr = '{:1.'+str(args.precision)+'f}'
+  print(','.join(['tag'] + list(Scaling._fields)), file=f)
+  for (tag, xs) in ss:
+    for x in xs:
+      print(','.join([tag, str(x.k), str(x.n)]
+        + [ fstr.format(v) for v in x[2:] ]), file=f)
+
+def write_scaling_svg(ss, args, filename):
+  fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(
+      (args.width, args.height) if args.width and args.height else None))
+  kmax = ss[0][1][-1].k
+  ax1.plot([1, kmax], [1, kmax], linestyle=':', color='grey', label='ideal')
+  for (tag, xs) in ss:
+    ax1.plot([ x.k for x in xs ], [ x.speedup for x in xs ], marker='o',
+        label=tag)
+    ax2.plot([ x.k for x in xs ], [ x.efficiency for x in xs ], marker='o',
+        label=tag)
+  ax1.set_xlabel('concurrency')
+  ax1.set_ylabel('speedup (throughput/throughput@1)')
+  ax2.set_xlabel('concurrency')
+  ax2.set_ylabel('efficiency (speedup/K)')
+  ax2.set_ylim(bottom=0)
+  ax1.legend()
+  fig.suptitle('Scaling')
+  fig.tight_layout()
+  fig.savefig(filename)
+
 # normally, we would just use a csv.writer() but
 # we want to control the number of significant figures
 def write_csv(zs, args, f):
@@ -317,7 +1139,8 @@ def write_csv(zs, args, f):
     print(','.join(srow), file=f)
 
 def get_items(rs, args):
-  m = np.zeros(rs.__len__(), dtype=[(x, 'float64') for x in args.items ] )
+  m = np.zeros(rs.__len__(),
+      dtype=[(x, 'float64') for x in args.items + args.derived ] )
   i = 0
   for row in rs:
     j = 0
@@ -326,6 +1149,8 @@ def get_items(rs, args):
       m[i][j] = 0 if v == '' else v
       j = j + 1
     i = i + 1
+  if args.derived:
+    derive_items(m, args)
   return m
 
 Stat = collections.namedtuple('Stat',
@@ -344,11 +1169,27 @@ def gen_stats(items, args):
 
 def run(args):
   xs = []
+  ss = []
   errors = 0
   if args.input:
-    xs = xs + read_raw(args.input)
+    xs = xs + read_raw(args.input, args)
+  if args.sample_input:
+    args.sample_runs.extend(read_samples(args.sample_input))
   if args.cmd:
-    rxs, errors = execute(args)
+    preflight(args)
+    # i.e. the children inherit the affinity
+    if args.cpu_set:
+      os.sched_setaffinity(0, args.cpu_set)
+    if args.cgroup is not None:
+      setup_cgroup(args)
+    try:
+      if args.concurrency:
+        rxs, ss, errors = execute_concurrent(args)
+      else:
+        rxs, errors = execute(args)
+    finally:
+      if args.cgroup is not None:
+        teardown_cgroup(args)
     xs = xs + rxs
   if args.csv or not args.quiet or args.svg:
     ys = [ (tag, get_items(rs, args)) for (tag, rs) in xs ]
@@ -359,15 +1200,47 @@ def run(args):
       write_csv(zs, args, f)
   if not args.quiet:
     write_csv(zs, args, sys.stdout)
+  if ss and args.scaling_csv:
+    with open(args.scaling_csv, 'w') as f:
+      write_scaling(ss, args, f)
+  if ss and not args.quiet:
+    print()
+    write_scaling(ss, args, sys.stdout)
+  if args.sample_runs and not args.quiet:
+    print()
+    write_sample_stats(gen_sample_stats(args.sample_runs), args, sys.stdout)
+  if args.samples:
+    write_samples(args.sample_runs, args.samples)
   if args.raw:
     write_raw(xs, args, args.raw)
   if args.svg:
     write_svg(ys, args, args.svg)
+  if ss and args.scaling_svg:
+    write_scaling_svg(ss, args, args.scaling_svg)
+  if args.sample_svg:
+    write_sample_svg(args.sample_runs, args, args.sample_svg)
   return int(errors != 0)
 
+def bench_callables(fs, xs = []):
+  '''Benchmark Python callables in-process and report them like
+  external commands, e.g.:
+
+      bench_callables([ ('sort', lambda: sorted(vs, key=LooseVersion)) ],
+          [ '-n', '20', '--svg', 'sort.svg' ])
+
+  fs is a list of (tag, callable) pairs and xs are benchmark command
+  line options, where the positional arguments are passed to the
+  callables. Returns the exit status.'''
+  args = parse_args(xs, fs)
+  return run(args)
+
 def main():
   args = parse_args()
-  return run(args)
+  try:
+    return run(args)
+  except PreflightError as e:
+    log.error(e)
+    return 1
 
 
 if __name__ == '__main__':
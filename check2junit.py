@@ -9,12 +9,16 @@ from lxml import etree
 import re
 import sys
 
-# necessary for xpath
-ns = etree.FunctionNamespace('http://check.sourceforge.net/ns')
-ns.prefix='c'
+# i.e. the qualified tag names, to avoid XPath queries per element
+ns = '{http://check.sourceforge.net/ns}'
+c_datetime = ns + 'datetime'
+c_suite    = ns + 'suite'
+c_title    = ns + 'title'
+c_test     = ns + 'test'
+case_tags  = { ns + x: x for x in
+               ('id', 'iteration', 'fn', 'duration', 'message') }
 
-# not necessary for xpath
-#etree.register_namespace('c', 'http://check.sourceforge.net/ns')
+fn_re = re.compile(r'\.[^.]+:.+$')
 
 
 # see also
@@ -22,53 +26,95 @@ ns.prefix='c'
 # for a discussion of the JUnit format, as used by Jenkins
 
 def mk_testcase(case):
-  name = case.xpath('./c:id')[0].text
-  iteration = case.xpath('./c:iteration')[0].text
+  d = { case_tags[c.tag]: c.text for c in case if c.tag in case_tags }
+  name = d['id']
+  iteration = d['iteration']
   if iteration != '0':
     name = name + '_' + iteration
-  fn = case.xpath('./c:fn')[0].text
-  fn = re.sub(r'\.[^.]+:.+$', '', fn)
+  fn = fn_re.sub('', d['fn'])
   result = case.attrib['result']
   if result == 'success':
-    duration = case.xpath('./c:duration')[0].text
+    duration = d['duration']
   else:
     duration = '0'
   r = E('testcase', name=name, classname=fn, time=duration)
   if result == 'failure':
-    message = case.xpath('./c:message')[0].text
-    err = E('error', message=message)
+    err = E('error', message=d['message'])
     r.append(err)
   return r
 
-def mk_testsuite(suite, timestamp):
-  title = suite.xpath('./c:title')[0]
-  tests = suite.xpath('./c:test')
-  failures = suite.xpath('./c:test[@result="failure"]')
-  r = E('testsuite', name=title.text, timestamp=timestamp,
-    tests=str(tests.__len__()), failures=str(failures.__len__()))
-  for test in tests:
-    r.append(mk_testcase(test))
-  return r
+# i.e. also drop the already processed siblings, otherwise
+# the emptied elements still pile up under the root
+def clear(el):
+  el.clear()
+  while el.getprevious() is not None:
+    del el.getparent()[0]
 
-def mk_testsuites_P(r, ts):
-  datetime = ts.xpath('./c:datetime')[0]
-  timestamp = datetime.text.replace(' ', 'T')
-  suites = ts.xpath('./c:suite')
-  for suite in suites:
-    r.append(mk_testsuite(suite, timestamp))
-  return r
+# the testsuite start tag needs the counts, thus, a first pass
+# yields the (tests, failures) of each suite
+def count_tests(filename):
+  n, failures = 0, 0
+  for _, el in etree.iterparse(filename, tag=(c_test, c_suite)):
+    if el.tag == c_test:
+      n += 1
+      failures += el.attrib['result'] == 'failure'
+    else:
+      yield n, failures
+      n, failures = 0, 0
+    clear(el)
+
+# The output is indented like etree.dump() does it.
+def write_testsuite(xf, events, title, timestamp, counts):
+  attrib = { 'name': title, 'timestamp': timestamp,
+             'tests': str(counts[0]), 'failures': str(counts[1]) }
+  if not counts[0]:
+    for _, el in events:
+      clear(el)
+      if el.tag == c_suite:
+        break
+    xf.write('  ', E('testsuite', attrib), '\n')
+    return
+  xf.write('  ')
+  with xf.element('testsuite', attrib):
+    xf.write('\n')
+    for _, el in events:
+      if el.tag == c_suite:
+        clear(el)
+        break
+      case = mk_testcase(el)
+      clear(el)
+      etree.indent(case, level=2)
+      xf.write('    ', case, '\n')
+    xf.write('  ')
+  xf.write('\n')
 
-def mk_testsuites(fs):
+def write_testsuites_P(xf, filename):
+  counts = count_tests(filename)
+  timestamp = None
+  events = etree.iterparse(filename,
+      tag=(c_datetime, c_title, c_test, c_suite))
+  for _, el in events:
+    if el.tag == c_datetime:
+      timestamp = el.text.replace(' ', 'T')
+    elif el.tag == c_title:
+      write_testsuite(xf, events, el.text, timestamp, next(counts))
+    clear(el)
+
+# Streams the reports, i.e. just one c:test element is kept in memory
+# and the output is written incrementally.
+def write_testsuites(fs, f):
   if type(fs) is list:
     filenames = fs
   else:
     filenames = [fs]
-  r = E('testsuites')
-  for filename in filenames:
-    d = etree.parse(filename)
-    root = d.getroot()
-    mk_testsuites_P(r, root)
-  return r
+  with etree.xmlfile(f, encoding='utf-8') as xf:
+    if not filenames:
+      xf.write(E('testsuites'))
+      return
+    with xf.element('testsuites'):
+      xf.write('\n')
+      for filename in filenames:
+        write_testsuites_P(xf, filename)
 
 def main(argv):
   if '-h' in argv or '--help' in argv:
@@ -77,7 +123,9 @@ compatible output (as understood by Jenkins)''')
     return 0
   print('''<!-- generated by check2junit.py
         the libcheck-XML to JUnit-Jenkins-style-XML converter -->''')
-  etree.dump(mk_testsuites(argv[1:]))
+  sys.stdout.flush()
+  write_testsuites(argv[1:], sys.stdout.buffer)
+  sys.stdout.buffer.write(b'\n')
   return 0
 
 
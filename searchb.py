@@ -3,23 +3,562 @@
 # 2018, Georg Sauthoff <mail@gms.tf>
 # SPDX-License-Identifier: GPL-3.0-or-later
 
+import argparse
+import collections
+import concurrent.futures
+import ctypes
+import fnmatch
+import gzip
+import itertools
+import lzma
 import mmap
+import os
+import re
 import sys
 
+try:
+  from compression import zstd # Python >= 3.14
+  have_zstd = True
+except ImportError:
+  try:
+    import zstandard
+    have_zstd = True
+  except ImportError:
+    have_zstd = False
+
+def parse_args(*a):
+  p = argparse.ArgumentParser(
+      formatter_class=argparse.RawDescriptionHelpFormatter,
+      description='Search a file for the content of another file and print the offset',
+      epilog='''
+A hex pattern (cf. `--hex`) may contain wildcards, i.e. `??` matches
+any byte and e.g. `4?` any byte whose high nibble is 4. A bitmask can
+be appended after a slash, i.e. only the bits set in the mask are
+compared. Example:
+
+    searchb.py --all --hex 'de ad ?? ?f be ef / ff ff 00 0f 7f ff' core.dump
+
+The longest run of fixed bytes is used as `find()` prefilter and the
+masked pattern is just verified at the candidate positions.
+
+A patterns file (cf. `--patterns`) contains one such pattern per line
+(whitespace is ignored, lines starting with # are comments).
+Each pattern is identified by its line number and each match is
+printed as OFFSET:LINE. All patterns are searched in one pass (with an
+Aho-Corasick automaton over the fixed runs of the patterns).
+
+Targets that can't be memory mapped (e.g. pipes, `-` for stdin or
+files under /proc) are read sequentially into a reusable buffer
+(cf. `--buffer-size`), i.e. with constant memory usage. With
+`--decompress` gzip, xz and zstd compressed targets are
+decompressed on the fly (zstd requires Python 3.14 or the zstandard
+package).
+
+With `--recursive` the target is a directory tree whose regular files
+are searched concurrently by a pool of threads (cf. `--jobs`). Matches
+are printed as PATH:OFFSET (in the order of the sorted tree walk). The
+files are mapped with sequential access and readahead hints. Their
+pages are dropped from the page cache after the search (unless
+`--keep-cache` or some of them were already cached before), i.e.
+scanning a large tree doesn't evict the page cache of other
+applications.
+
+Example:
+
+    searchb.py -ra --include '*.bin' --max-size 100000000 query /srv/firmware
+''')
+  p.add_argument('files', metavar='FILE', nargs='+',
+      help='QUERYFILE TARGETFILE or just TARGETFILE (with --hex/--patterns), - for stdin')
+  p.add_argument('--hex', '-x', metavar='PATTERN',
+      help='search for the hex PATTERN (with wildcards/mask) instead of the QUERYFILE content')
+  p.add_argument('--patterns', '-f', metavar='FILE',
+      help='search for all the (hex) patterns listed in FILE')
+  p.add_argument('--all', '-a', action='store_true',
+      help='print the offsets of all (possibly overlapping) matches')
+  p.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+      help='number of worker processes (--all) or threads (--recursive) (default: %(default)s)')
+  p.add_argument('--chunk-size', type=int, default=64*1024*1024, metavar='BYTES',
+      help='--all: search large targets in chunks of BYTES in parallel (default: %(default)s)')
+  p.add_argument('--buffer-size', type=int, default=4*1024*1024, metavar='BYTES',
+      help='read buffer size when streaming the target (default: %(default)s)')
+  p.add_argument('--decompress', '-z', action='store_true',
+      help='decompress gzip/xz/zstd compressed targets on the fly')
+  p.add_argument('--recursive', '-r', action='store_true',
+      help='search all files under the target directory')
+  p.add_argument('--include', action='append', default=[], metavar='GLOB',
+      help='recursive: only search files whose name matches GLOB')
+  p.add_argument('--exclude', action='append', default=[], metavar='GLOB',
+      help='recursive: skip files and directories whose name matches GLOB')
+  p.add_argument('--min-size', type=int, default=0, metavar='BYTES',
+      help='recursive: skip smaller files')
+  p.add_argument('--max-size', type=int, default=0, metavar='BYTES',
+      help='recursive: skip larger files, 0 means no limit (default: %(default)s)')
+  p.add_argument('--keep-cache', action='store_true',
+      help="recursive: don't drop the searched files from the page cache")
+  args = p.parse_args(*a)
+  if args.chunk_size < 1 or args.buffer_size < 1:
+    raise RuntimeError('chunk and buffer size must be positive')
+  if args.hex and args.patterns:
+    p.error('--hex and --patterns are mutually exclusive')
+  if len(args.files) != (1 if args.patterns or args.hex else 2):
+    p.error('expected QUERYFILE TARGETFILE or --hex/--patterns ... TARGETFILE')
+  args.target = args.files[-1]
+  args.query = None if args.patterns or args.hex else args.files[0]
+  if os.path.isdir(args.target) and not args.recursive:
+    p.error(f'{args.target} is a directory (cf. --recursive)')
+  return args
+
+# returns None if the file can't be mapped, e.g. a pipe or a /proc file
+# (since their size is zero they can't be told apart from empty files,
+# which are thus streamed, as well)
 def map_file(filename):
   with open(filename, 'rb', buffering=0) as f:
     try:
       b = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
       return b
-    except ValueError:
-      return bytes()
+    except (ValueError, OSError):
+      return None
+
+def read_file(filename):
+  with open(filename, 'rb') as f:
+    return f.read()
+
+magics = {
+    'gzip': b'\x1f\x8b',
+    'xz'  : b'\xfd7zXZ\x00',
+    'zstd': b'\x28\xb5\x2f\xfd'
+    }
+
+def get_compression(b):
+  for k, m in magics.items():
+    if b.startswith(m):
+      return k
+  return None
+
+def open_stream(filename, decompress):
+  f = sys.stdin.buffer if filename == '-' else open(filename, 'rb')
+  c = get_compression(f.peek(8)[:8]) if decompress else None
+  if c == 'gzip':
+    return gzip.GzipFile(fileobj=f)
+  elif c == 'xz':
+    return lzma.LZMAFile(f)
+  elif c == 'zstd':
+    if not have_zstd:
+      raise RuntimeError('zstd decompression requires Python 3.14 or the zstandard package')
+    if 'zstandard' in globals():
+      return zstandard.ZstdDecompressor().stream_reader(f)
+    return zstd.ZstdFile(f)
+  return f
+
+# i.e. short reads are normal for pipes and decompressors
+def read_into(f, b):
+  n = 0
+  while n < len(b):
+    k = f.readinto(b[n:])
+    if not k:
+      break
+    n += k
+  return n
+
+# A byte pattern where only the bits set in the mask are compared.
+# The literal is the longest run of fully fixed bytes (at lit_off),
+# i.e. each match contains it.
+class Pattern:
+  def __init__(self, value, mask):
+    self.size = len(value)
+    self.mask = mask
+    self.value = bytes(v & m for v, m in zip(value, mask))
+    self.exact = all(m == 0xff for m in mask)
+    self.m = int.from_bytes(mask, 'big')
+    self.v = int.from_bytes(self.value, 'big')
+    i = k = 0
+    for fixed, g in itertools.groupby(mask, lambda m: m == 0xff):
+      n = len(list(g))
+      if fixed and n > k:
+        self.lit_off, k = i, n
+      i += n
+    if not k:
+      raise RuntimeError('pattern must contain at least one fixed byte')
+    self.literal = self.value[self.lit_off:self.lit_off + k]
+
+  def matches(self, t, off):
+    return int.from_bytes(t[off:off + self.size], 'big') & self.m == self.v
+
+# e.g. 'de ad ?? 4? be ef' or 'de ad 00 40 be ef / ff ff 00 f0 ff ff'
+def parse_hex(s):
+  s, _, m = ''.join(s.split()).partition('/')
+  if not s or len(s) % 2:
+    raise RuntimeError(f'invalid hex pattern: {s}')
+  value = bytes.fromhex(s.replace('?', '0'))
+  mask  = bytes.fromhex(''.join('0' if c == '?' else 'f' for c in s))
+  if m:
+    m = bytes.fromhex(m)
+    if len(m) != len(mask):
+      raise RuntimeError('mask and pattern must have the same length')
+    mask = bytes(a & b for a, b in zip(mask, m))
+  return Pattern(value, mask)
+
+# returns (line number, pattern) pairs
+def read_patterns(filename):
+  xs = []
+  with open(filename) as f:
+    for i, line in enumerate(f, 1):
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+      try:
+        xs.append((i, parse_hex(line)))
+      except (ValueError, RuntimeError) as e:
+        raise RuntimeError(f'{filename}:{i}: {e}')
+  if not xs:
+    raise RuntimeError(f'{filename}: no patterns')
+  return xs
+
+# i.e. a matcher finds the matches that start in [start, end), thus,
+# the chunks overlap by the maximum pattern length minus one
+class Literal:
+  def __init__(self, q):
+    self.q = q
+    self.overlap = len(q) - 1
+
+  def find(self, t, start, end, first=False):
+    q = self.q
+    xs = []
+    end += self.overlap
+    i = t.find(q, start, end)
+    while i != -1:
+      xs.append((i, None))
+      if first:
+        break
+      i = t.find(q, i + 1, end)
+    return xs
+
+# i.e. when there is nothing to sample: zero, 0xff and printable
+# ASCII bytes are usually much more common in binaries and text files
+def default_freqs():
+  c = collections.Counter({ i: 1 for i in range(256) })
+  c.update({ i: 10 for i in range(0x20, 0x7f) })
+  c.update({ 0x0a: 10, 0x00: 100, 0xff: 20 })
+  return c
+
+# i.e. the literal of the pattern is used as prefilter
+class Masked:
+  def __init__(self, p):
+    self.p = p
+    self.overlap = p.size - 1
+
+  def find(self, t, start, end, first=False):
+    p = self.p
+    lit, k = p.literal, p.lit_off
+    n = len(t)
+    xs = []
+    # i.e. the literal of a match that starts before end
+    hi = end + k + len(lit) - 1
+    i = t.find(lit, start + k, hi)
+    while i != -1:
+      off = i - k
+      if off + p.size <= n and p.matches(t, off):
+        xs.append((off, None))
+        if first:
+          break
+      i = t.find(lit, i + 1, hi)
+    return xs
+
+# estimates the byte frequencies from a few evenly spaced samples
+def byte_freqs(t, samples=16, size=16*1024):
+  if not t:
+    return default_freqs()
+  n = len(t)
+  c = collections.Counter()
+  for i in range(samples):
+    off = n * i // samples
+    c.update(t[off:off + size])
+  return c
+
+# Aho-Corasick automaton, i.e. the trie of all pattern literals with
+# failure links, compiled into a DFA (one 256-entry transition list per
+# state). Masked patterns are verified when their literal matches.
+#
+# Since stepping through the DFA in Python is slow, the target is
+# prefiltered: each literal contains its rarest byte (the anchor), thus,
+# each literal match lies in a window of +/- (maximum pattern length - 1) bytes
+# around an anchor occurrence. The anchors are located with a regular
+# expression character class (i.e. in C) and the DFA is just run over
+# the (merged) windows.
+class Automaton:
+  def __init__(self, patterns, freqs):
+    self.overlap = max(p.size for _, p in patterns) - 1
+    goto = [ {} ]
+    out  = [ [] ]
+    for pid, p in patterns:
+      s = 0
+      for c in p.literal:
+        if c not in goto[s]:
+          goto.append({})
+          out.append([])
+          goto[s][c] = len(goto) - 1
+        s = goto[s][c]
+      # i.e. the offset of the match relative to the end of the literal
+      out[s].append((pid, p.lit_off + len(p.literal) - 1, None if p.exact else p))
+    # breadth-first, i.e. the failure states are complete when needed
+    delta = [ None ] * len(goto)
+    delta[0] = [ goto[0].get(c, 0) for c in range(256) ]
+    fail = [ 0 ] * len(goto)
+    xs = collections.deque(goto[0].values())
+    while xs:
+      s = xs.popleft()
+      f = fail[s]
+      out[s] = out[s] + out[f]
+      delta[s] = list(delta[f])
+      for c, u in goto[s].items():
+        delta[s][c] = u
+        fail[u] = delta[f][c] if s else 0
+        xs.append(u)
+    self.delta = delta
+    self.out = [ tuple(x) for x in out ]
+    anchors = { min(p.literal, key=lambda c: (freqs[c], c)) for _, p in patterns }
+    self.anchor_re = re.compile(b'[' + b''.join(re.escape(bytes([c])) for c in sorted(anchors)) + b']')
+
+  def windows(self, t, lo, hi):
+    k = self.overlap
+    a = b = None
+    for m in self.anchor_re.finditer(t, lo, hi):
+      c = m.start()
+      if b is not None and c - k <= b:
+        b = min(c + k + 1, hi)
+        continue
+      if b is not None:
+        yield a, b
+      a, b = max(c - k, lo), min(c + k + 1, hi)
+    if b is not None:
+      yield a, b
+
+  def find(self, t, start, end, first=False):
+    delta, out = self.delta, self.out
+    n = len(t)
+    xs = []
+    for a, b in self.windows(t, start, min(end + self.overlap, n)):
+      s = 0
+      for j, c in enumerate(t[a:b], a):
+        s = delta[s][c]
+        for pid, k, p in out[s]:
+          off = j - k
+          if start <= off < end and (p is None or (off + p.size <= n and p.matches(t, off))):
+            xs.append((off, pid))
+    xs.sort()
+    return xs[:1] if first else xs
+
+# i.e. a match is a (offset, pattern id) pair
+def fmt_match(x):
+  return str(x[0]) if x[1] is None else f'{x[0]}:{x[1]}'
+
+# NB: bytes.find() and mmap.find() don't release the GIL, thus, the
+# chunks are searched by worker processes that map the target themselves
+worker_target  = None
+worker_matcher = None
+
+def init_worker(filename, matcher):
+  global worker_target, worker_matcher
+  worker_target  = map_file(filename)
+  worker_matcher = matcher
+
+def search_chunk(start, end):
+  return worker_matcher.find(worker_target, start, end, False)
+
+# Yields the matches buffer by buffer, i.e. the last overlap bytes of
+# the buffer are carried over to the start of the next one.
+def search_stream(matcher, f, args):
+  k = matcher.overlap
+  buf = bytearray(max(args.buffer_size, 2 * k + 1))
+  b = memoryview(buf)
+  first = not args.all
+  base = 0
+  filled = 0
+  while True:
+    filled += read_into(f, b[filled:])
+    if filled < len(buf):
+      # i.e. EOF, and the tail of the buffer is stale
+      xs = matcher.find(buf[:filled], 0, filled, first)
+      yield [ (off + base, pid) for off, pid in xs ]
+      return
+    end = filled - k
+    xs = matcher.find(buf, 0, end, first)
+    yield [ (off + base, pid) for off, pid in xs ]
+    buf[:k] = buf[end:filled]
+    base += end
+    filled = k
+
+# yields the matches chunk by chunk, in order - the first match is
+# searched by a single scan since it stops early, whereas the chunks
+# beyond the match would be searched in vain
+def search(matcher, t, filename, args):
+  n = len(t)
+  if not args.all:
+    yield matcher.find(t, 0, n, True)
+    return
+  cs = [ (s, min(s + args.chunk_size, n)) for s in range(0, n, args.chunk_size) ]
+  if args.jobs <= 1 or len(cs) <= 1:
+    for s, e in cs:
+      yield matcher.find(t, s, e, False)
+    return
+  ex = concurrent.futures.ProcessPoolExecutor(min(args.jobs, len(cs)),
+      initializer=init_worker, initargs=(filename, matcher))
+  try:
+    yield from ex.map(search_chunk, (s for s, _ in cs), (e for _, e in cs))
+  finally:
+    # i.e. also when the caller is interrupted
+    ex.shutdown(cancel_futures=True)
+
+def excluded(name, args):
+  return any(fnmatch.fnmatch(name, g) for g in args.exclude)
+
+# yields the regular files in sorted order, i.e. symbolic links
+# aren't followed
+def scan_tree(d, args):
+  try:
+    with os.scandir(d) as it:
+      es = sorted(it, key=lambda e: e.name)
+  except OSError as e:
+    print(f'searchb: {e}', file=sys.stderr)
+    return
+  for e in es:
+    if excluded(e.name, args):
+      continue
+    if e.is_dir(follow_symlinks=False):
+      yield from scan_tree(e.path, args)
+    elif e.is_file(follow_symlinks=False):
+      if args.include and not any(fnmatch.fnmatch(e.name, g) for g in args.include):
+        continue
+      n = e.stat(follow_symlinks=False).st_size
+      if n == 0 or n < args.min_size or (args.max_size and n > args.max_size):
+        continue
+      yield e.path
+
+libc = None
+
+# i.e. just loaded when needed
+def get_libc():
+  global libc
+  if libc is None:
+    c = ctypes.CDLL(None, use_errno=True)
+    c.mmap.restype = ctypes.c_void_p
+    c.mmap.argtypes = [ ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+        ctypes.c_int, ctypes.c_int, ctypes.c_long ]
+    c.munmap.argtypes = [ ctypes.c_void_p, ctypes.c_size_t ]
+    c.mincore.argtypes = [ ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p ]
+    libc = c
+  return libc
+
+# i.e. whether any page of the file is in the page cache, cf. mincore(2)
+# - in doubt, it's assumed to be cached
+#
+# NB: the mmap module doesn't expose the address of a mapping
+def is_cached(fd, n):
+  libc = get_libc()
+  p = libc.mmap(None, n, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+  if p == ctypes.c_void_p(-1).value:
+    return True
+  try:
+    v = ctypes.create_string_buffer((n + mmap.PAGESIZE - 1) // mmap.PAGESIZE)
+    if libc.mincore(p, n, v) != 0:
+      return True
+    return any(b & 1 for b in v.raw)
+  finally:
+    libc.munmap(p, n)
+
+# NB: find() holds the GIL (also while it's blocked on page faults),
+# thus, MADV_WILLNEED is used to start the (asynchronous) readahead
+# of the whole file such that the I/O of several files overlaps
+def search_file(matcher, path, args):
+  with open(path, 'rb', buffering=0) as f:
+    try:
+      t = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+    except (ValueError, OSError):
+      return []
+    try:
+      # i.e. don't evict files that were in use before the search
+      drop = not args.keep_cache and not is_cached(f.fileno(), len(t))
+      t.madvise(mmap.MADV_SEQUENTIAL)
+      t.madvise(mmap.MADV_WILLNEED)
+      xs = matcher.find(t, 0, len(t), not args.all)
+      if drop:
+        t.madvise(mmap.MADV_DONTNEED)
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+      t.close()
+  return xs
+
+# yields (path, matches) pairs in tree walk order, i.e. at most
+# 4 * jobs files are searched ahead
+def search_tree(matcher, args):
+  def get(x):
+    path, fut = x
+    try:
+      return path, fut.result()
+    except OSError as e:
+      print(f'searchb: {e}', file=sys.stderr)
+      return path, []
+  with concurrent.futures.ThreadPoolExecutor(max(args.jobs, 1)) as ex:
+    pending = collections.deque()
+    for path in scan_tree(args.target, args):
+      pending.append((path, ex.submit(search_file, matcher, path, args)))
+      if len(pending) >= 4 * max(args.jobs, 1):
+        yield get(pending.popleft())
+    while pending:
+      yield get(pending.popleft())
+
+def main_tree(matcher, args):
+  found = False
+  for path, xs in search_tree(matcher, args):
+    if xs:
+      found = True
+      sys.stdout.write(''.join(f'{path}:{fmt_match(x)}\n' for x in xs))
+      sys.stdout.flush()
+  return 0 if found else 1
+
+# i.e. None for an empty query
+def mk_matcher(args, freqs):
+  if args.patterns:
+    return Automaton(read_patterns(args.patterns), freqs)
+  if args.hex:
+    return Masked(parse_hex(args.hex))
+  q = read_file(args.query)
+  return Literal(q) if q else None
 
-def main(qfilename, filename):
-  q, t = (map_file(x) for x in (qfilename, filename))
-  i = t.find(q)
-  if i == -1:
-    return 1
-  print(i)
+def main(*a):
+  args = parse_args(*a)
+  if args.recursive and os.path.isdir(args.target):
+    matcher = mk_matcher(args, default_freqs())
+    if not matcher:
+      raise RuntimeError('query must not be empty')
+    return main_tree(matcher, args)
+  t = None if args.target == '-' else map_file(args.target)
+  if t is not None and args.decompress and get_compression(t[:8]):
+    t = None
+  f = None
+  if t is None:
+    f = open_stream(args.target, args.decompress)
+  # i.e. the byte frequencies of a stream are estimated from its start
+  sample = t if f is None else (f.peek(64 * 1024) if hasattr(f, 'peek') else None)
+  matcher = mk_matcher(args, byte_freqs(sample, 1 if f else 16) if args.patterns else None)
+  if not matcher:
+    print(0)
+    return 0
+  if f is None:
+    ms = search(matcher, t, args.target, args)
+  else:
+    ms = search_stream(matcher, f, args)
+  found = False
+  for xs in ms:
+    if not xs:
+      continue
+    found = True
+    if not args.all:
+      print(fmt_match(xs[0]))
+      break
+    sys.stdout.write(''.join(fmt_match(x) + '\n' for x in xs))
+    sys.stdout.flush()
+  return 0 if found else 1
 
 if __name__ == '__main__':
-  sys.exit(main(sys.argv[1], sys.argv[2]))
+  sys.exit(main())
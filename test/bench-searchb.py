@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+#
+# bench-searchb.py unittests
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import subprocess
+import sys
+
+src_dir = os.getenv('src_dir', os.getcwd()+'/..')
+bench_searchb = src_dir + '/bench-searchb.py'
+
+# i.e. behaves like GNU time: without --quiet, a non-zero exit status
+# is reported in the output file before the formatted line
+fake_time = '''#!{python}
+import resource, subprocess, sys, time
+a = sys.argv[1:]
+i = a.index('--output')
+out, cmd = a[i+1], a[i+2:]
+t = time.time()
+rc = subprocess.call(cmd)
+w = time.time() - t
+r = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(out, 'a') as f:
+    if rc != 0 and '--quiet' not in a:
+        f.write(f'Command exited with non-zero status {{rc}}\\n')
+    f.write(f'{{w:.3f}},{{r.ru_utime:.3f}},{{r.ru_stime:.3f}},{{r.ru_maxrss}}\\n')
+sys.exit(rc)
+'''
+
+def test_no_match(tmp_path):
+    t = tmp_path / 'time'
+    t.write_text(fake_time.format(python=sys.executable))
+    t.chmod(0o755)
+    p = subprocess.run([sys.executable, bench_searchb, '--impls', 'py',
+        '--sizes', '64K', '--positions', 'none', 'end', '-n', '2',
+        '--time', str(t), '--preflight', 'off', '--work-dir', str(tmp_path / 'w'),
+        '--baseline', str(tmp_path / 'baseline.json')],
+        stdout=subprocess.PIPE, universal_newlines=True, cwd=tmp_path)
+    assert p.returncode == 0
+    ls = p.stdout.splitlines()
+    assert [ l.split(',')[0] for l in ls if l.startswith('py/') ] == [
+            'py/64K-none/cold', 'py/64K-none/warm',
+            'py/64K-end/cold', 'py/64K-end/warm' ]
+    assert ls[ls.index('corpus,cache,py') + 1].startswith('64K-none,cold,0.')
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+#
+# bench-startup.py unittests
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import json
+import os
+import subprocess
+import sys
+
+src_dir = os.getenv('src_dir', os.getcwd()+'/..')
+bench_startup = src_dir + '/bench-startup.py'
+
+def run(*a):
+    return subprocess.run([sys.executable, bench_startup] + [str(x) for x in a],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+# i.e. failing scripts aren't recorded and scripts without a main guard
+# aren't executed
+def test_failures(tmp_path):
+    ok = tmp_path / 'ok.py'
+    ok.write_text('import argparse\nif __name__ == "__main__":\n    argparse.ArgumentParser().parse_args()\n')
+    fail = tmp_path / 'fail.py'
+    fail.write_text('import no_such_module\nif __name__ == "__main__":\n    pass\n')
+    marker = tmp_path / 'executed'
+    noguard = tmp_path / 'noguard.py'
+    noguard.write_text(f'open({str(marker)!r}, "w")\n')
+    baseline = tmp_path / 'baseline.json'
+    p = run('-n', '1', '--baseline', baseline, '--update', ok, fail, noguard)
+    assert p.returncode == 1
+    rows = [ l.split(',') for l in p.stdout.splitlines()[2:] ]
+    assert [ (r[0], r[1], r[-1]) for r in rows ] == [ ('ok.py', '0', 'new'),
+            ('fail.py', '1', 'failed'), ('noguard.py', '', 'skipped') ]
+    assert not marker.exists()
+    assert list(json.loads(baseline.read_text())['scripts']) == ['ok.py']
+    p = run('-n', '1', '--baseline', baseline, '--allow-failure', 'fail.py', ok, fail)
+    assert p.returncode == 0
+    assert p.stdout.splitlines()[3].endswith(',allowed-failure')
+    p = run('-n', '1', '--baseline', baseline, '--allow-exec', 'noguard.py', noguard)
+    assert p.returncode == 0
+    assert marker.exists()
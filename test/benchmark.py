@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# benchmark.py unittests
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import gc
+import importlib.util
+import os
+import pytest
+import subprocess
+import sys
+
+src_dir = os.getenv('src_dir', os.getcwd()+'/..')
+benchmark = src_dir + '/benchmark.py'
+
+# i.e. behaves like GNU time, cf. bench-searchb.py
+fake_time = '''#!{python}
+import resource, subprocess, sys, time
+a = sys.argv[1:]
+i = a.index('--output')
+out, cmd = a[i+1], a[i+2:]
+t = time.time()
+rc = subprocess.call(cmd)
+w = time.time() - t
+r = resource.getrusage(resource.RUSAGE_CHILDREN)
+with open(out, 'a') as f:
+    if rc != 0 and '--quiet' not in a:
+        f.write(f'Command exited with non-zero status {{rc}}\\n')
+    f.write(f'{{w:.3f}},{{r.ru_utime:.3f}},{{r.ru_stime:.3f}},{{r.ru_maxrss}}\\n')
+sys.exit(rc)
+'''
+
+@pytest.fixture
+def fake(tmp_path):
+    t = tmp_path / 'time'
+    t.write_text(fake_time.format(python=sys.executable))
+    t.chmod(0o755)
+    return t
+
+@pytest.fixture
+def bm():
+    s = importlib.util.spec_from_file_location('benchmark', benchmark)
+    m = importlib.util.module_from_spec(s)
+    s.loader.exec_module(m)
+    return m
+
+def run(*a, cwd=None):
+    return subprocess.run([sys.executable, benchmark] + [str(x) for x in a],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+            cwd=cwd)
+
+# i.e. the per-call times are in µs such that they don't vanish
+# in the printed precision
+def test_callable(tmp_path):
+    (tmp_path / 'mod.py').write_text('def f(n):\n    return sum(range(int(n)))\n')
+    p = run('--callable', '-n', '2', '--min-time', '0.01', '--', 'mod.py:f', '100', cwd=tmp_path)
+    assert p.returncode == 0
+    ls = p.stdout.splitlines()
+    assert ls[0] == 'tag,n,min,Q1,median,Q3,max,mean,dev,item'
+    xs = ls[1].split(',')
+    assert xs[:2] == ['mod.py:f', '2']
+    assert xs[-1] == 'wall_us'
+    assert float(xs[4]) > 0
+
+def test_load_callable(bm, tmp_path):
+    assert bm.load_callable('os.path:join') is os.path.join
+    f = tmp_path / 'my-mod.py'
+    f.write_text('class C:\n    @staticmethod\n    def m(x):\n        return x + "!"\n')
+    assert bm.load_callable(f'{f}:C.m')('a') == 'a!'
+    with pytest.raises(ValueError):
+        bm.load_callable('os.path.join')
+
+def test_calibrate(bm, monkeypatch):
+    # i.e. each call takes 1 ms
+    monkeypatch.setattr(bm, 'time_calls', lambda f, xs, number, args: (number / 1000, 0, 0, 0))
+    args = bm.parse_args(['--min-time', '0.02'], [ ('f', len) ])
+    assert bm.calibrate(len, [], args) == 20
+
+# i.e. each callable is calibrated once, without the GC while timing
+def test_bench_callables(bm, tmp_path, monkeypatch):
+    calibrated = []
+    calibrate = bm.calibrate
+    def calibrate_once(f, xs, args):
+        calibrated.append(f)
+        return calibrate(f, xs, args)
+    monkeypatch.setattr(bm, 'calibrate', calibrate_once)
+    gc_states = []
+    def f(x):
+        assert x == 'abc'
+        gc_states.append(gc.isenabled())
+        return x * 2
+    csv = tmp_path / 'stats.csv'
+    assert bm.bench_callables([ ('f', f), ('g', lambda x: x) ],
+            [ '-n', '3', '--min-time', '0.001', '--no-gc', '--quiet', '--csv', str(csv), '--', 'abc' ]) == 0
+    assert len(calibrated) == 2
+    assert gc_states and not any(gc_states)
+    assert gc.isenabled()
+    ls = csv.read_text().splitlines()
+    assert ls[0] == 'tag,n,min,Q1,median,Q3,max,mean,dev,item'
+    assert [ l.split(',')[:2] + l.split(',')[-1:] for l in ls[1:] ] == [
+            ['f', '3', 'wall_us'], ['g', '3', 'wall_us'] ]
+    assert bm.bench_callables([ ('f', f) ], [ '-n', '2', '--loops', '7', '--quiet', 'abc' ]) == 0
+    assert len(calibrated) == 2
+
+# i.e. the concurrently started instances are pinned as well
+def test_concurrency_cpus(fake):
+    cpu = min(os.sched_getaffinity(0))
+    p = run('--time', fake, '--concurrency', '1,2', '-n', '2', '--cpus', str(cpu), '--',
+            sys.executable, '-c', f'import os; assert os.sched_getaffinity(0) == {{{cpu}}}')
+    assert p.returncode == 0, p.stderr
+    ls = p.stdout.splitlines()
+    tag = os.path.basename(sys.executable)
+    assert [ l.split(',')[:2] for l in ls[1:3] ] == [ [f'{tag}/k1', '2'], [f'{tag}/k2', '4'] ]
+
+# i.e. the leaf that benchmark moves itself into (when the parent has
+# processes) is removed again, emulated with a plain directory
+def test_cgroup_leaf(bm, tmp_path, monkeypatch):
+    (tmp_path / 'cgroup.controllers').write_text('cpu memory pids\n')
+    calls = []
+    def fake_open(filename, mode='r', *a, **kw):
+        if filename.endswith('/cgroup.subtree_control') and not calls:
+            calls.append(filename)
+            raise OSError(bm.errno.EBUSY, 'busy')
+        return open(filename, mode, *a, **kw)
+    monkeypatch.setattr(bm, 'open', fake_open, raising=False)
+    args = bm.parse_args(['--cgroup', str(tmp_path), 'true'])
+    bm.setup_cgroup(args)
+    leaf = tmp_path / f'benchmark-{os.getpid()}'
+    assert args.cgroup_leaf == str(leaf)
+    assert (leaf / 'cgroup.procs').read_text() == '0'
+    assert (tmp_path / 'cgroup.subtree_control').read_text() == '+cpu +memory'
+    (leaf / 'cgroup.procs').unlink()
+    bm.teardown_cgroup(args)
+    assert not leaf.exists()
+    assert (tmp_path / 'cgroup.subtree_control').read_text() == '-cpu -memory'
+    assert (tmp_path / 'cgroup.procs').read_text() == '0'
+
+# i.e. the environment is appended to each raw row
+def test_env(fake, tmp_path):
+    cpu = min(os.sched_getaffinity(0))
+    f = tmp_path / 'input'
+    f.write_text('x')
+    raw = tmp_path / 'raw.csv'
+    p = run('--time', fake, '-n', '1', '--cpus', str(cpu), '--cache', 'cold', 'warm',
+            '--raw', raw, '--', 'cat', f)
+    assert p.returncode == 0, p.stderr
+    rows = [ l.split(',') for l in raw.read_text().splitlines() ]
+    assert rows[0][-6:] == ['governor', 'turbo', 'aslr', 'load', 'cpus', 'cache']
+    with open('/proc/sys/kernel/randomize_va_space') as g:
+        aslr = g.read().strip()
+    for row, cache in zip(rows[1:], ('cold', 'warm')):
+        assert row[0] == f'cat/{cache}'
+        assert row[-4] == aslr
+        assert float(row[-3]) >= 0
+        assert row[-2:] == [str(cpu), cache]
+    assert len(rows) == 3
+
+@pytest.mark.parametrize('mode', ['warn', 'refuse'])
+def test_preflight(fake, mode):
+    p = run('--time', fake, '-n', '1', '--preflight', mode, '--max-load', '-1', 'true')
+    assert 'Preflight: load average' in p.stderr
+    assert 'Traceback' not in p.stderr
+    if mode == 'warn':
+        assert p.returncode == 0
+        assert p.stdout.startswith('tag,')
+    else:
+        assert p.returncode == 1
+        assert p.stderr.splitlines()[-1].endswith('Refusing to run on a noisy system (cf. --preflight)')
+        assert p.stdout == ''
+
+# i.e. the layout of the former perfstat.sh wrapper, which also stored
+# the derived items
+def test_pstat_input_perfstat(tmp_path):
+    raw = tmp_path / 'raw.csv'
+    raw.write_text('tag,nsec,cswitch,cpu_migr,page_fault,cycles,ghz,ins,ins_cyc,br,br_mis,br_mis_rate,date,rc,cmd,args\n'
+            'a,1000000,1,0,100,2000000,2.0,3000000,1.5,500,5,1.0,2020-01-01 10:00:00,0,a,[]\n'
+            'a,1000000,1,0,100,2000000,2.0,5000000,2.5,500,10,2.0,2020-01-01 10:00:01,0,a,[]\n')
+    p = run('--pstat', '--input', raw)
+    assert p.returncode == 0, p.stderr
+    assert p.stdout.splitlines()[1] == 'a,2,1.500,1.750,2.000,2.250,2.500,2.000,0.500,ins_cyc'
+    p = run('--pstat', '--graph-item', 'br_mis_rate', '--input', raw)
+    assert p.stdout.splitlines()[1].startswith('a,2,1.000,')
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+#
+# check2junit.py unittests
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import subprocess
+import sys
+
+src_dir = os.getenv('src_dir', os.getcwd()+'/..')
+check2junit = src_dir + '/check2junit.py'
+
+report_a = '''<?xml version="1.0"?>
+<?xml-stylesheet type="text/xsl" href="http://check.sourceforge.net/xml/check_unittest.xslt"?>
+<testsuites xmlns="http://check.sourceforge.net/ns">
+  <datetime>2016-05-13 21:25:43</datetime>
+  <suite>
+    <title>Core</title>
+    <test result="success">
+      <path>.</path>
+      <fn>check_money.c:20</fn>
+      <id>test_money_create</id>
+      <iteration>0</iteration>
+      <duration>0.000123</duration>
+      <description>Core</description>
+      <message>Passed</message>
+    </test>
+    <test result="failure">
+      <path>.</path>
+      <fn>check_money.c:31</fn>
+      <id>test_money_neg</id>
+      <iteration>2</iteration>
+      <duration>0.000042</duration>
+      <description>Core</description>
+      <message>Amount &lt; 0 &amp; "bad"</message>
+    </test>
+    <test result="error">
+      <path>.</path>
+      <fn>check_money.c:40</fn>
+      <id>test_money_crash</id>
+      <iteration>0</iteration>
+      <duration>-1.000000</duration>
+      <description>Core</description>
+      <message>Received signal 11 (Segmentation fault)</message>
+    </test>
+  </suite>
+  <suite>
+    <title>Empty</title>
+  </suite>
+  <suite>
+    <title>Limits</title>
+    <test result="success">
+      <path>.</path>
+      <fn>check_limits.c:7</fn>
+      <id>test_max</id>
+      <iteration>0</iteration>
+      <duration>0.000007</duration>
+      <description>Limits</description>
+      <message>Passed</message>
+    </test>
+  </suite>
+  <duration>0.001</duration>
+</testsuites>
+'''
+
+report_b = '''<?xml version="1.0"?>
+<testsuites xmlns="http://check.sourceforge.net/ns">
+  <datetime>2016-05-14 08:00:01</datetime>
+  <suite>
+    <title>Other</title>
+    <test result="failure">
+      <path>.</path>
+      <fn>check_other.c:3</fn>
+      <id>test_other</id>
+      <iteration>0</iteration>
+      <duration>0.000001</duration>
+      <description>Other</description>
+      <message>Assertion 'x == 1' failed</message>
+    </test>
+  </suite>
+  <duration>0.0001</duration>
+</testsuites>
+'''
+
+# i.e. the output of the original (tree based) implementation
+golden = '''<!-- generated by check2junit.py
+        the libcheck-XML to JUnit-Jenkins-style-XML converter -->
+<testsuites>
+  <testsuite name="Core" timestamp="2016-05-13T21:25:43" tests="3" failures="1">
+    <testcase name="test_money_create" classname="check_money" time="0.000123"/>
+    <testcase name="test_money_neg_2" classname="check_money" time="0">
+      <error message="Amount &lt; 0 &amp; &quot;bad&quot;"/>
+    </testcase>
+    <testcase name="test_money_crash" classname="check_money" time="0"/>
+  </testsuite>
+  <testsuite name="Empty" timestamp="2016-05-13T21:25:43" tests="0" failures="0"/>
+  <testsuite name="Limits" timestamp="2016-05-13T21:25:43" tests="1" failures="0">
+    <testcase name="test_max" classname="check_limits" time="0.000007"/>
+  </testsuite>
+  <testsuite name="Other" timestamp="2016-05-14T08:00:01" tests="1" failures="1">
+    <testcase name="test_other" classname="check_other" time="0">
+      <error message="Assertion 'x == 1' failed"/>
+    </testcase>
+  </testsuite>
+</testsuites>
+'''
+
+header = '''<!-- generated by check2junit.py
+        the libcheck-XML to JUnit-Jenkins-style-XML converter -->
+'''
+
+def run(*a):
+    return subprocess.run([sys.executable, check2junit] + [str(x) for x in a],
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+def test_golden(tmp_path):
+    a = tmp_path / 'a.xml'
+    a.write_text(report_a)
+    b = tmp_path / 'b.xml'
+    b.write_text(report_b)
+    assert run(a, b).stdout == golden
+
+def test_no_reports():
+    assert run().stdout == header + '<testsuites/>\n'
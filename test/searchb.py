@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+#
+# searchb.py unittests
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import gzip
+import lzma
+import os
+import pytest
+import subprocess
+import sys
+
+src_dir = os.getenv('src_dir', os.getcwd()+'/..')
+searchb = src_dir + '/searchb.py'
+
+def run(*a, input=None):
+    return subprocess.run([sys.executable, searchb] + [str(x) for x in a],
+            stdout=subprocess.PIPE, universal_newlines=True, input=input)
+
+@pytest.fixture
+def files(tmp_path):
+    q = tmp_path / 'query'
+    q.write_bytes(b'abab')
+    t = tmp_path / 'target'
+    # i.e. overlapping matches that cross the chunk boundaries
+    t.write_bytes(b'x' * 1000 + b'ababab' + b'y' * 10 + b'abab' + b'z' * 1000)
+    return q, t
+
+@pytest.mark.parametrize('opts', ([], ['--chunk-size', '3', '-j', '2']))
+def test_first(files, opts):
+    p = run(*opts, *files)
+    assert p.returncode == 0
+    assert p.stdout == '1000\n'
+
+def test_no_match(files, tmp_path):
+    q = tmp_path / 'q2'
+    q.write_bytes(b'abc')
+    p = run(q, files[1])
+    assert p.returncode == 1
+    assert p.stdout == ''
+
+def test_empty_target(files, tmp_path):
+    t = tmp_path / 'empty'
+    t.write_bytes(b'')
+    assert run(files[0], t).returncode == 1
+
+@pytest.mark.parametrize('opts', ([], ['--chunk-size', '1001', '-j', '1'],
+    ['--chunk-size', '1001', '-j', '3'], ['--chunk-size', '3', '-j', '2']))
+def test_all(files, opts):
+    p = run('--all', *opts, *files)
+    assert p.returncode == 0
+    assert p.stdout.split() == ['1000', '1002', '1016']
+
+def test_patterns(files, tmp_path):
+    f = tmp_path / 'patterns'
+    f.write_text('# comment\n6162 6162\n\n6261\n7a7a7a\n')
+    xs = ['1000:2', '1001:4', '1002:2', '1003:4', '1016:2', '1017:4'] + [
+            f'{i}:5' for i in range(1020, 2018)]
+    p = run('--all', '--patterns', f, files[1])
+    assert p.returncode == 0
+    assert p.stdout.split() == xs
+    p = run('-f', f, files[1])
+    assert p.stdout == '1000:2\n'
+    p = run('--all', '--chunk-size', '5', '-j', '2', '-f', f, files[1])
+    assert p.stdout.split() == xs
+
+# i.e. the buffer size forces carrying over the tail several times
+@pytest.mark.parametrize('opts', ([], ['--buffer-size', '7']))
+def test_stdin(files, opts):
+    t = files[1].read_text()
+    p = run('--all', *opts, files[0], '-', input=t)
+    assert p.stdout.split() == ['1000', '1002', '1016']
+
+@pytest.mark.parametrize('compress', (gzip.compress, lzma.compress))
+def test_decompress(files, tmp_path, compress):
+    t = tmp_path / 'target.z'
+    t.write_bytes(compress(files[1].read_bytes()))
+    p = run('--all', '--decompress', '--buffer-size', '100', files[0], t)
+    assert p.stdout.split() == ['1000', '1002', '1016']
+    assert run('--all', files[0], t).returncode == 1
+
+def test_recursive(files, tmp_path):
+    d = tmp_path / 'tree'
+    (d / 'a' / 'b').mkdir(parents=True)
+    (d / 'skip').mkdir()
+    (d / 'a' / 'b' / 'x.bin').write_bytes(b'..abab')
+    (d / 'a' / 'y.txt').write_bytes(b'abab' * 100)
+    (d / 'skip' / 'z.bin').write_bytes(b'abab')
+    (d / 'a' / 'empty.bin').write_bytes(b'')
+    (d / 'a' / 'link.bin').symlink_to(files[1])
+    p = run('--recursive', '--exclude', 'skip', files[0], d)
+    assert p.returncode == 0
+    assert p.stdout.splitlines() == [f'{d}/a/b/x.bin:2', f'{d}/a/y.txt:0']
+    p = run('-ra', '--include', '*.bin', files[0], d)
+    assert p.stdout.splitlines() == [f'{d}/a/b/x.bin:2', f'{d}/skip/z.bin:0']
+    p = run('-r', '--max-size', '100', files[0], d)
+    assert p.stdout.splitlines() == [f'{d}/a/b/x.bin:2', f'{d}/skip/z.bin:0']
+    assert run(files[0], d).returncode == 2
+
+@pytest.mark.parametrize('pattern', ('62 ?? 62', '6? 61 6?', '62 41 62 / ff 0f ff'))
+def test_hex(files, pattern):
+    p = run('--all', '--hex', pattern, files[1])
+    assert p.returncode == 0
+    assert p.stdout.split() == ['1001', '1003', '1017']
+
+def test_hex_literal_offset(files):
+    p = run('--all', '--hex', '??62??', files[1])
+    assert p.stdout.split() == ['1000', '1002', '1004', '1016', '1018']
+
+def test_masked_patterns(files, tmp_path):
+    f = tmp_path / 'patterns'
+    f.write_text('79 ?? 61\n78 78 / ff f0\n')
+    p = run('--all', '-f', f, '--chunk-size', '500', '-j', '2', files[1])
+    assert p.stdout.split() == [f'{i}:2' for i in range(999)] + ['1014:1']
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+#
+# wipedev unittests
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+
+import os
+import pytest
+import struct
+import subprocess
+import sys
+
+src_dir = os.getenv('src_dir', os.getcwd()+'/..')
+wipedev = src_dir + '/wipedev.py'
+
+size = 3 * 1024 * 1024 + 4096
+
+# i.e. a regular file stands in for a block device
+@pytest.fixture
+def dev(tmp_path):
+    fn = tmp_path / 'dev.img'
+    with open(fn, 'wb') as f:
+        f.truncate(size)
+    return fn
+
+# the unaligned tail is written without O_DIRECT
+@pytest.mark.parametrize('opts', ([], ['--direct', '--depth', '3']))
+def test_wipe(dev, opts):
+    with open(dev, 'ab') as f:
+        f.truncate(size + 1000)
+    subprocess.run([sys.executable, wipedev, '--wipe', '--blocksize', str(1024 * 1024),
+        '--threads', '3', str(dev)] + opts, check=True)
+    b = dev.read_bytes()
+    assert len(b) == size + 1000
+    # i.e. random data contains a zero byte in 1 of 256 cases
+    assert b.count(0) < len(b) / 128
+    assert b[-1000:].count(0) < 1000 / 32
+
+def test_verify(dev):
+    seed = '42' * 32
+    base = [sys.executable, wipedev, '--blocksize', str(1024 * 1024), '--seed', seed]
+    subprocess.run(base + ['--wipe', '--verify', str(dev)], check=True)
+    p = subprocess.run(base + ['--verify-sample', '50', str(dev)])
+    assert p.returncode == 0
+    with open(dev, 'r+b') as f:
+        f.seek(2 * 1024 * 1024 + 23)
+        b = f.read(1)
+        f.seek(-1, 1)
+        f.write(bytes([b[0] ^ 1]))
+    p = subprocess.run(base + ['--verify', str(dev)], stderr=subprocess.PIPE,
+            universal_newlines=True)
+    assert p.returncode == 1
+    assert 'first mismatch at offset 2097175' in p.stderr
+
+# i.e. as if the first wipe was interrupted after 1 MiB
+def test_resume(dev, tmp_path):
+    ckpt = tmp_path / 'wipe.ckpt'
+    seed = '23' * 32
+    bs = 1024 * 1024
+    base = [sys.executable, wipedev, '--blocksize', str(bs), '--checkpoint', str(ckpt)]
+    subprocess.run(base + ['--wipe', '--seed', seed, str(dev)], check=True)
+    with open(dev, 'r+b') as f:
+        f.seek(bs)
+        f.write(bytes(size - bs))
+    ckpt.write_text(f'{{"dev": "{dev}", "size": {size}, "blocksize": {bs}, '
+            f'"seed": "{seed}", "offset": {bs}}}')
+    p = subprocess.run(base + ['--pre-wipe', '--wipe', '--resume', '--verify', '--json', '-',
+        '--verbose', str(dev)], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    assert p.returncode == 0
+    assert '"watermark": ' + str(size) in p.stdout
+    assert 'Erasing signatures' not in p.stderr
+    assert dev.read_bytes()[bs:].count(0) < (size - bs) / 128
+    p = subprocess.run(base + ['--wipe', '--resume', '--seed', '00' * 32, str(dev)])
+    assert p.returncode != 0
+
+# i.e. one failing device doesn't abort the others
+def test_multiple(dev, tmp_path):
+    dev2 = tmp_path / 'dev2.img'
+    dev2.write_bytes(bytes(size))
+    p = subprocess.run([sys.executable, wipedev, '--wipe', '--verify', '--blocksize', str(1024 * 1024),
+        '--parallel', '2', '--bwlimit', '1000', str(dev), str(tmp_path / 'missing.img'), str(dev2)],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    assert p.returncode == 1
+    xs = p.stdout.splitlines()
+    assert len(xs) == 4
+    assert xs[1].split()[:2] == [str(dev), 'ok']
+    assert xs[2].split()[:2] == [str(tmp_path / 'missing.img'), 'failed']
+    assert xs[3].split()[:2] == [str(dev2), 'ok']
+    for d in (dev, dev2):
+        assert d.read_bytes().count(0) < size / 128
+
+# i.e. the LUKS1 header/key-slots (payload at 2 MiB) and the signatures
+# at the start and the end are zeroed
+def test_pre_wipe_luks(dev):
+    b = bytearray(os.urandom(size))
+    b[:8] = b'LUKS\xba\xbe' + struct.pack('>H', 1)
+    b[104:108] = struct.pack('>I', 4096)
+    dev.write_bytes(b)
+    subprocess.run([sys.executable, wipedev, '--pre-wipe', '--signature-size', '4096', str(dev)],
+            check=True)
+    b = dev.read_bytes()
+    k = 2 * 1024 * 1024
+    assert b[:k].count(0) == k
+    assert b[k:-4096].count(0) < (size - k) / 128
+    assert b[-4096:].count(0) == 4096
+
+# i.e. the verify step uses the autotuned blocksize as well
+def test_autotune(dev):
+    p = subprocess.run([sys.executable, wipedev, '--wipe', '--verify', '--autotune', '--direct',
+        str(dev)], stderr=subprocess.PIPE, universal_newlines=True)
+    assert p.returncode == 0
+    assert 'Autotuned' in p.stderr
+    assert dev.read_bytes().count(0) < size / 128
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-# List all manually installed packages.
+# List all manually installed packages - of the running system or
+# of one or more root directories (e.g. mounted images, chroots).
 #
 # Supported distributions:
 #
@@ -13,17 +14,33 @@
 # 2017, Georg Sauthoff <mail@gms.tf>, GPLv3+
 
 
+import argparse
+import concurrent.futures
+import csv
 import gzip
+import hashlib
 import io
 import itertools
+import json
 import operator
 import os
 import distro
 import re
+import shlex
+import sqlite3
+import struct
 import subprocess
 import sys
+import tempfile
 import unittest.mock as mock
 
+try:
+  import tomllib
+  have_tomllib = True
+except ImportError:
+  # i.e. Python < 3.11
+  have_tomllib = False
+
 
 split_version_re = re.compile('[.+-]')
 
@@ -66,21 +83,260 @@ def test_cmp_version():
 # call e.g.: py.test-3 user-installed.py
 
 
+# i.e. an absolute path of the system below root, where symbolic links
+# are resolved relative to root (and not to the host's /), e.g. an
+# etc/os-release -> /usr/lib/os-release link
+def rooted(root, filename):
+  if root == '/':
+    return '/' + filename.lstrip('/')
+  xs = [ x for x in filename.split('/') if x ]
+  ys = []
+  links = 0
+  while xs:
+    x = xs.pop(0)
+    if x == '.':
+      continue
+    if x == '..':
+      ys = ys[:-1]
+      continue
+    p = os.path.join(root, *ys, x)
+    if not os.path.islink(p):
+      ys.append(x)
+      continue
+    links += 1
+    if links > 40:
+      raise RuntimeError(f'Too many levels of symbolic links: {p}')
+    t = os.readlink(p)
+    if t.startswith('/'):
+      ys = []
+    xs = [ y for y in t.split('/') if y ] + xs
+  return os.path.join(root, *ys)
+
+# Fedora >= 33, i.e. where the rpmdb is an SQLite database,
+# /var/lib/rpm is a (relative) symlink since Fedora 36
+rpmdb_sqlites = [ '/usr/lib/sysimage/rpm/rpmdb.sqlite',
+    '/var/lib/rpm/rpmdb.sqlite' ]
+dnf_history = '/var/lib/dnf/history.sqlite'
+# Fedora >= 41, i.e. dnf5 keeps the reasons in its system state
+dnf5_state = '/usr/lib/sysimage/libdnf5/packages.toml'
+
+RPMTAG_NAME = 1000
+RPMTAG_ARCH = 1022
+RPM_STRING_TYPE = 6
+
+# reads the string tags of an rpm header blob, i.e. the index entry
+# count and data size followed by the index entries (tag, type, offset,
+# count) and the data - only the needed parts are read
+def read_rpm_tags(f, tags):
+  il, dl = struct.unpack('>II', f.read(8))
+  es = f.read(il * 16)
+  d = {}
+  for i in range(il):
+    tag, typ, off, cnt = struct.unpack_from('>iiii', es, i * 16)
+    if tag in tags and typ == RPM_STRING_TYPE:
+      f.seek(8 + il * 16 + off)
+      d[tag] = f.read(256).split(b'\0', 1)[0].decode()
+  return d
+
+def open_sqlite(filename):
+  return sqlite3.connect(f'file:{filename}?mode=ro', uri=True)
+
+# i.e. (name, arch) pairs of the installed packages - without
+# Connection.blobopen() (Python < 3.11) the complete headers are read
+def read_rpmdb(filename):
+  con = open_sqlite(filename)
+  try:
+    ps = set()
+    if hasattr(con, 'blobopen'):
+      hs = ( con.blobopen('Packages', 'blob', hnum, readonly=True)
+          for (hnum,) in con.execute('SELECT hnum FROM Packages') )
+    else:
+      hs = ( io.BytesIO(b) for (b,) in con.execute('SELECT blob FROM Packages') )
+    for h in hs:
+      with h as f:
+        d = read_rpm_tags(f, (RPMTAG_NAME, RPMTAG_ARCH))
+      # i.e. skip the gpg-pubkey pseudo packages
+      if RPMTAG_ARCH in d:
+        ps.add((d[RPMTAG_NAME], d[RPMTAG_ARCH]))
+    return ps
+  finally:
+    con.close()
+
+# cf. TransactionItemAction/TransactionItemReason in libdnf
+DNF_REMOVE = 8
+DNF_REASON_UNKNOWN = 0
+DNF_REASON_USER = 2
+
+# Returns the last reason of each (name, arch) - similar to what
+# libdnf's resolveTransactionItemReason() looks up for each package,
+# i.e. the replaced side of upgrades etc. (downgraded, obsoleted,
+# upgraded, reinstalled) is ignored and a removal resets the reason.
+def read_dnf_reasons(filename):
+  con = open_sqlite(filename)
+  try:
+    d = {}
+    for name, arch, action, reason in con.execute('''SELECT i.name, i.arch,
+          ti.action, ti.reason
+        FROM trans_item ti
+        JOIN trans t ON ti.trans_id = t.id
+        JOIN rpm i USING (item_id)
+        WHERE t.state = 1 AND ti.action NOT IN (3, 5, 7, 10)
+        ORDER BY ti.trans_id, ti.id'''):
+      d[(name, arch)] = DNF_REASON_UNKNOWN if action == DNF_REMOVE else reason
+    return d
+  finally:
+    con.close()
+
+# i.e. packages."NAME.ARCH".reason = "User"|"Dependency"|...
+def read_dnf5_reasons(filename):
+  with open(filename, 'rb') as f:
+    d = tomllib.load(f)
+  rs = { 'None': DNF_REASON_UNKNOWN, 'External User': DNF_REASON_UNKNOWN,
+      'User': DNF_REASON_USER }
+  return { tuple(k.rsplit('.', 1)): rs.get(v.get('reason'), -1)
+      for k, v in d.get('packages', {}).items() }
+
+# i.e. like dnf's iter_userinstalled(): a package without known reason
+# was most likely installed with rpm, thus, it's user-installed, as well
+def get_rpm_userinstalled(rpmdb, history, state=None):
+  ps = read_rpmdb(rpmdb)
+  if state and os.path.exists(state):
+    rs = read_dnf5_reasons(state)
+  elif os.path.exists(history):
+    rs = read_dnf_reasons(history)
+  else:
+    rs = {}
+  return [ name for name, arch in ps
+      if rs.get((name, arch), DNF_REASON_UNKNOWN)
+          in (DNF_REASON_UNKNOWN, DNF_REASON_USER) ]
+
+def get_dnf_userinstalled(root='/'):
+  import dnf
+  b = dnf.Base()
+  if root != '/':
+    b.conf.installroot = root
+  b.fill_sack();
+  return [ x.name for x in b.iter_userinstalled() ]
+
 # For Fedora >= 26 this functionality is also available via the dnf command:
 # dnf repoquery --qf '%{name}' --userinstalled \
 #    | grep -v -- '-debuginfo$' \
 #    | grep -v '^\(kernel-modules\|kernel\|kernel-core\|kernel-devel\)$'
 # Fedora >= 23
 # cf. http://unix.stackexchange.com/questions/82880/how-to-replicate-installed-package-selection-from-one-fedora-instance-to-another/82882#82882
-def list_fedora():
-  import dnf
-  b = dnf.Base()
-  b.fill_sack();
-  l = sorted(set(x.name for x in b.iter_userinstalled()
-       if not x.name.endswith("-debuginfo") \
-          and x.name not in \
+#
+# With an SQLite rpmdb, it and the dnf history are read directly,
+# otherwise (e.g. Berkeley DB on RHEL 8) dnf is used - as well as
+# for the dnf5 state when tomllib isn't available.
+def list_fedora(root='/'):
+  rpmdb = next((fn for fn in (rooted(root, x) for x in rpmdb_sqlites)
+      if os.path.exists(fn)), None)
+  if rpmdb and (have_tomllib or not os.path.exists(rooted(root, dnf5_state))):
+    ns = get_rpm_userinstalled(rpmdb, rooted(root, dnf_history),
+        rooted(root, dnf5_state))
+  else:
+    ns = get_dnf_userinstalled(root)
+  l = sorted(set(x for x in ns
+       if not x.endswith("-debuginfo") \
+          and x not in \
              ["kernel-modules", "kernel", "kernel-core", "kernel-devel"] ))
-  print("\n".join(l))
+  return l
+
+def mk_rpm_header(tags):
+  es = b''
+  data = b''
+  for tag, s in tags.items():
+    es += struct.pack('>iiii', tag, RPM_STRING_TYPE, len(data), 1)
+    data += s.encode() + b'\0'
+  return struct.pack('>II', len(tags), len(data)) + es + data
+
+def test_read_rpmdb(tmp_path):
+  fn = str(tmp_path / 'rpmdb.sqlite')
+  con = sqlite3.connect(fn)
+  con.execute('CREATE TABLE Packages (hnum INTEGER PRIMARY KEY AUTOINCREMENT,'
+      ' blob BLOB NOT NULL)')
+  for tags in ({ RPMTAG_NAME: 'zsh', 1001: '5.9', RPMTAG_ARCH: 'x86_64' },
+      { RPMTAG_NAME: 'gpg-pubkey', 1001: '8d1e' },
+      { RPMTAG_NAME: 'glibc', RPMTAG_ARCH: 'i686' }):
+    con.execute('INSERT INTO Packages (blob) VALUES (?)', (mk_rpm_header(tags),))
+  con.commit()
+  con.close()
+  assert read_rpmdb(fn) == { ('zsh', 'x86_64'), ('glibc', 'i686') }
+  # i.e. Python < 3.11
+  class Con:
+    def __init__(self, filename):
+      self.con = sqlite3.connect(filename)
+    def execute(self, *a):
+      return self.con.execute(*a)
+    def close(self):
+      self.con.close()
+  with mock.patch.dict(globals(), {'open_sqlite': Con}):
+    assert read_rpmdb(fn) == { ('zsh', 'x86_64'), ('glibc', 'i686') }
+
+def mk_dnf_history(filename, rows):
+  con = sqlite3.connect(filename)
+  con.executescript('''
+    CREATE TABLE trans (id INTEGER PRIMARY KEY, state INTEGER);
+    CREATE TABLE rpm (item_id INTEGER PRIMARY KEY, name TEXT, arch TEXT);
+    CREATE TABLE trans_item (id INTEGER PRIMARY KEY, trans_id INTEGER,
+      item_id INTEGER, action INTEGER, reason INTEGER);''')
+  items = {}
+  for trans_id, state, name, arch, action, reason in rows:
+    con.execute('INSERT OR IGNORE INTO trans VALUES (?, ?)', (trans_id, state))
+    if (name, arch) not in items:
+      items[(name, arch)] = len(items) + 1
+      con.execute('INSERT INTO rpm VALUES (?, ?, ?)',
+          (items[(name, arch)], name, arch))
+    con.execute('INSERT INTO trans_item (trans_id, item_id, action, reason)'
+        ' VALUES (?, ?, ?, ?)', (trans_id, items[(name, arch)], action, reason))
+  con.commit()
+  con.close()
+
+def test_get_rpm_userinstalled(tmp_path):
+  rpmdb = str(tmp_path / 'rpmdb.sqlite')
+  con = sqlite3.connect(rpmdb)
+  con.execute('CREATE TABLE Packages (hnum INTEGER PRIMARY KEY, blob BLOB)')
+  for name in ('bash', 'vim', 'zsh', 'kernel', 'foo-debuginfo', 'curl', 'git'):
+    con.execute('INSERT INTO Packages (blob) VALUES (?)',
+        (mk_rpm_header({ RPMTAG_NAME: name, RPMTAG_ARCH: 'x86_64' }),))
+  con.commit()
+  con.close()
+  history = str(tmp_path / 'history.sqlite')
+  mk_dnf_history(history, [
+      # trans, state, name, arch, action, reason
+      (1, 1, 'bash', 'x86_64', 1, 1),
+      (1, 1, 'vim', 'x86_64', 1, 2),
+      (1, 1, 'curl', 'x86_64', 1, 2),
+      (1, 1, 'kernel', 'x86_64', 1, 2),
+      (1, 1, 'foo-debuginfo', 'x86_64', 1, 2),
+      # i.e. upgraded side of an upgrade
+      (2, 1, 'vim', 'x86_64', 7, 1),
+      (2, 1, 'vim', 'x86_64', 6, 2),
+      # reason change to dependency
+      (3, 1, 'curl', 'x86_64', 11, 1),
+      # failed transaction
+      (4, 2, 'bash', 'x86_64', 11, 2),
+      (5, 1, 'git', 'x86_64', 1, 1),
+      (6, 1, 'git', 'x86_64', 8, 1),
+      ])
+  assert sorted(get_rpm_userinstalled(rpmdb, history)) == [ 'foo-debuginfo',
+      'git', 'kernel', 'vim', 'zsh' ]
+  state = tmp_path / 'packages.toml'
+  state.write_text('''version = "1.0"
+[packages]
+"zsh.x86_64" = {reason = "Dependency"}
+"git.x86_64" = {reason = "User"}
+"vim.x86_64" = {reason = "External User"}
+''')
+  assert sorted(get_rpm_userinstalled(rpmdb, history, str(state))) == [
+      'bash', 'curl', 'foo-debuginfo', 'git', 'kernel', 'vim' ]
+  with mock.patch.dict(globals(), { 'rpmdb_sqlites': [ rpmdb ],
+        'dnf_history': history, 'dnf5_state': str(tmp_path / 'none') }), \
+       mock.patch('distro.id', lambda : 'fedora'), \
+       mock.patch('distro.version', lambda : '39'), \
+       mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+    main() # calls list_fedora()
+    assert fake_out.getvalue() == 'git\nvim\nzsh\n'
 
 def test_list_fedora():
   f_distro_id = lambda : 'fedora'
@@ -95,21 +351,46 @@ def test_list_fedora():
   # yes, we are mocking the local import of dnf
   with mock.patch('distro.id', f_distro_id), \
        mock.patch('distro.version', f_distro_version), \
+       mock.patch.dict(globals(), {'rpmdb_sqlites': []}), \
        mock.patch.dict('sys.modules', {'dnf': f_dnf}), \
        mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
     main() # calls list_fedora()
     assert fake_out.getvalue() == 'vim\nzsh\n'
 
 
-# cf. http://unix.stackexchange.com/questions/82880/how-to-replicate-installed-package-selection-from-one-fedora-instance-to-another/82882#82882
-def list_centos():
+yumdb_dir = '/var/lib/yum/yumdb'
+
+def read_file(filename, default=''):
+  try:
+    with open(filename) as f:
+      return f.read().strip()
+  except FileNotFoundError:
+    return default
+
+# i.e. what repoquery reports for yumdb_info, the yumdb contains a
+# directory for each installed package (FIRST/PKGID-NAME-VERSION-RELEASE-ARCH)
+# that contains a file for each key
+def read_yumdb(dirname):
+  for fn in os.listdir(dirname):
+    for pkg in os.listdir(dirname + '/' + fn):
+      d = f'{dirname}/{fn}/{pkg}'
+      yield (pkg.split('-', 1)[1].rsplit('-', 3)[0], read_file(d + '/reason'),
+          read_file(d + '/installed_by'))
+
+def get_repoquery(root='/'):
   rq = subprocess.check_output(['repoquery', '--installed',
     '--qf', '%{n},%{yumdb_info.reason},%{yumdb_info.installed_by}', '--all']
+    + ([ '--installroot', root ] if root != '/' else [])
     ).decode()
-  ps = [ row[0] for row in (line.split(',') for line in rq.splitlines())
+  return [ line.split(',') for line in rq.splitlines() ]
+
+# cf. http://unix.stackexchange.com/questions/82880/how-to-replicate-installed-package-selection-from-one-fedora-instance-to-another/82882#82882
+def list_centos(root='/'):
+  d = rooted(root, yumdb_dir)
+  rows = read_yumdb(d) if os.path.isdir(d) else get_repoquery(root)
+  ps = [ row[0] for row in rows
            if row[1] == 'user' and row[2] != '4294967295' ]
-  for p in map(operator.itemgetter(0), itertools.groupby(sorted(ps))):
-    print(p)
+  return list(map(operator.itemgetter(0), itertools.groupby(sorted(ps))))
 
 
 def test_list_centos(name='centos'):
@@ -126,6 +407,7 @@ zsh,user,1000''')
   with mock.patch('distro.id', f_distro_id), \
        mock.patch('distro.version', f_distro_version), \
        mock.patch('subprocess.check_output', f_check_output), \
+       mock.patch.dict(globals(), {'yumdb_dir': '/nonexistent'}), \
        mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
     main() # calls list_centos
   assert fake_out.getvalue() == 'time\nyum-cron\nzsh\n'
@@ -133,19 +415,56 @@ zsh,user,1000''')
 def test_list_rhel(name='rhel'):
   test_list_centos(name)
 
+def test_read_yumdb(tmp_path):
+  for pkg, reason, installed_by in [
+      ('z/0d3f-zsh-5.0.2-34.el7_8.2-x86_64', 'user', '1000'),
+      ('y/a1b2-yum-utils-1.1.31-54.el7_8-noarch', 'dep', '0'),
+      ('y/c3d4-yum-cron-3.4.3-168.el7.centos-noarch', 'user', None) ]:
+    d = tmp_path / pkg
+    d.mkdir(parents=True)
+    (d / 'reason').write_text(reason)
+    if installed_by:
+      (d / 'installed_by').write_text(installed_by)
+  assert sorted(read_yumdb(str(tmp_path))) == [ ('yum-cron', 'user', ''),
+      ('yum-utils', 'dep', '0'), ('zsh', 'user', '1000') ]
+
+# i.e. yields the selected fields of each stanza of a deb822 style
+# file such as /var/lib/dpkg/status, continuation lines are skipped
+def parse_stanzas(lines, fields):
+  d = {}
+  for line in lines:
+    if not line.strip():
+      if d:
+        yield d
+        d = {}
+    elif line[0] not in ' \t':
+      k, _, v = line.partition(':')
+      if k in fields:
+        d[k] = v.strip()
+  if d:
+    yield d
+
+def test_parse_stanzas():
+  xs = list(parse_stanzas('''Package: vim
+Status: install ok installed
+Description: Vi IMproved
+ Package: not-a-package
+ .
+
+Package: zsh
+Status: deinstall ok config-files
+'''.splitlines(True), ('Package', 'Status')))
+  assert xs == [ { 'Package': 'vim', 'Status': 'install ok installed' },
+      { 'Package': 'zsh', 'Status': 'deinstall ok config-files' } ]
+
 # i.e. lines from files/usr/var/lib/apt/extended_states
 # thus should be similar to what e.g. apt-mark showmanual does
 # (apt-mark is not available on termux)
 # cf. http://askubuntu.com/questions/2389/generating-list-of-manually-installed-packages-and-querying-individual-packages
 def parse_auto_installed(lines):
-  ps = set()
-  package = None
-  for line in lines:
-    if line.startswith('Package: '):
-      package = line[9:]
-    elif line.startswith('Auto-Installed: 1'):
-      ps.add(package)
-  return ps
+  return set(d['Package'] for d in
+      parse_stanzas(lines, ('Package', 'Auto-Installed'))
+      if d.get('Auto-Installed') == '1')
 
 def test_parse_auto_installed():
   s = parse_auto_installed('''Package: libgcc
@@ -214,9 +533,8 @@ def list_termux():
     # when line comes from open() it has a trailing newline that we strip
     auto_installed = parse_auto_installed(map(lambda line : line[:-1],  es))
     selections = get_selections(ss)
-    for s in selections:
-      if s not in auto_installed and s not in default_termux_pkgs:
-        print(s)
+    return [ s for s in selections
+        if s not in auto_installed and s not in default_termux_pkgs ]
 
 def takefind(f, g):
   for i in g:
@@ -260,6 +578,98 @@ def dpkg_log_lines(dirname='/var/log'):
       for line in f:
         yield line
 
+dpkg_log_re = re.compile('^[^ ]+ [^ ]+ (install|remove) ')
+
+# i.e. package -> True if its last action is install, False if it's remove
+def parse_dpkg_log(lines):
+  d = {}
+  for line in filter(dpkg_log_re.match, lines):
+    (action, p) = line.split(' ')[2:4]
+    d[p.split(':')[0]] = action == 'install'
+  return d
+
+def apply_dpkg_actions(ps, d):
+  for p, installed in d.items():
+    if installed:
+      ps.add(p)
+    else:
+      ps.discard(p)
+
+# returns the actions and the offset after the last complete line,
+# i.e. a partially written line is read again, next time
+def read_dpkg_log(filename, offset=0):
+  ofn = gzip.open if filename.endswith('.gz') else open;
+  with ofn(filename, 'rb') as f:
+    f.seek(offset)
+    b = f.read()
+  n = b.rfind(b'\n') + 1
+  return parse_dpkg_log(b[:n].decode(errors='replace').splitlines()), offset + n
+
+# i.e. to detect a re-used inode number
+def read_head(filename, n=64):
+  with open(filename, 'rb') as f:
+    return f.read(n).decode('latin-1')
+
+dpkg_log_cache = os.path.join(os.getenv('XDG_CACHE_HOME',
+    os.path.expanduser('~/.cache')), 'user-installed', 'dpkg-log.json')
+
+# i.e. inode -> { size, mtime, offset, head, actions }
+def load_dpkg_log_cache(filename, dirname):
+  try:
+    with open(filename) as f:
+      d = json.load(f)
+    if d.get('dirname') != dirname:
+      return {}
+    return { e['ino']: e for e in d['files'] }
+  except (OSError, ValueError, KeyError, TypeError):
+    return {}
+
+def save_dpkg_log_cache(filename, dirname, es):
+  try:
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(filename),
+        delete=False) as f:
+      json.dump({ 'dirname': dirname, 'files': es }, f)
+    os.replace(f.name, filename)
+  except OSError:
+    pass # e.g. read-only home, the next run just parses everything again
+
+# Unchanged logs (identified by inode, size and mtime - thus, rotating
+# dpkg.log to dpkg.log.1 is a hit, as well) aren't read again and
+# appended ones are read from the last offset. The remaining ones
+# (i.e. usually just the newly compressed rotation) are parsed by a
+# process pool.
+def get_dpkg_log_actions(dirname, cache_file):
+  cache = load_dpkg_log_cache(cache_file, dirname)
+  es = []
+  jobs = []
+  for fn in dpkg_log_names(dirname):
+    filename = dirname + '/' + fn
+    st = os.stat(filename)
+    e = cache.get(st.st_ino)
+    plain = not fn.endswith('.gz')
+    if e and e['size'] == st.st_size and e['mtime'] == st.st_mtime_ns:
+      pass
+    elif e and plain and e['head'] is not None and e['offset'] <= st.st_size \
+        and read_head(filename, len(e['head'])) == e['head']:
+      jobs.append((e, filename, e['offset']))
+    else:
+      e = { 'ino': st.st_ino, 'offset': 0, 'actions': {},
+          'head': read_head(filename) if plain else None }
+      jobs.append((e, filename, 0))
+    e['size'], e['mtime'] = st.st_size, st.st_mtime_ns
+    es.append(e)
+  if len(jobs) > 1:
+    with concurrent.futures.ProcessPoolExecutor() as ex:
+      rs = list(ex.map(read_dpkg_log, *zip(*[ job[1:] for job in jobs ])))
+  else:
+    rs = [ read_dpkg_log(*job[1:]) for job in jobs ]
+  for (e, _, _), (d, offset) in zip(jobs, rs):
+    e['actions'].update(d)
+    e['offset'] = offset
+  save_dpkg_log_cache(cache_file, dirname, es)
+  return [ e['actions'] for e in es ]
+
 # kind of complement to /var/log/installer/initial-status.gz
 # note that dpkg.log* is rotated, by default
 # (montly, 12 times), thus this is not sufficient after 1 year
@@ -267,67 +677,120 @@ def dpkg_log_lines(dirname='/var/log'):
 # i.e. /var/log/dpkg.log* - grepping for 'install|remove' there
 # yields all packages that are installed after sys-creation (i.e.
 # inner join with apt-mark showmanual)
-def get_dpkg_installed(dirname='/var/log'):
+def get_dpkg_installed(dirname='/var/log', cache_file=None):
   ps = set()
-  expr = re.compile('^[^ ]+ [^ ]+ (install|remove) ')
-  for line in filter(expr.match, dpkg_log_lines(dirname)):
-    (action, p) = line.split(' ')[2:4]
-    p = p.split(':')[0]
-    if action == 'install':
-      ps.add(p)
-    else:
-      ps.discard(p)
+  if cache_file:
+    for d in get_dpkg_log_actions(dirname, cache_file):
+      apply_dpkg_actions(ps, d)
+  else:
+    apply_dpkg_actions(ps, parse_dpkg_log(dpkg_log_lines(dirname)))
   return ps
 
-# - in contrast to termux: debian has `apt-mark showmanual`, i.e.
-# we don't need to parse extended_states ourselves
+def test_get_dpkg_installed_cache(tmp_path):
+  d = tmp_path / 'log'
+  d.mkdir()
+  cache_file = str(tmp_path / 'cache' / 'dpkg-log.json')
+  with gzip.open(d / 'dpkg.log.2.gz', 'wt') as f:
+    f.write('2017-01-22 17:44:14 install a:amd64 <none> 1\n'
+            '2017-01-22 17:44:15 install b:amd64 <none> 1\n')
+  (d / 'dpkg.log.1').write_text('2017-02-01 10:00:00 remove a:amd64 1 <none>\n'
+      '2017-02-01 10:00:01 install c:amd64 <none> 1\n')
+  (d / 'dpkg.log').write_text('2017-03-01 10:00:00 install d:amd64 <none> 1\n')
+  def check(xs):
+    assert get_dpkg_installed(str(d), cache_file) == set(xs)
+    assert get_dpkg_installed(str(d)) == set(xs)
+  check('bcd')
+  # i.e. the unchanged logs aren't read again
+  with mock.patch('gzip.open', mock.Mock(side_effect=AssertionError)):
+    with open(d / 'dpkg.log', 'a') as f:
+      f.write('2017-03-02 10:00:00 remove b:amd64 1 <none>\n')
+    assert get_dpkg_installed(str(d), cache_file) == set('cd')
+  # rotate
+  os.rename(d / 'dpkg.log.2.gz', d / 'dpkg.log.3.gz')
+  with gzip.open(d / 'dpkg.log.2.gz', 'wb') as f:
+    f.write((d / 'dpkg.log.1').read_bytes())
+  os.rename(d / 'dpkg.log', d / 'dpkg.log.1')
+  (d / 'dpkg.log').write_text('2017-04-01 10:00:00 install e:amd64 <none> 1\n')
+  check('cde')
+
+dpkg_status = '/var/lib/dpkg/status'
+apt_extended_states = '/var/lib/apt/extended_states'
+dpkg_log_dir = '/var/log'
+
+# i.e. packages that have a current version, like what apt considers
+# as installed
+def read_dpkg_status(filename):
+  with open(filename) as f:
+    return set(d['Package'] for d in
+        parse_stanzas(f, ('Package', 'Status'))
+        if d.get('Status', '').split(' ')[-1]
+            not in ('not-installed', 'config-files'))
+
+# i.e. what `apt-mark showmanual` prints - although, with foreign
+# architectures, a package counts as auto-installed if any of its
+# architectures is marked as such
+def get_apt_manual(status, extended_states):
+  ps = read_dpkg_status(status)
+  if os.path.exists(extended_states):
+    with open(extended_states) as f:
+      ps -= parse_auto_installed(f)
+  return sorted(ps)
+
 # - similar to termux: there are installations without
 # /var/log/installer/initial-status.gz (debian/ubuntu)
 # - /var/log/apt/history.log gets also rotated away and takes a
 # bit more effort to parse
-def list_debian():
-  ms = subprocess.check_output(['apt-mark', 'showmanual']).decode() \
-      .splitlines()
-  ds = get_dpkg_installed()
-  for p in ms:
-    if p in ds:
-      print(p)
-
-def test_list_debian(dname='debian'):
+def list_debian(root='/'):
+  ms = get_apt_manual(rooted(root, dpkg_status),
+      rooted(root, apt_extended_states))
+  cache_file = dpkg_log_cache
+  # i.e. one cache per root, such that roots can be processed in parallel
+  if cache_file and root != '/':
+    cache_file = '{}-{}.json'.format(cache_file[:-5],
+        hashlib.sha1(root.encode()).hexdigest()[:16])
+  ds = get_dpkg_installed(rooted(root, dpkg_log_dir), cache_file)
+  return [ p for p in ms if p in ds ]
+
+def test_list_debian(tmp_path, dname='debian'):
   f_distro_id = lambda : dname
   f_distro_version = lambda : ''
-  def f_check_output(*args, **kargs):
-    return b'''acl
-apt
-grub-common
-curl
-vim
-'''
-  #f_listdir = lambda x : [ 'acl:amd64.list', 'apt.list', 'e',
-  #    'grub-common.list', 'curl.list', 'd' ]
-  f_listdir = lambda x : [ 'dpkg.log' ]
-  # mock.patch('os.path.getmtime', F_Getmtime()),
-  class F_Getmtime:
-    def __init__(self):
-      self.l = range(10).__iter__()
-    def __call__(self, fn):
-      return next(self.l)
-  f_open = mock_open(read_data='''2017-01-22 17:44:14 install make:amd64 <none> 3.81-8.2ubuntu3
+  status = tmp_path / 'status'
+  status.write_text(''.join(f'''Package: {p}
+Status: {st}
+Architecture: amd64
+Description: dummy
+ with continuation
+
+''' for p, st in [ ('acl', 'install ok installed'),
+      ('apt', 'install ok installed'), ('grub-common', 'hold ok installed'),
+      ('curl', 'install ok installed'), ('make', 'deinstall ok config-files'),
+      ('vim', 'install ok installed') ]))
+  extended_states = tmp_path / 'extended_states'
+  extended_states.write_text('''Package: apt
+Architecture: amd64
+Auto-Installed: 1
+
+Package: curl
+Architecture: amd64
+Auto-Installed: 0
+''')
+  (tmp_path / 'dpkg.log').write_text('''2017-01-22 17:44:14 install make:amd64 <none> 3.81-8.2ubuntu3
 2017-01-22 17:44:31 remove make:amd64 3.81-8.2ubuntu3 <none>
+2017-01-22 17:48:06 install apt foo bar
 2017-01-22 17:48:06 install curl foo bar
 2017-01-22 17:48:06 install vim foo bar
 ''')
   with mock.patch('distro.id', f_distro_id), \
        mock.patch('distro.version', f_distro_version), \
-       mock.patch('subprocess.check_output', f_check_output), \
-       mock.patch('os.listdir', f_listdir), \
-       mock.patch('builtins.open', f_open), \
+       mock.patch.dict(globals(), {'dpkg_status': str(status),
+         'apt_extended_states': str(extended_states),
+         'dpkg_log_dir': str(tmp_path), 'dpkg_log_cache': None}), \
        mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
     main() # calls list_debian()
     assert fake_out.getvalue() == 'curl\nvim\n'
 
-def test_list_ubuntu():
-  test_list_debian('ubuntu')
+def test_list_ubuntu(tmp_path):
+  test_list_debian(tmp_path, 'ubuntu')
 
 # work-around bug:
 # http://bugs.python.org/issue21258
@@ -380,24 +843,186 @@ list_fn = {
     ,'ubuntu': list_debian
     }
 
-def main():
-  dname, version = distro.id(), distro.version()
+def list_packages(dname, version, root='/'):
+  fn = list_fn.get(dname)
+  if fn == list_centos and LooseVersion(version) >= LooseVersion('8.0'):
+    fn = list_fedora
+  elif fn == list_fedora and LooseVersion(version) < LooseVersion('23'):
+    fn = list_centos
+  if not fn:
+    raise RuntimeError(f'Unknown system (distribution: {dname})')
+  return fn(root)
+
+def read_os_release(root):
+  for fn in ('etc/os-release', 'usr/lib/os-release'):
+    try:
+      with open(rooted(root, fn)) as f:
+        lines = f.read().splitlines()
+      break
+    except FileNotFoundError:
+      pass
+  else:
+    raise RuntimeError(f'No os-release found in {root}')
+  d = {}
+  for line in lines:
+    k, sep, v = line.partition('=')
+    if sep and not k.startswith('#'):
+      d[k.strip()] = ' '.join(shlex.split(v))
+  return d
+
+# i.e. derivatives (e.g. Rocky, Linux Mint) are detected via ID_LIKE
+def get_distribution(root):
+  d = read_os_release(root)
+  dname = d.get('ID', '')
+  if dname not in list_fn:
+    dname = next((x for x in d.get('ID_LIKE', '').split() if x in list_fn),
+        dname)
+  return dname, d.get('VERSION_ID', '')
+
+# i.e. returns (root, packages, error) such that a broken root doesn't
+# abort the inventory of the others
+def inventory_root(root):
   try:
-    fn = list_fn[dname]
-    if fn == list_centos and LooseVersion(version) >= LooseVersion('8.0'):
-      list_fedora()
-    elif fn == list_fedora and LooseVersion(version) < LooseVersion('23'):
-      list_centos()
-    else:
-      fn()
-  except KeyError:
-    if os.path.exists('/data/data/com.termux'):
-      list_termux()
-    else:
-      raise RuntimeError(f'Unknown system (distribution: {dname})')
+    dname, version = get_distribution(root)
+    return root, list_packages(dname, version, root), None
+  except Exception as e:
+    return root, [], f'{type(e).__name__}: {e}'
+
+def inventory(roots, jobs):
+  if jobs == 1 or len(roots) == 1:
+    return list(map(inventory_root, roots))
+  with concurrent.futures.ProcessPoolExecutor(jobs) as ex:
+    return list(ex.map(inventory_root, roots))
+
+def print_table(rs):
+  ss = [ set(xs) for _, xs, _ in rs ]
+  w = csv.writer(sys.stdout, lineterminator='\n')
+  w.writerow(['package'] + [ root for root, _, _ in rs ])
+  for p in sorted(set().union(*ss)):
+    w.writerow([p] + [ 'x' if p in s else '' for s in ss ])
+
+# returns the number of roots that differ from the reference
+def print_diff(ref, rs):
+  a = set(ref[1])
+  n = 0
+  for root, xs, _ in rs:
+    b = set(xs)
+    if root == ref[0] or a == b:
+      continue
+    n += 1
+    print(f'--- {ref[0]}')
+    print(f'+++ {root}')
+    for p in sorted(a ^ b):
+      print(('+' if p in b else '-') + p)
+  return n
+
+def parse_args(argv):
+  p = argparse.ArgumentParser(
+      description='List all manually installed packages',
+      epilog='''Without ROOT, the running system is inventoried. Otherwise,
+      the distribution of each root is detected from its os-release and
+      the roots are processed by a pool of worker processes. With multiple
+      roots, a table of all packages is printed, with --diff, just the
+      differences of each root to the reference root. Exit status is 1 if
+      there are differences and 2 if a root couldn't be inventoried.''')
+  p.add_argument('roots', metavar='ROOT', nargs='*',
+      help='root directory of a system, e.g. a mounted image or a chroot')
+  p.add_argument('--diff', '-d', metavar='ROOT',
+      help='print the differences to this reference root')
+  p.add_argument('--jobs', '-j', type=int, default=os.cpu_count(),
+      help='number of worker processes (default: %(default)s)')
+  args = p.parse_args(argv)
+  args.roots = [ os.path.abspath(x) for x in args.roots ]
+  if args.diff:
+    args.diff = os.path.abspath(args.diff)
+    if args.diff not in args.roots:
+      args.roots.insert(0, args.diff)
+  return args
+
+def main_roots(args):
+  rs = inventory(args.roots, args.jobs)
+  for root, _, e in rs:
+    if e:
+      print(f'{root}: {e}', file=sys.stderr)
+  ok = [ r for r in rs if not r[2] ]
+  rc = 2 if len(ok) != len(rs) else 0
+  if args.diff:
+    ref = next((r for r in ok if r[0] == args.diff), None)
+    if ref and print_diff(ref, ok) and not rc:
+      rc = 1
+  elif len(args.roots) == 1:
+    for _, xs, _ in ok:
+      for p in xs:
+        print(p)
+  elif ok:
+    print_table(ok)
+  return rc
+
+def main(argv=()):
+  args = parse_args(argv)
+  if args.roots:
+    return main_roots(args)
+  dname, version = distro.id(), distro.version()
+  if dname not in list_fn and os.path.exists('/data/data/com.termux'):
+    ps = list_termux()
+  else:
+    ps = list_packages(dname, version)
+  for p in ps:
+    print(p)
   return 0
-  
+
+def mk_debian_root(d, manual, auto):
+  (d / 'etc').mkdir(parents=True)
+  (d / 'etc' / 'os-release').write_text('NAME="Linux Mint"\nID=linuxmint\n'
+      'ID_LIKE="ubuntu debian"\nVERSION_ID="21.3"\n')
+  (d / 'var' / 'lib' / 'dpkg').mkdir(parents=True)
+  (d / 'var' / 'lib' / 'dpkg' / 'status').write_text(''.join(
+      f'Package: {p}\nStatus: install ok installed\n\n' for p in manual + auto))
+  (d / 'var' / 'lib' / 'apt').mkdir(parents=True)
+  (d / 'var' / 'lib' / 'apt' / 'extended_states').write_text(''.join(
+      f'Package: {p}\nAuto-Installed: 1\n\n' for p in auto))
+  (d / 'var' / 'log').mkdir(parents=True)
+  (d / 'var' / 'log' / 'dpkg.log').write_text(''.join(
+      f'2017-01-22 17:48:06 install {p}:amd64 <none> 1\n' for p in manual + auto))
+  return str(d)
+
+def test_read_os_release(tmp_path):
+  (tmp_path / 'etc').mkdir()
+  (tmp_path / 'usr' / 'lib').mkdir(parents=True)
+  (tmp_path / 'usr' / 'lib' / 'os-release').write_text('ID=target\n')
+  (tmp_path / 'etc' / 'os-release').symlink_to('/usr/lib/os-release')
+  assert read_os_release(str(tmp_path)) == { 'ID': 'target' }
+  (tmp_path / 'etc' / 'os-release').unlink()
+  (tmp_path / 'etc' / 'os-release').symlink_to('../../../etc/../usr/lib/./os-release')
+  assert read_os_release(str(tmp_path)) == { 'ID': 'target' }
+  (tmp_path / 'etc' / 'loop').symlink_to('/etc/loop')
+  try:
+    rooted(str(tmp_path), '/etc/loop')
+    assert False
+  except RuntimeError:
+    pass
+
+def test_main_roots(tmp_path):
+  a = mk_debian_root(tmp_path / 'a', ['curl', 'vim'], ['libc6'])
+  b = mk_debian_root(tmp_path / 'b', ['vim', 'zsh'], ['curl'])
+  c = tmp_path / 'c'
+  c.mkdir()
+  with mock.patch.dict(globals(), {'dpkg_log_cache': None}), \
+       mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+    assert main(['-j', '2', a, b]) == 0
+    assert fake_out.getvalue() == f'package,{a},{b}\ncurl,x,\nvim,x,x\nzsh,,x\n'
+  with mock.patch.dict(globals(), {'dpkg_log_cache': None}), \
+       mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+    assert main(['--diff', a, b, a]) == 1
+    assert fake_out.getvalue() == f'--- {a}\n+++ {b}\n-curl\n+zsh\n'
+  with mock.patch.dict(globals(), {'dpkg_log_cache': None}), \
+       mock.patch('sys.stderr', new=io.StringIO()) as fake_err, \
+       mock.patch('sys.stdout', new=io.StringIO()) as fake_out:
+    assert main([b, str(c)]) == 2
+    assert fake_out.getvalue() == f'package,{b}\nvim,x\nzsh,x\n'
+    assert 'No os-release' in fake_err.getvalue()
+
 
 if __name__ == '__main__':
-  sys.exit(main())
+  sys.exit(main(sys.argv[1:]))
 
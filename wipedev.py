@@ -4,18 +4,37 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 
 import argparse
+import concurrent.futures
+import copy
+import errno
 import fcntl
+import datetime
+import hmac
+import json
 import logging
+import mmap
 import os
+import queue
 import random
 import stat
 import struct
-import subprocess
 import sys
+import threading
+import time
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    have_cryptography = True
+except ImportError:
+    have_cryptography = False
 
 
 log = logging.getLogger(__name__)
 
+# set on interruption when several devices are wiped in parallel, i.e.
+# to stop all the device threads
+interrupt = threading.Event()
+
 def parse_args(*a):
     p = argparse.ArgumentParser(
             formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -31,6 +50,14 @@ The pre-wipe step just removes all filesystem, LUKS-encrypted
 volume, partition table (etc.) signatures and invokes the drive's
 DISCARD command.
 
+The signatures are located via sysfs (partitions) and the
+udev database, LUKS key-slots (and header) are zeroed and the
+DISCARD (cf. `--secure`) is issued via ioctl in chunks (cf.
+`--discard-chunk`), i.e. with progress reporting. Devices that
+support write-zeroes offload (cf. `write_zeroes_max_bytes` in
+sysfs) can also be zeroed out quickly (cf. `--zero`), e.g. before
+the post-wipe step.
+
 Although the main wipe step overwrites everything, the pre-wipe
 step gives some protection in case the main wipe step doesn't
 complete for some reason. Such as when your device finally dies
@@ -54,6 +81,63 @@ DISCARD followed by a full device write followed by a DISCARD
 arguably minimizes the chances that an adversary might extract
 any useful from that device, anymore.
 
+The random data is generated by a pool of threads (cf. `--threads`)
+that fill a fixed set of reusable buffers which are handed to the
+writer via a bounded queue. If the cryptography package is available,
+the random stream is an AES-256-CTR keystream (which is fast due to
+AES-NI and friends), otherwise Python's PRNG is used as fallback.
+
+With `--direct` the main wipe bypasses the page cache (O_DIRECT), i.e.
+it doesn't flood the page cache with garbage, and keeps `--depth`
+positional writes in flight. The buffers are page-aligned and the
+blocksize must be a multiple of the device's logical block size.
+
+Example (e.g. to benchmark the write engine on a loop device):
+
+    wipedev -wv --direct --depth 8 /dev/loop0
+
+Since the optimal blocksize and depth differ a lot between e.g. HDDs,
+SATA SSDs and NVMe devices, `--autotune` measures the write
+throughput of a few blocksizes (with the configured depth) and then
+of a few depths (with the best blocksize) on the first region of the
+device (cf. `--autotune-size`). The smallest setting within 5 % of
+the best throughput is used for the main wipe (and the verify step)
+and recorded in the summary. The main wipe then starts from the
+beginning again.
+
+The random stream is derived from a seed (that is logged, cf. `--seed`)
+such that the optional verify step (`--verify`) can regenerate it
+and compare it with what is read back from the device. Since the
+stream is position addressable, `--verify-sample` can also just
+check a random subset of the blocks. The verify step runs before the
+post-wipe step. Example of verifying a previous wipe later:
+
+    wipedev --verify-sample 1 --seed 3f9a...c2 /dev/sdz
+
+During the main wipe and the verify step the progress (bytes written,
+current and average throughput, ETA) is logged periodically (cf.
+`--progress`) and optionally also written as JSON lines (`--json`).
+With `--checkpoint` the main wipe periodically syncs the device and
+records the offset up to which everything is durably written (and
+the seed), such that an interrupted wipe can be continued with
+`--resume` (which skips the pre-wipe step since it already ran before
+the checkpointed wipe):
+
+    wipedev -w --checkpoint sdz.ckpt /dev/sdz
+    ^C
+    wipedev -w --checkpoint sdz.ckpt --resume /dev/sdz
+
+Several devices can be wiped in one go. Their steps then run
+concurrently (at most `--parallel` devices at a time) where the
+`--threads` random data generators are split between the devices
+and `--bwlimit` caps the total bandwidth of the main wipe and verify
+steps. A failing device doesn't abort the others. Instead of the
+per-device progress the aggregate progress is reported, and a summary
+of all devices is printed at the end. With `--checkpoint` the device's
+name is appended to the checkpoint filename. Example:
+
+    wipedev -a --parallel 8 --bwlimit 4000 --checkpoint /root/wipe.ckpt /dev/sd[b-y]
+
 The post-wipe step invokes DISCARD again which hides the fact
 that random garbage was written to the device, possibly discards
 some internal storage cells and possibly speeds up following
@@ -77,8 +161,22 @@ certainly superfluous now.
 
 '''
             )
-    p.add_argument('dev', metavar='DEVICE', nargs=1, help='device to wipe - e.g. /dev/sda')
+    p.add_argument('devs', metavar='DEVICE', nargs='+', help='device(s) to wipe - e.g. /dev/sda')
     p.add_argument('--blocksize', '-b', type=int, default=8*1024*1024, help='write blocksize in bytes (default: %(default)s)')
+    p.add_argument('--direct', '-d', action='store_true',
+            help='main wipe: bypass the page cache (O_DIRECT)')
+    p.add_argument('--depth', '-q', type=int, default=4,
+            help='main wipe: number of in-flight writes (default: %(default)s)')
+    p.add_argument('--autotune', '-t', action='store_true',
+            help='main wipe: select blocksize and depth by measuring the throughput on the first region of the device')
+    p.add_argument('--autotune-size', type=int, default=256*1024*1024, metavar='BYTES',
+            help='size of the region used for autotuning (default: %(default)s)')
+    p.add_argument('--threads', '-j', type=int, default=min(4, os.cpu_count()),
+            help='number of random data generator threads, shared by the devices wiped in parallel (default: %(default)s)')
+    p.add_argument('--parallel', '-P', type=int, default=0, metavar='N',
+            help='process at most N devices at a time, 0 means all (default: %(default)s)')
+    p.add_argument('--bwlimit', type=float, metavar='MIBS',
+            help='limit the total main wipe/verify bandwidth to MIBS MiB/s')
 
     p.add_argument('--pre-wipe', '-x', action='store_true',
             help='quickly remove signatures of all partitions and discard everything before overwriting everything')
@@ -86,18 +184,60 @@ certainly superfluous now.
             help='main wipe, i.e. overwrite everything with random garbage')
     p.add_argument('--post-wipe', '-z', action='store_true',
             help='discard everything after the main wipe')
+    p.add_argument('--zero', action='store_true',
+            help='zero out everything (BLKZEROOUT, fast with write-zeroes offload) before the post-wipe step')
+    p.add_argument('--secure', action='store_true',
+            help='use secure DISCARD (BLKSECDISCARD), if supported')
+    p.add_argument('--discard-chunk', type=int, default=1024*1024*1024, metavar='BYTES',
+            help='discard/zero out in chunks of BYTES (default: %(default)s)')
+    p.add_argument('--signature-size', type=int, default=1024*1024, metavar='BYTES',
+            help='pre-wipe: zero out BYTES at the start and end of each partition (default: %(default)s)')
+    p.add_argument('--verify', '-y', action='store_true',
+            help='read back everything and compare it with the random stream (before the post-wipe step)')
+    p.add_argument('--verify-sample', type=float, metavar='P',
+            help='just verify a random P percent of the blocks')
+    p.add_argument('--progress', type=float, default=10, metavar='SECONDS',
+            help='progress reporting interval, 0 disables it (default: %(default)s)')
+    p.add_argument('--json', metavar='FILE',
+            help='also write progress as JSON lines to FILE (- for stdout)')
+    p.add_argument('--checkpoint', metavar='FILE',
+            help='main wipe: periodically record the durably written offset in FILE')
+    p.add_argument('--resume', action='store_true',
+            help='main wipe: continue from the offset recorded in the --checkpoint file')
+    p.add_argument('--seed', help='seed of the random stream as 64 hex digits (default: random)')
     p.add_argument('--all', '-a', action='store_true',
             help='apply pre/main/post wipe steps')
     p.add_argument('--verbose', '-v', action='store_true',
             help='verbose output')
     args = p.parse_args(*a)
-    args.dev = args.dev[0]
     if args.all:
         args.pre_wipe  = True
         args.wipe      = True
         args.post_wipe = True
-    if not (args.wipe or args.pre_wipe or args.post_wipe):
+    if args.verify_sample is not None:
+        args.verify = True
+        if not 0 < args.verify_sample <= 100:
+            raise RuntimeError('verify sample percentage must be in (0, 100]')
+    if not (args.wipe or args.pre_wipe or args.post_wipe or args.verify or args.zero):
         raise RuntimeError('Specify one, more or all wipe steps')
+    if args.resume and not args.checkpoint:
+        raise RuntimeError('--resume requires --checkpoint')
+    if args.verify and not args.wipe and not args.seed:
+        raise RuntimeError('Verifying a previous wipe requires its --seed')
+    if args.seed:
+        args.seed = bytes.fromhex(args.seed)
+        if len(args.seed) != 32:
+            raise RuntimeError('seed must consist of 64 hex digits')
+    if args.blocksize % 16 != 0:
+        raise RuntimeError('blocksize must be a multiple of 16')
+    if args.discard_chunk <= 0 or args.signature_size % 4096 != 0:
+        raise RuntimeError('discard chunk must be positive and signature size a multiple of 4096')
+    if len(set(args.devs)) != len(args.devs):
+        raise RuntimeError('devices must be distinct')
+    if args.parallel <= 0:
+        args.parallel = len(args.devs)
+    if args.bwlimit is not None and args.bwlimit <= 0:
+        raise RuntimeError('bandwidth limit must be positive')
     return args
 
 
@@ -124,72 +264,921 @@ def get_size(fd):
         raise RuntimeError('Unknown file mode')
 
 
+def get_sysfs_dir(fd):
+    st = os.fstat(fd)
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    d = os.path.realpath(f'/sys/dev/block/{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}')
+    if os.path.exists(d + '/partition'):
+        # i.e. the queue limits are properties of the whole device
+        d = os.path.dirname(d)
+    return d
+
+def read_int(filename):
+    with open(filename) as f:
+        return int(f.read())
+
+# the [start, length) range of these ioctls is passed as 2 uint64
+BLKDISCARD    = 0x1277
+BLKSECDISCARD = 0x127d
+BLKZEROOUT    = 0x127f
+
+def block_op(fd, req, off, n):
+    fcntl.ioctl(fd, req, struct.pack('QQ', off, n))
+
+def is_blk(fd):
+    return stat.S_ISBLK(os.fstat(fd).st_mode)
+
+# for regular files we assume the page size which also works with O_DIRECT
+# on the usual filesystems
+def get_queue_limits(fd):
+    d = get_sysfs_dir(fd)
+    if d is None:
+        return { 'logical': mmap.PAGESIZE, 'physical': mmap.PAGESIZE, 'optimal': 0,
+                'discard': 0, 'discard_granularity': 0, 'write_zeroes': 0 }
+    return {
+            'logical' : read_int(d + '/queue/logical_block_size'),
+            'physical': read_int(d + '/queue/physical_block_size'),
+            'optimal' : read_int(d + '/queue/optimal_io_size'),
+            # i.e. 0 if the device doesn't support DISCARD
+            'discard' : read_int(d + '/queue/discard_max_bytes'),
+            'discard_granularity': read_int(d + '/queue/discard_granularity'),
+            # i.e. 0 if the device doesn't support write-zeroes offload
+            'write_zeroes': read_int(d + '/queue/write_zeroes_max_bytes')
+            }
+
+def sysfs_dev_dir(dev):
+    st = os.stat(dev)
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    return os.path.realpath(f'/sys/dev/block/{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}')
+
+# Partitions are listed in sysfs as subdirectories (of the device's
+# directory) that contain a partition attribute.
 def get_parts(dev):
-    xs = subprocess.check_output(['lsblk', '-o', 'path', '-l', '-n', dev],
-            universal_newlines=True).splitlines()
+    d = sysfs_dev_dir(dev)
+    if d is None:
+        return [ dev ]
+    xs = [ '/dev/' + x.replace('!', '/') for x in sorted(os.listdir(d))
+            if os.path.exists(f'{d}/{x}/partition') ]
     # make sure that partitions themselves are wiped before the
     # device's partition table itself ...
     xs.reverse()
-    return xs
-
-def get_luks(devs):
-    if not devs:
-        raise RuntimeError('device list must not be empty')
-    cmd = ['blkid', '--match-token', 'TYPE=crypto_LUKS', '-o', 'device'] + devs
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
-    if p.returncode not in (0, 2):
-        raise RuntimeError(
-            f'Command {",".join(cmd)} failed with exit status {p.returncode}')
-    xs = p.stdout.splitlines()
-    return xs
-
-def erase_luks(devs):
-    if not devs:
-        raise RuntimeError('device list must not be empty')
-    log.debug(f'LUKS-erasing {devs} ...')
-    subprocess.run(['cryptsetup', '--batch-mode', 'luksErase'] + devs, check=True)
-
-def wipefs(devs):
-    if not devs:
-        raise RuntimeError('device list must not be empty')
-    log.debug(f'Wipefsing {devs} ...')
-    subprocess.check_output(['wipefs', '-a'] + devs)
-
-def discard(dev):
-    log.debug(f'Discarding {dev} ...')
-    subprocess.run(['blkdiscard', dev], check=True)
-
-def pre_wipe(dev):
+    return xs + [ dev ]
+
+# i.e. as probed by udev (via libblkid), if available
+def get_fs_type(dev):
+    st = os.stat(dev)
+    if not stat.S_ISBLK(st.st_mode):
+        return None
+    try:
+        with open(f'/run/udev/data/b{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}') as f:
+            for line in f:
+                if line.startswith('E:ID_FS_TYPE='):
+                    return line[13:].strip() or None
+    except FileNotFoundError:
+        pass
+    return None
+
+def get_holders(dev):
+    d = sysfs_dev_dir(dev)
+    if d is None:
+        return []
+    return os.listdir(d + '/holders')
+
+def is_mounted(dev):
+    st = os.stat(dev)
+    if not stat.S_ISBLK(st.st_mode):
+        return False
+    k = f'{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}'
+    with open('/proc/self/mountinfo') as f:
+        return any(line.split(' ', 3)[2] == k for line in f)
+
+# i.e. refuse to touch a device with a mounted filesystem or an active
+# holder (e.g. device mapper, LVM, MD), like wipefs and blkdiscard do
+def check_unused(dev):
+    holders = get_holders(dev)
+    if holders:
+        raise RuntimeError(f'{dev} is in use by {",".join(holders)}')
+    t = get_fs_type(dev)
+    if t and is_mounted(dev):
+        raise RuntimeError(f'{dev} contains a mounted {t} filesystem')
+
+# O_EXCL fails with EBUSY if the block device is claimed by the kernel,
+# e.g. mounted or a member of an active device mapper/MD device
+def open_excl(dev, mode):
+    try:
+        return os.open(dev, mode | os.O_EXCL)
+    except OSError as e:
+        if e.errno == errno.EBUSY:
+            raise RuntimeError(f'{dev} is busy (mounted or in use)') from e
+        raise
+
+luks_magic = b'LUKS\xba\xbe'
+
+# Returns the size of the LUKS metadata (header and key-slots), i.e. the
+# offset of the first data segment.
+def get_luks_size(fd, h):
+    version = struct.unpack('>H', h[6:8])[0]
+    if version == 1:
+        return struct.unpack('>I', h[104:108])[0] * 512
+    hdr_size = struct.unpack('>Q', h[8:16])[0]
+    b = os.pread(fd, hdr_size - 4096, 4096)
+    d = json.loads(b.split(b'\0', 1)[0])
+    if d['segments']:
+        return min(int(s['offset']) for s in d['segments'].values())
+    return 2 * hdr_size + int(d['config']['keyslots_size'])
+
+def pwrite_zeros(fd, off, n):
+    z = bytes(min(n, 1024 * 1024))
+    end = off + n
+    while off < end:
+        k = min(len(z), end - off)
+        pwrite_all(fd, memoryview(z)[:k], off)
+        off += k
+
+# i.e. regular files are zeroed with plain writes
+def zero_range(fd, off, n):
+    if is_blk(fd):
+        block_op(fd, BLKZEROOUT, off, n)
+    else:
+        pwrite_zeros(fd, off, n)
+
+# Issues the ioctl on [0, size) in chunks of at most chunk bytes,
+# i.e. such that the progress can be reported and the operation can be
+# interrupted between chunks.
+def ranged_op(dev, fd, req, stage, chunk, args):
+    n = get_size(fd)
+    progress = mk_progress(dev, stage, n, args)
+    try:
+        for off in range(0, n, chunk):
+            if interrupt.is_set():
+                raise RuntimeError('Interrupted')
+            k = min(chunk, n - off)
+            if req == BLKZEROOUT:
+                zero_range(fd, off, k)
+            else:
+                block_op(fd, req, off, k)
+            progress.add(off, k)
+    finally:
+        progress.close()
+    if args.progress > 0 and not args.aggregate:
+        progress.report()
+
+# i.e. the chunk must be a multiple of the discard granularity
+def get_chunk(args, granularity):
+    g = max(granularity, 512)
+    return max(g, args.discard_chunk // g * g)
+
+def discard(dev, args):
+    fd = open_excl(dev, os.O_WRONLY)
+    try:
+        if not is_blk(fd):
+            log.warning(f'Not discarding {dev} since it is not a block device')
+            return
+        limits = get_queue_limits(fd)
+        if not limits['discard']:
+            log.warning(f'{dev} does not support DISCARD')
+            return
+        chunk = get_chunk(args, limits['discard_granularity'])
+        log.debug(f'Discarding {dev} in chunks of {chunk} bytes ...')
+        if args.secure:
+            try:
+                ranged_op(dev, fd, BLKSECDISCARD, 'secure-discard', chunk, args)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                log.warning(f'{dev} does not support secure DISCARD - falling back to DISCARD')
+        ranged_op(dev, fd, BLKDISCARD, 'discard', chunk, args)
+    finally:
+        os.close(fd)
+
+# With write-zeroes offload (e.g. NVMe Write Zeroes or SCSI WRITE SAME)
+# the device zeroes the blocks itself, otherwise the kernel writes
+# zero pages.
+def zero_out(dev, args):
+    fd = open_excl(dev, os.O_WRONLY)
+    try:
+        limits = get_queue_limits(fd)
+        if is_blk(fd) and not limits['write_zeroes']:
+            log.warning(f'{dev} does not support write-zeroes offload - zeroing out is slow')
+        log.debug(f'Zeroing out {dev} ...')
+        ranged_op(dev, fd, BLKZEROOUT, 'zero', get_chunk(args, limits['logical']), args)
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+# Removes the LUKS key-slots and the signatures at the start and the end of
+# the device/partition (i.e. where partition tables, filesystem superblocks,
+# RAID metadata etc. are usually located).
+def erase_signatures(dev, args):
+    check_unused(dev)
+    fd = open_excl(dev, os.O_RDWR)
+    try:
+        n = get_size(fd)
+        h = os.pread(fd, 4096, 0)
+        if h.startswith(luks_magic):
+            k = min(get_luks_size(fd, h), n)
+            log.debug(f'LUKS-erasing {dev} (first {k} bytes) ...')
+            zero_range(fd, 0, k)
+        k = min(args.signature_size, n)
+        log.debug(f'Erasing signatures of {dev} ...')
+        zero_range(fd, 0, k)
+        zero_range(fd, n - k, k)
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+def pre_wipe(dev, args):
     parts = get_parts(dev)
-    luks = get_luks(parts) if parts else []
+    # i.e. nothing is erased if any partition is still in use
+    for part in parts:
+        check_unused(part)
+    for part in parts:
+        erase_signatures(part, args)
+    discard(dev, args)
+
+
+# Position addressable random stream, i.e. the stream at offset off
+# can be (re-)generated independently of the other offsets.
+# The offset must be a multiple of 16.
+class AES_Stream:
+    def __init__(self, key, blocksize):
+        self.key = key
+        self.zeros = bytes(blocksize)
+
+    # NB: older cryptography versions require 15 extra bytes in the
+    # output buffer of update_into()
+    def fill(self, buf, off, n):
+        c = Cipher(algorithms.AES(self.key), modes.CTR((off // 16).to_bytes(16, 'big'))).encryptor()
+        c.update_into(memoryview(self.zeros)[:n], buf)
+
+# i.e. the PRNG is seeded per unit (and not per block) such that the
+# stream doesn't depend on the blocksize
+prng_unit = 16 * 1024
+
+class PRNG_Stream:
+    def __init__(self, key, blocksize):
+        self.key = int.from_bytes(key, 'big')
+
+    def fill(self, buf, off, n):
+        # randbytes() churns buffers (i.e. python objects) but this is
+        # (of course) still faster than e.g. copying /dev/urandom to
+        # the device ...
+        i = 0
+        while i < n:
+            base = (off + i) // prng_unit * prng_unit
+            j = off + i - base
+            k = min(prng_unit - j, n - i)
+            buf[i:i+k] = random.Random(self.key ^ base).randbytes(prng_unit)[j:j+k]
+            i += k
+
+def mk_stream(blocksize, key):
+    if have_cryptography:
+        return AES_Stream(key, blocksize)
+    else:
+        log.warning('cryptography package not available - falling back to slower PRNG')
+        return PRNG_Stream(key, blocksize)
+
+# Fills a fixed set of buffers with the random stream in several threads
+# and hands them to the consumers via a bounded queue, i.e. the number of
+# buffers is the number of threads plus the queue depth plus the
+# number of consumers.
+#
+# The buffers are page-aligned (as required for O_DIRECT) and the filled
+# blocks might arrive out of order, thus the consumers have to use
+# positional writes.
+class Producer:
+    def __init__(self, stream, size, blocksize, threads, offsets=None, consumers=1):
+        self.stream = stream
+        self.size = size
+        self.blocksize = blocksize
+        if offsets is None:
+            offsets = range(0, size, blocksize)
+        self.blocks = len(offsets)
+        self.offsets = iter(offsets)
+        self.lock = threading.Lock()
+        depth = 2 * threads
+        self.free = queue.Queue()
+        for _ in range(threads + depth + consumers):
+            self.free.put(mmap.mmap(-1, blocksize + 16))
+        self.full = queue.Queue(maxsize=depth)
+        self.done = threading.Event()
+        self.error = None
+        self.threads = [ threading.Thread(target=self.run, daemon=True) for _ in range(threads) ]
+        for t in self.threads:
+            t.start()
+
+    def next_offset(self):
+        with self.lock:
+            return next(self.offsets, None)
+
+    def run(self):
+        try:
+            while not self.done.is_set():
+                off = self.next_offset()
+                if off is None:
+                    break
+                n = min(self.blocksize, self.size - off)
+                buf = self.wait(self.free.get)
+                if buf is None:
+                    break
+                self.stream.fill(buf, off, n)
+                self.wait(self.full.put, (off, buf, n))
+        except Exception as e:
+            # i.e. all consumers stop, not just the one that would get it
+            self.error = e
+            self.done.set()
+
+    # i.e. such that the threads don't block forever after an interruption
+    def wait(self, f, *a):
+        while not self.done.is_set() and not interrupt.is_set():
+            try:
+                return f(*a, timeout=0.1)
+            except (queue.Empty, queue.Full):
+                pass
+
+    # returns (offset, buffer, length) or None when all blocks are consumed
+    # - the buffer must be released after use
+    def get(self):
+        with self.lock:
+            if self.blocks == 0:
+                return None
+            self.blocks -= 1
+        x = self.wait(self.full.get)
+        if x is None:
+            if self.error:
+                raise self.error
+            if interrupt.is_set():
+                raise RuntimeError('Interrupted')
+            return None
+        return x
+
+    def release(self, buf):
+        self.free.put(buf)
+
+    def close(self):
+        self.done.set()
+        for t in self.threads:
+            t.join()
+
+def pwrite_all(fd, b, off):
+    while b:
+        k = os.pwrite(fd, b, off)
+        b = b[k:]
+        off += k
+
+def fmt_size(n):
+    return f'{n/1024/1024/1024:.2f} GiB'
+
+# Tracks the completed (possibly out-of-order) blocks and periodically
+# reports the progress and invokes the tick callback (e.g. for
+# checkpointing) from a background thread.
+#
+# The watermark is the offset up to which all blocks are completed.
+class Progress:
+    # i.e. with report=False the thread just calls tick
+    def __init__(self, dev, stage, start, end, interval, json_file=None, tick=None, report=True):
+        self.dev = dev
+        self.stage = stage
+        self.total = end - start
+        self.watermark = start
+        self.bytes = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.interval = interval
+        self.json_file = json_file
+        self.tick = tick
+        self.reporting = report
+        self.start = time.monotonic()
+        self.last = (self.start, 0)
+        self.done = threading.Event()
+        self.thread = None
+        if interval > 0 and (tick or report):
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    # off is None if the watermark isn't tracked
+    def add(self, off, k):
+        with self.lock:
+            self.bytes += k
+            if off is None:
+                return
+            self.pending[off] = k
+            while self.watermark in self.pending:
+                self.watermark += self.pending.pop(self.watermark)
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            if self.tick:
+                self.tick(self)
+            if self.reporting:
+                self.report()
+
+    # i.e. the rate is the one since the last call
+    def state(self):
+        now = time.monotonic()
+        b = self.bytes
+        rate = (b - self.last[1]) / max(now - self.last[0], 1e-9)
+        avg = b / max(now - self.start, 1e-9)
+        eta = 0 if b >= self.total else ((self.total - b) / avg if avg else None)
+        self.last = (now, b)
+        return { 'time': time.time(), 'dev': self.dev, 'stage': self.stage, 'bytes': b,
+                'total': self.total, 'rate': rate, 'avg_rate': avg, 'eta': eta,
+                'watermark': self.watermark }
+
+    def report(self):
+        d = self.state()
+        log.info(f'{self.dev}: {self.stage} {fmt_state(d)}')
+        if self.json_file:
+            print(json.dumps(d), file=self.json_file, flush=True)
+
+    def close(self):
+        self.done.set()
+        if self.thread:
+            self.thread.join()
+
+def fmt_state(d):
+    b, total, eta = d['bytes'], d['total'], d['eta']
+    p = 100 * b / total if total else 100
+    eta_str = str(datetime.timedelta(seconds=int(eta))) if eta is not None else '?'
+    return (f'{fmt_size(b)}/{fmt_size(total)} ({p:.1f}%), {d["rate"]/1024/1024:.1f} MiB/s now, '
+            f'{d["avg_rate"]/1024/1024:.1f} MiB/s avg, ETA {eta_str}')
+
+# Aggregates the progress of several devices (which don't report
+# themselves), i.e. the totals are the ones of all stages started so far.
+class Aggregate:
+    def __init__(self, devs, interval, json_file=None):
+        self.devs = devs
+        self.interval = interval
+        self.json_file = json_file
+        self.progresses = []
+        self.results = {}
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.last = (self.start, 0)
+        self.done = threading.Event()
+        self.thread = None
+        if interval > 0:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def add(self, progress):
+        with self.lock:
+            self.progresses.append(progress)
+
+    def finish(self, dev, result):
+        with self.lock:
+            self.results[dev] = result
+
+    def run(self):
+        while not self.done.wait(self.interval):
+            self.report()
+
+    def report(self):
+        with self.lock:
+            ps = list(self.progresses)
+            failed = sum(r['status'] != 'ok' for r in self.results.values())
+            finished = len(self.results)
+        ds = [ p.state() for p in ps ]
+        now = time.monotonic()
+        b = sum(d['bytes'] for d in ds)
+        total = sum(d['total'] for d in ds)
+        rate = (b - self.last[1]) / max(now - self.last[0], 1e-9)
+        avg = b / max(now - self.start, 1e-9)
+        self.last = (now, b)
+        eta = 0 if b >= total else ((total - b) / avg if avg else None)
+        d = { 'time': time.time(), 'dev': '*', 'stage': 'all', 'bytes': b, 'total': total,
+                'rate': rate, 'avg_rate': avg, 'eta': eta, 'devices': len(self.devs),
+                'finished': finished, 'failed': failed }
+        log.info(f'{finished}/{len(self.devs)} devices finished ({failed} failed), {fmt_state(d)}')
+        if self.json_file:
+            for x in ds + [d]:
+                print(json.dumps(x), file=self.json_file, flush=True)
+
+    def close(self):
+        self.done.set()
+        if self.thread:
+            self.thread.join()
+
+# Limits the total bandwidth of all writer/reader threads, i.e. each
+# block gets the next free slot of the (virtual) bandwidth timeline.
+class Throttle:
+    def __init__(self, rate):
+        self.rate = rate
+        self.next = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        with self.lock:
+            now = time.monotonic()
+            t = max(self.next, now)
+            self.next = t + n / self.rate
+        if t > now:
+            interrupt.wait(t - now)
+
+def mk_progress(dev, stage, total, args):
+    agg = args.aggregate
+    progress = Progress(dev, stage, 0, total, args.progress,
+            None if agg else args.json_file, report=not agg)
+    if agg:
+        agg.add(progress)
+    return progress
+
+def open_json(filename):
+    if filename is None:
+        return None
+    if filename == '-':
+        return sys.stdout
+    return open(filename, 'a')
+
+def read_checkpoint(filename):
+    with open(filename) as f:
+        return json.load(f)
+
+# i.e. atomically replace the checkpoint
+def write_checkpoint(filename, d):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(d, f)
+        f.write('\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+# Runs n copies of f in a thread pool, i.e. the first failing worker
+# stops the producer and thus all other workers.
+def run_workers(producer, f, n):
+    def run():
+        try:
+            f()
+        except BaseException:
+            producer.done.set()
+            raise
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n) as e:
+        fs = [ e.submit(run) for _ in range(n) ]
+        try:
+            for x in concurrent.futures.as_completed(fs):
+                x.result()
+        except BaseException:
+            # i.e. also on KeyboardInterrupt
+            producer.done.set()
+            raise
+
+# Each writer thread keeps one write in flight, i.e. --depth writers
+# yield a queue depth of --depth.
+# With O_DIRECT, an unaligned tail (only possible with regular files)
+# is written through the page cache (i.e. via the plain fd).
+def write_blocks(fd, plain_fd, align, producer, depth, progress=None, throttle=None):
+    def run():
+        while True:
+            x = producer.get()
+            if x is None:
+                return
+            off, buf, k = x
+            if throttle:
+                throttle.take(k)
+            pwrite_all(fd if k % align == 0 else plain_fd, memoryview(buf)[:k], off)
+            producer.release(buf)
+            if progress:
+                progress.add(off, k)
+    run_workers(producer, run, depth)
+
+def open_dev(dev, direct, mode=os.O_WRONLY):
+    # i.e. no O_TRUNC for regular files
+    fd = os.open(dev, mode)
+    dfd = os.open(dev, mode | os.O_DIRECT) if direct else fd
+    return fd, dfd
+
+def close_dev(fd, dfd):
+    if dfd != fd:
+        os.close(dfd)
+    os.close(fd)
+
+autotune_blocksizes = [ 2**i * 1024 * 1024 for i in range(6) ]
+autotune_depths     = [ 1, 2, 4, 8, 16 ]
+# i.e. to limit the memory used for the buffers
+autotune_max_inflight = 256 * 1024 * 1024
+
+def get_mem_available():
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith('MemAvailable:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# Returns the throughput of writing the first region with the settings,
+# i.e. the data is synced such that the page cache isn't measured.
+def time_write(fd, dfd, align, n, region, bs, depth, args):
+    offsets = range(0, region, bs)
+    producer = Producer(mk_stream(bs, args.seed), n, bs, args.threads, offsets, consumers=depth)
+    t = time.monotonic()
+    try:
+        write_blocks(dfd, fd, align, producer, depth)
+    finally:
+        producer.close()
+    os.fdatasync(fd)
+    return sum(min(bs, n - off) for off in offsets) / max(time.monotonic() - t, 1e-9)
+
+# Coordinate search, i.e. first the blocksize is selected (with the
+# configured depth) and then the depth (with the selected blocksize).
+# In each round the smallest setting within 5 % of the best throughput
+# is selected. The settings whose buffers (cf. Producer) don't fit into
+# half of the available memory (shared by the devices that are wiped in
+# parallel) are skipped.
+def autotune(dev, fd, dfd, align, n, limits, args):
+    region = min(args.autotune_size, n)
+    budget = get_mem_available() // 2 // min(args.parallel, len(args.devs))
+    def fits(bs, depth):
+        return (3 * args.threads + depth) * (bs + 16) <= budget
+    trials = []
+    def select(xs, f):
+        rs = []
+        for x in xs:
+            bs, depth = f(x)
+            rate = time_write(fd, dfd, align, n, region, bs, depth, args)
+            log.debug(f'Autotuning {dev}: blocksize {bs}, depth {depth}: {rate/1024/1024:.1f} MiB/s')
+            trials.append({ 'blocksize': bs, 'depth': depth, 'rate': rate })
+            rs.append((x, rate))
+        best = max(rate for _, rate in rs)
+        return next((x, rate) for x, rate in rs if rate >= 0.95 * best)
+    opt = limits['optimal'] or 1
+    bss = [ b for b in autotune_blocksizes if b % align == 0 and b % opt == 0 and b <= region
+            and fits(b, args.depth) ]
+    bs, _ = select(bss or [ args.blocksize ], lambda b: (b, args.depth))
+    ds = [ d for d in autotune_depths if d * bs <= autotune_max_inflight and fits(bs, d) ]
+    depth, rate = select(ds or [ 1 ], lambda d: (bs, d))
+    log.info(f'Autotuned {dev}: blocksize {bs}, depth {depth} ({rate/1024/1024:.1f} MiB/s)')
+    return bs, depth, trials
+
+def wipe(dev, args, start=0):
+    fd, dfd = open_dev(dev, args.direct)
+    try:
+        n = get_size(fd)
+        limits = get_queue_limits(fd)
+        log.debug(f'Queue limits of {dev}: {limits}')
+        align = limits['logical'] if args.direct else 1
+        if args.autotune and start == 0:
+            if args.throttle:
+                log.warning('Not autotuning since the bandwidth is limited')
+            else:
+                args.blocksize, args.depth, args.trials = autotune(dev, fd, dfd, align, n, limits, args)
+        if args.blocksize % align != 0:
+            raise RuntimeError(f'blocksize must be a multiple of the logical block size ({align})')
+        if limits['optimal'] and args.blocksize % limits['optimal'] != 0:
+            log.warning(f'blocksize is not a multiple of the optimal I/O size ({limits["optimal"]})')
+        if start % args.blocksize != 0:
+            raise RuntimeError(f'Resume offset {start} is not a multiple of the blocksize')
+        log.debug(f'Writing {fmt_size(n - start)} random data to {dev} (starting at offset {start}) ...')
+        stream = mk_stream(args.blocksize, args.seed)
+        producer = Producer(stream, n, args.blocksize, args.threads,
+                range(start, n, args.blocksize), consumers=args.depth)
+        def checkpoint(progress):
+            # i.e. everything below the watermark is durable after the sync
+            off = progress.watermark
+            os.fdatasync(fd)
+            write_checkpoint(args.checkpoint, { 'dev': dev, 'size': n,
+                'blocksize': args.blocksize, 'depth': args.depth, 'seed': args.seed.hex(),
+                'offset': off })
+            log.debug(f'Checkpointed offset {off}')
+        tick = checkpoint if args.checkpoint else None
+        interval = args.progress if args.progress > 0 or not tick else 10
+        agg = args.aggregate
+        report = args.progress > 0 and not agg
+        progress = Progress(dev, 'wipe', start, n, interval,
+                None if agg else args.json_file, tick, report)
+        if agg:
+            agg.add(progress)
+        t = time.monotonic()
+        try:
+            write_blocks(dfd, fd, align, producer, args.depth, progress, args.throttle)
+        finally:
+            producer.close()
+            progress.close()
+            # i.e. also after an interruption, such that --resume
+            # continues from the last block written
+            if tick:
+                tick(progress)
+        if not tick:
+            os.fdatasync(fd)
+        if report:
+            progress.report()
+        d = time.monotonic() - t
+        log.debug(f'Wrote {fmt_size(n - start)} in {d:.1f} s ({(n - start)/1024/1024/max(d, 1e-9):.1f} MiB/s)')
+        return n - start
+    finally:
+        close_dev(fd, dfd)
+
+def resume_offset(dev, args):
+    c = read_checkpoint(args.checkpoint)
+    if args.autotune:
+        # i.e. continue with the autotuned settings
+        args.blocksize = c['blocksize']
+        args.depth = c.get('depth', args.depth)
+    if c['dev'] != dev or c['blocksize'] != args.blocksize:
+        raise RuntimeError(f'Checkpoint {args.checkpoint} is for {c["dev"]} with blocksize {c["blocksize"]}')
+    seed = bytes.fromhex(c['seed'])
+    if args.seed is not None and args.seed != seed:
+        raise RuntimeError('--seed differs from the checkpointed one')
+    args.seed = seed
+    log.info(f'Resuming wipe of {dev} at offset {c["offset"]} ({fmt_size(c["offset"])})')
+    return c['offset']
+
+
+def pread_all(fd, b, off):
+    n = len(b)
+    while b:
+        k = os.preadv(fd, [b], off)
+        if k == 0:
+            raise RuntimeError(f'Unexpected EOF at offset {off}')
+        b = b[k:]
+        off += k
+    return n
+
+def first_mismatch(a, b):
+    i = 0
+    n = len(a)
+    k = 4096
+    while i < n and a[i:i+k] == b[i:i+k]:
+        i += k
+    while a[i] == b[i]:
+        i += 1
+    return i
+
+# Regenerates the random stream with the same generator as the main wipe
+# and compares it with what the --depth reader threads read back.
+# Returns the offset of the first mismatch or None.
+def verify(dev, args):
+    fd, dfd = open_dev(dev, args.direct, os.O_RDONLY)
+    try:
+        n = get_size(fd)
+        align = get_queue_limits(fd)['logical'] if args.direct else 1
+        if not args.direct:
+            # i.e. don't just verify the page cache
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        offsets = range(0, n, args.blocksize)
+        if args.verify_sample is not None:
+            k = max(1, int(len(offsets) * args.verify_sample / 100))
+            offsets = sorted(random.sample(offsets, k))
+        log.debug(f'Verifying {len(offsets)} blocks of {dev} ...')
+        stream = mk_stream(args.blocksize, args.seed)
+        producer = Producer(stream, n, args.blocksize, args.threads, offsets, consumers=args.depth)
+        total = sum(min(args.blocksize, n - off) for off in offsets)
+        progress = mk_progress(dev, 'verify', total, args)
+        lock = threading.Lock()
+        mismatch = []
+        read = [0]
+        def run():
+            rbuf = mmap.mmap(-1, args.blocksize)
+            while True:
+                x = producer.get()
+                if x is None:
+                    return
+                off, buf, k = x
+                if args.throttle:
+                    args.throttle.take(k)
+                r = memoryview(rbuf)[:k]
+                pread_all(dfd if k % align == 0 else fd, r, off)
+                e = memoryview(buf)[:k]
+                # compare_digest() doesn't copy
+                ok = hmac.compare_digest(r, e)
+                with lock:
+                    read[0] += k
+                    if not ok:
+                        mismatch.append(off + first_mismatch(r, e))
+                producer.release(buf)
+                progress.add(None, k)
+        start = time.monotonic()
+        try:
+            run_workers(producer, run, args.depth)
+        finally:
+            producer.close()
+            progress.close()
+        d = time.monotonic() - start
+        log.info(f'Verified {fmt_size(read[0])} of {dev} in {d:.1f} s ({read[0]/1024/1024/max(d, 1e-9):.1f} MiB/s)')
+        if mismatch:
+            log.error(f'Verification of {dev} failed: {len(mismatch)} mismatching blocks, first mismatch at offset {min(mismatch)}')
+            return min(mismatch)
+        return None
+    finally:
+        close_dev(fd, dfd)
+
+
+def mk_result(dev):
+    return { 'dev': dev, 'status': 'ok', 'steps': [], 'written': 0, 'seconds': 0.0,
+            'mismatch': None, 'error': None, 'seed': None, 'blocksize': None,
+            'depth': None, 'autotune': None }
+
+# Executes all selected steps for one device and records them in res,
+# i.e. the args are copied since the seed and checkpoint are per-device.
+def run_device(dev, args, res):
+    args = copy.copy(args)
+    t = time.monotonic()
+    if args.checkpoint and len(args.devs) > 1:
+        args.checkpoint = f'{args.checkpoint}.{os.path.basename(dev)}'
+    start = 0
+    resume = args.wipe and args.resume
+    if resume:
+        start = resume_offset(dev, args)
+    if args.seed is None:
+        args.seed = os.urandom(32)
+        if args.verify or args.wipe:
+            log.info(f'Random stream seed of {dev}: {args.seed.hex()}')
+    res['seed'] = args.seed.hex()
+    try:
+        # i.e. the device already contains (partly) wiped data, thus,
+        # there is nothing left to erase or discard
+        if  args.pre_wipe and not resume:
+            res['steps'].append('pre-wipe')
+            pre_wipe(dev, args)
+        if args.wipe:
+            res['steps'].append('wipe')
+            res['written'] = wipe(dev, args, start)
+            res.update(blocksize=args.blocksize, depth=args.depth, autotune=args.trials)
+        if args.verify:
+            res['steps'].append('verify')
+            res['mismatch'] = verify(dev, args)
+            if res['mismatch'] is not None:
+                res['status'] = 'mismatch'
+        if args.zero:
+            res['steps'].append('zero')
+            zero_out(dev, args)
+        if  args.post_wipe:
+            res['steps'].append('post-wipe')
+            discard(dev, args)
+    finally:
+        res['seconds'] = time.monotonic() - t
+    return res
 
-    if luks:
-        erase_luks(luks)
-    wipefs(parts)
+def run_device_safely(dev, args):
+    res = mk_result(dev)
+    if interrupt.is_set():
+        res.update(status='skipped', error='Interrupted')
+        return res
+    try:
+        run_device(dev, args, res)
+    except Exception as e:
+        if interrupt.is_set():
+            res.update(status='interrupted', error=str(e))
+        else:
+            log.error(f'Wiping {dev} failed: {e}')
+            log.debug(f'Wiping {dev} failed', exc_info=True)
+            res.update(status='failed', error=str(e))
+    args.aggregate.finish(dev, res)
+    return res
 
-    discard(dev)
+def print_summary(rs, json_file):
+    print(f'{"device":<20} {"status":<8} {"written":>10} {"seconds":>9} {"MiB/s":>8} '
+          f'{"bs/depth":>9}  steps/error')
+    for r in rs:
+        tuning = f'{r["blocksize"]//1024}K/{r["depth"]}' if r['blocksize'] else '-'
+        rate = r['written'] / 1024 / 1024 / max(r['seconds'], 1e-9)
+        s = r['error'] or ','.join(r['steps'])
+        if r['mismatch'] is not None:
+            s += f' (first mismatch at offset {r["mismatch"]})'
+        print(f'{r["dev"]:<20} {r["status"]:<8} {fmt_size(r["written"]):>10} '
+              f'{r["seconds"]:>9.1f} {rate:>8.1f} {tuning:>9}  {s}')
+        if json_file:
+            print(json.dumps(dict(r, stage='summary')), file=json_file, flush=True)
 
+# Several devices are processed by a pool of --parallel threads, i.e.
+# one device's failure is just reported in the summary.
+def run_devices(args):
+    n = min(args.parallel, len(args.devs))
+    args.threads = max(1, args.threads // n)
+    args.aggregate = Aggregate(args.devs, args.progress, args.json_file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n) as e:
+        fs = [ e.submit(run_device_safely, dev, args) for dev in args.devs ]
+        try:
+            for f in fs:
+                f.result()
+        except BaseException:
+            interrupt.set()
+            log.error('Interrupted - stopping all devices ...')
+            concurrent.futures.wait(fs)
+    args.aggregate.close()
+    rs = [ f.result() for f in fs ]
+    print_summary(rs, args.json_file)
+    if interrupt.is_set():
+        return 130
+    return int(any(r['status'] != 'ok' for r in rs))
 
 def main(*a):
     args = parse_args(*a)
     setup_logging(args.verbose)
-    if  args.pre_wipe:
-        pre_wipe(args.dev)
-    if args.wipe:
-        with open(args.dev, 'wb', buffering=0) as f:
-            n = get_size(f.fileno())
-            log.debug(f'Writing {n/1024/1024/1024} GiB random data to {args.dev} ...')
-            blocks = n // args.blocksize
-            rest   = n %  args.blocksize
-            for _ in range(blocks):
-                # randbytes() churns buffers (i.e. python
-                # objects) but this is (of course) still faster
-                # than e.g. copying /dev/urandom to the device
-                # ...
-                f.write(random.randbytes(args.blocksize))
-            f.write(random.randbytes(rest))
-    if  args.post_wipe:
-        discard(args.dev)
+    args.aggregate = None
+    args.trials = None
+    args.throttle = Throttle(args.bwlimit * 1024 * 1024) if args.bwlimit else None
+    args.json_file = open_json(args.json)
+    try:
+        if len(args.devs) > 1:
+            return run_devices(args)
+        r = run_device(args.devs[0], args, mk_result(args.devs[0]))
+        return int(r['status'] != 'ok')
+    finally:
+        if args.json_file and args.json_file is not sys.stdout:
+            args.json_file.close()
 
 if __name__ == '__main__':
     sys.exit(main())